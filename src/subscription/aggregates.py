@@ -0,0 +1,120 @@
+import threading
+from decimal import Decimal
+
+from .signals import subscription_changed, websites_added, websites_removed
+
+
+class SubscriptionAggregates:
+    """
+    Running revenue and plan mix aggregates of a set of customers: the total revenue of their subscriptions,
+    the number of customers per plan type and per plan, and the number of websites per plan.
+
+    Aggregates follow, in O(1), the customers subscription changes (thus subscribe_plan and change_plan) and websites
+    additions and removals, through the subscription_changed, websites_added and websites_removed signals.
+    Changes these signals don't cover (e.g. a plan price changed in place) are caught by audit().
+    """
+
+    def __init__(self, customers=()):
+        """
+        :param customers=(): Customers to aggregate straight away
+        """
+        # customer identity -> the plan counted for it (None while it has no subscription)
+        self._plans = {}
+        self._reset()
+        # Signals of different customers may be sent from different threads at the same time
+        self._lock = threading.Lock()
+
+        for customer in customers:
+            self.add(customer)
+
+        subscription_changed.connect(self._subscription_changed)
+        websites_added.connect(self._websites_added)
+        websites_removed.connect(self._websites_removed)
+
+    def __len__(self):
+        return len(self._plans)
+
+    def __contains__(self, customer):
+        return id(customer) in self._plans
+
+    @property
+    def mrr(self):
+        """Monthly recurring revenue, as subscriptions are renewed every year."""
+        return self.revenue / 12
+
+    @property
+    def arr(self):
+        """Annual recurring revenue."""
+        return self.revenue
+
+    def add(self, customer):
+        with self._lock:
+            if id(customer) not in self._plans:
+                self._plans[id(customer)] = customer.subscription
+                self._count(customer.subscription, 1, customer.websites.count())
+
+    def discard(self, customer):
+        with self._lock:
+            if id(customer) in self._plans:
+                self._count(self._plans.pop(id(customer)), -1, -customer.websites.count())
+
+    def audit(self, customers):
+        """
+        Recomputes the aggregates from scratch, out of the given customers (the ones aggregated), returning the
+        {aggregate name: (running value, recomputed value)} of the ones which drifted, or an empty dict.
+        """
+        # A bare object is enough to recompute them, without following the signals
+        audited = SubscriptionAggregates.__new__(SubscriptionAggregates)
+        audited._reset()
+        for customer in customers:
+            audited._count(customer.subscription, 1, customer.websites.count())
+
+        with self._lock:
+            return {
+                name: (getattr(self, name), getattr(audited, name))
+                for name in ('revenue', 'customers_by_plan_type', 'customers_by_plan', 'websites_by_plan')
+                if getattr(self, name) != getattr(audited, name)
+            }
+
+    def _reset(self):
+        self.revenue = Decimal(0)
+        self.customers_by_plan_type = {}
+        self.customers_by_plan = {}
+        self.websites_by_plan = {}
+
+    def _count(self, plan, customers, websites):
+        """Adds (or, with negative numbers, subtracts) customers subscribing a plan and their websites."""
+        if not plan:
+            return
+
+        self.revenue += plan.price * customers
+        for index, key, value in (
+            (self.customers_by_plan_type, plan.plan_type, customers),
+            (self.customers_by_plan, plan, customers),
+            (self.websites_by_plan, plan, websites),
+        ):
+            total = index.get(key, 0) + value
+            if total:
+                index[key] = total
+            else:
+                index.pop(key, None)
+
+    def _subscription_changed(self, sender, instance, old_subscription, **kwargs):
+        if id(instance) not in self._plans or old_subscription is instance.subscription:
+            return
+
+        with self._lock:
+            websites = instance.websites.count()
+            self._count(self._plans[id(instance)], -1, -websites)
+            self._count(instance.subscription, 1, websites)
+            self._plans[id(instance)] = instance.subscription
+
+    def _websites_added(self, sender, instance, websites, **kwargs):
+        if id(instance) in self._plans:
+            with self._lock:
+                self._count(self._plans[id(instance)], 0, len(websites))
+
+    def _websites_removed(self, sender, instance, websites, **kwargs):
+        if id(instance) in self._plans:
+            with self._lock:
+                self._count(self._plans[id(instance)], 0, -len(websites))
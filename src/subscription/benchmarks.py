@@ -0,0 +1,399 @@
+"""
+Benchmarks of the subscription models and managers.
+
+Usage:
+    $ python -m subscription.benchmarks suite --sizes 1000 10000 100000 --output results.json --baseline baseline.json
+    $ python -m subscription.benchmarks memory --total 1000000
+    $ python -m subscription.benchmarks renewals --total 1000000
+    $ python -m subscription.benchmarks locks --total 100000
+    $ python -m subscription.benchmarks async --total 100000 --customers 1000 --concurrency 100
+
+Times are only comparable on the machine (and Python) they were measured on, so a baseline is only valid there.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+from .hashers import password_hasher
+from .locks import customer_locks
+from .managers import WebsiteManager
+from .models import Customer, Plan, Website
+from .services import AsyncSubscriptionService
+from .storage import ArrayStorage, MemoryStorage
+from .utils import get_renewal_dates, numpy
+
+
+# Customers are created with a password hashed once, rather than hashing it again for each of them
+PASSWORD = password_hasher.hash('bar')
+
+STORAGES = {
+    'memory': MemoryStorage,
+    'array': ArrayStorage,
+}
+
+
+def measure_websites_memory(total, storage='memory'):
+    """Returns the memory (in bytes) taken by a customer holding a total of websites on the given storage."""
+    urls = ['https://foo{}.bar'.format(i) for i in range(total)]
+    gc.collect()
+    tracemalloc.start()
+
+    customer = Customer('foo', PASSWORD, 'foo@bar.com', Plan('Infinite', 249.0, 'infinite'))
+    customer.websites = WebsiteManager(customer, STORAGES[storage]())
+    customer.websites.bulk_add(Website(url) for url in urls)
+
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return current
+
+
+def memory(args):
+    for storage in STORAGES:
+        size = measure_websites_memory(args.total, storage)
+        print('{:>8} storage: {:>8.1f} MiB ({:.1f} bytes per website)'.format(
+            storage, size / 2 ** 20, size / args.total
+        ))
+
+
+def renewals(args):
+    plan = Plan('Single', 49.0, 'single')
+    customers = []
+    for i in range(args.total):
+        customer = Customer('foo', PASSWORD, 'foo@bar.com', plan)
+        customer.subscription_date = date(2000, 1, 1) + timedelta(days=i % 7305)
+        customers.append(customer)
+
+    timings = [('sub_renewal_date property', lambda: [customer.sub_renewal_date for customer in customers])]
+    timings.append(('get_renewal_dates (python)', lambda: get_renewal_dates(customers, use_numpy=False)))
+    if numpy is not None:
+        timings.append(('get_renewal_dates (numpy)', lambda: get_renewal_dates(customers, use_numpy=True)))
+
+    for name, func in timings:
+        start = time.perf_counter()
+        func()
+        print('{:>28}: {:.3f}s'.format(name, time.perf_counter() - start))
+
+
+def locks(args):
+    customer = Customer('foo', PASSWORD, 'foo@bar.com', Plan('Plus', 99.0, 'plus', total_websites_allowed=3))
+    websites = [Website('https://foo{}.bar'.format(i)) for i in range(args.total)]
+
+    start = time.perf_counter()
+    for website in websites:
+        customer.websites.add(website)
+        customer.websites.remove(website)
+    total_time = time.perf_counter() - start
+
+    # Each add and remove holds the customer lock once. The time of the loop itself is left out.
+    start = time.perf_counter()
+    for _ in range(args.total * 2):
+        with customer_locks.hold(customer):
+            pass
+    locks_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(args.total * 2):
+        pass
+    locks_time -= time.perf_counter() - start
+
+    print('add + remove: {:.2f}us, uncontended locking: {:.2f}us ({:.1%})'.format(
+        total_time / args.total * 1e6, locks_time / args.total * 1e6, locks_time / total_time
+    ))
+
+
+def async_service(args):
+    plan = Plan('Infinite', 249.0, 'infinite')
+    customers = [Customer('foo', PASSWORD, 'foo{}@bar.com'.format(i), plan) for i in range(args.customers)]
+    requests = [(customers[i % args.customers], Website('https://foo{}.bar'.format(i))) for i in range(args.total)]
+
+    start = time.perf_counter()
+    for customer, website in requests:
+        customer.websites.add(website)
+        customer.websites.remove(website)
+    sync_time = time.perf_counter() - start
+
+    service = AsyncSubscriptionService()
+    queue = iter(requests)
+
+    async def client():
+        # Each client sends its next request once the previous one is answered
+        for customer, website in queue:
+            await service.add_websites(customer, website)
+            await service.remove_website(customer, website)
+
+    async def load():
+        await asyncio.gather(*(client() for _ in range(args.concurrency)))
+
+    start = time.perf_counter()
+    asyncio.run(load())
+    async_time = time.perf_counter() - start
+
+    for name, elapsed in (('sync', sync_time), ('async', async_time)):
+        print('{:>5}: {:>9.0f} requests/s'.format(name, args.total * 2 / elapsed))
+
+
+def _customer(plan_type='infinite', websites=0):
+    plan = Plan('Plan', 99.0, plan_type, total_websites_allowed=3 if plan_type == 'plus' else 1)
+    customer = Customer('foo', PASSWORD, 'foo@bar.com', plan)
+    customer.websites.bulk_add(Website('https://foo{}.bar'.format(i)) for i in range(websites))
+    return customer
+
+
+def setup_websites_add(size):
+    customer = _customer()
+    websites = [Website('https://foo{}.bar'.format(i)) for i in range(size)]
+
+    def run():
+        for website in websites:
+            customer.websites.add(website)
+    return run
+
+
+def setup_websites_get(size):
+    customer = _customer(websites=size)
+    websites = list(customer.websites.all())
+
+    def run():
+        for website in websites:
+            customer.websites.get(website)
+    return run
+
+
+def setup_websites_remove(size):
+    customer = _customer(websites=size)
+    websites = list(customer.websites.all())
+
+    def run():
+        for website in websites:
+            customer.websites.remove(website)
+    return run
+
+
+def setup_websites_count(size):
+    customer = _customer(websites=size)
+
+    def run():
+        for _ in range(size):
+            customer.websites.count()
+    return run
+
+
+def setup_can_add_website(size):
+    customers = [_customer('plus', websites=i % 3) for i in range(size)]
+
+    def run():
+        for customer in customers:
+            customer.can_add_website()
+    return run
+
+
+def setup_sub_renewal_date(size):
+    plan = Plan('Single', 49.0, 'single')
+    customers = [Customer('foo', PASSWORD, 'foo@bar.com', plan) for _ in range(size)]
+    for i, customer in enumerate(customers):
+        customer.subscription_date = date(2000, 1, 1) + timedelta(days=i % 7305)
+
+    def run():
+        for customer in customers:
+            customer.sub_renewal_date
+    return run
+
+
+def setup_change_plan(size):
+    plans = [Plan('Single', 49.0, 'single'), Plan('Infinite', 249.0, 'infinite')]
+    customers = [Customer('foo', PASSWORD, 'foo@bar.com', plans[0]) for _ in range(size)]
+
+    def run():
+        for customer in customers:
+            customer.change_plan(plans[1])
+    return run
+
+
+# Each case sets up its data for a size, returning a function running `size` operations
+SUITE = {
+    'websites_add': setup_websites_add,
+    'websites_get': setup_websites_get,
+    'websites_remove': setup_websites_remove,
+    'websites_count': setup_websites_count,
+    'can_add_website': setup_can_add_website,
+    'sub_renewal_date': setup_sub_renewal_date,
+    'change_plan': setup_change_plan,
+}
+
+# Cases whose runs don't change their data, so they're run over and over on a single setup
+READ_ONLY_CASES = {setup_websites_get, setup_websites_count, setup_can_add_website, setup_sub_renewal_date}
+
+
+def run_case(setup, size, repeat=3, min_time=0.5):
+    """
+    Runs a case at the given size, at least `repeat` times and for `min_time` seconds (setups included), so that
+    small sizes are run enough times for their timings to settle, returning the median time of the runs, and the
+    peak memory (bytes) and memory blocks left allocated by one more run, traced with tracemalloc.
+    """
+    times = []
+    run = None
+    # Garbage left by the previous case (such as its websites reference cycles) isn't counted against this one
+    gc.collect()
+    deadline = time.perf_counter() + min_time
+    while len(times) < repeat or time.perf_counter() < deadline:
+        if run is None or setup not in READ_ONLY_CASES:
+            run = setup(size)
+        gc.collect()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+
+    # Tracing memory slows everything down, so it's done on a run of its own
+    run = setup(size)
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    run()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    median_time = statistics.median(times)
+    return {
+        'time': median_time,
+        'time_per_operation': median_time / size,
+        'runs': len(times),
+        'peak_memory': peak_memory,
+        'allocated_blocks': sys.getallocatedblocks() - blocks,
+    }
+
+
+def machine():
+    """Returns the description of the machine running the benchmarks, which their times depend on."""
+    return {
+        'system': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpus': os.cpu_count(),
+        'python': '{} {}'.format(platform.python_implementation(), platform.python_version()),
+    }
+
+
+# Metrics compared with a baseline, with the increase under which they're never flagged, whatever the tolerance, as
+# timings of the same operations vary by a microsecond or so from process to process on shared machines (and the
+# memory of small runs by a few hundred bytes)
+NOISE_FLOORS = {
+    'time_per_operation': 1.5e-6,
+    'peak_memory': 1024,
+}
+
+
+def compare(results, baseline, tolerance, noise_floors=None):
+    """
+    Returns the (case, size, metric, value, baseline value) of the results regressing from the baseline: the median
+    time per operation or the peak memory grown over the tolerance, by more than the metric noise floor.
+    """
+    noise_floors = noise_floors or NOISE_FLOORS
+    regressions = []
+    for case, sizes in results.items():
+        for size, metrics in sizes.items():
+            baseline_metrics = baseline.get(case, {}).get(size)
+            if not baseline_metrics:
+                continue
+
+            for metric, noise_floor in noise_floors.items():
+                value, baseline_value = metrics[metric], baseline_metrics[metric]
+                if value > baseline_value * (1 + tolerance) and value - baseline_value > noise_floor:
+                    regressions.append((case, size, metric, value, baseline_value))
+
+    return regressions
+
+
+def suite(args):
+    cases = args.cases or list(SUITE)
+    results = {}
+
+    for case in cases:
+        results[case] = {}
+        for size in args.sizes:
+            metrics = results[case][str(size)] = run_case(SUITE[case], size, args.repeat, args.min_time)
+            print('{:>18} {:>9}: {:>9.4f}s {:>8.3f}us/op {:>5} runs {:>10.1f} KiB peak {:>9} blocks'.format(
+                case, size, metrics['time'], metrics['time_per_operation'] * 1e6, metrics['runs'],
+                metrics['peak_memory'] / 1024, metrics['allocated_blocks'],
+            ), file=sys.stderr)
+
+    # Results are stored along with the machine they were measured on, the only one they can be compared on
+    output = {'machine': machine(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(output, output_file, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        if baseline['machine'] != output['machine']:
+            print('WARNING: the baseline was measured on another machine ({}), so its times aren\'t comparable. '
+                  'Refresh it on this machine with --output.'.format(baseline['machine']), file=sys.stderr)
+
+        noise_floors = dict(NOISE_FLOORS, time_per_operation=args.noise_floor * 1e-6)
+        regressions = compare(results, baseline['results'], args.tolerance, noise_floors)
+
+        for case, size, metric, value, baseline_value in regressions:
+            print('REGRESSION {} {} {}: {:.6g} (baseline {:.6g}, +{:.0%})'.format(
+                case, size, metric, value, baseline_value, value / baseline_value - 1
+            ), file=sys.stderr)
+
+        if regressions:
+            sys.exit(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m subscription.benchmarks', description=__doc__.split('\n')[1])
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    suite_parser = subparsers.add_parser('suite', help='Models and managers operations at several sizes, as JSON')
+    suite_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    suite_parser.add_argument('--cases', nargs='+', choices=list(SUITE), help='Cases to run. Defaults to all.')
+    suite_parser.add_argument('--repeat', type=int, default=3, help='Minimum runs per case, keeping the median time')
+    suite_parser.add_argument('--min-time', type=float, default=0.5, help='Minimum seconds running each case')
+    suite_parser.add_argument('--output', help='File to write the JSON results to. Defaults to stdout.')
+    suite_parser.add_argument('--baseline', help='JSON results to compare with, exiting with 1 on regressions')
+    # Timings of the same case vary by up to 30% from process to process on shared machines (e.g. CI runners)
+    suite_parser.add_argument('--tolerance', type=float, default=0.35, help='Increase flagged as regression')
+    suite_parser.add_argument(
+        '--noise-floor', type=float, default=NOISE_FLOORS['time_per_operation'] * 1e6,
+        help='Microseconds per operation under which time increases are never flagged',
+    )
+    suite_parser.set_defaults(func=suite)
+
+    memory_parser = subparsers.add_parser('memory', help='Memory taken by websites, per storage')
+    memory_parser.add_argument('--total', type=int, default=1000000)
+    memory_parser.set_defaults(func=memory)
+
+    renewals_parser = subparsers.add_parser('renewals', help='Renewal dates calculation, one by one and at once')
+    renewals_parser.add_argument('--total', type=int, default=1000000)
+    renewals_parser.set_defaults(func=renewals)
+
+    locks_parser = subparsers.add_parser('locks', help='Uncontended customer locking overhead on add and remove')
+    locks_parser.add_argument('--total', type=int, default=100000)
+    locks_parser.set_defaults(func=locks)
+
+    async_parser = subparsers.add_parser('async', help='Requests per second of the async service and the sync path')
+    async_parser.add_argument('--total', type=int, default=100000)
+    async_parser.add_argument('--customers', type=int, default=1000)
+    async_parser.add_argument('--concurrency', type=int, default=100)
+    async_parser.set_defaults(func=async_service)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+from decimal import Decimal
+
+from .models import Plan
+
+
+class PlanCatalog:
+    """
+    Interns plans by their (name, price, plan type, total websites allowed), so that customers subscribing
+    identical plans share a single Plan object, which is only created (and validated) once.
+
+    Plans on a catalog are shared, so they shouldn't be changed afterwards.
+    """
+
+    def __init__(self, plans=()):
+        """
+        :param plans=(): Plans to intern straight away
+        """
+        self._plans = {}
+
+        for plan in plans:
+            self.intern(plan)
+
+    def __contains__(self, plan):
+        return self._plans.get(self.key(plan)) is plan
+
+    def __iter__(self):
+        return iter(list(self._plans.values()))
+
+    def __len__(self):
+        return len(self._plans)
+
+    def get(self, name, price, plan_type='single', total_websites_allowed=1):
+        """Returns the plan with the given values, creating it if needed. Takes the same arguments as Plan."""
+        key = (name, Decimal(price), plan_type, total_websites_allowed)
+        plan = self._plans.get(key)
+        if plan is None:
+            # setdefault keeps a single plan per key even when threads create it at the same time
+            plan = self._plans.setdefault(key, Plan(*key))
+
+        return plan
+
+    def intern(self, plan):
+        """Returns the catalog plan identical to the given one, which is added when there's none."""
+        return self._plans.setdefault(self.key(plan), plan)
+
+    @staticmethod
+    def key(plan):
+        return plan.name, plan.price, plan.plan_type, plan.total_websites_allowed
@@ -0,0 +1,204 @@
+import itertools
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+
+from .signals import subscription_changed, website_url_changed, websites_added, websites_removed
+
+logger = logging.getLogger(__name__)
+
+# A change of a customer: its `kind` is the name of the signal it comes from, and `data` holds the signal arguments,
+# along with the new values of the changed attributes (`subscription` and `subscription_date`, or `url`). Websites
+# added or removed are given by their `urls`, as they were when the change happened.
+ChangeEvent = namedtuple('ChangeEvent', ('kind', 'customer', 'data'))
+
+
+class EventBus:
+    """
+    In-process stream of the customers subscription and websites changes (thus of subscribe_plan, change_plan and
+    WebsiteManager.add/remove/update), delivered to the subscribers in batches, on the order they happened.
+
+    Events are queued from the models signals and flushed once `batch_size` of them are pending, or every
+    `flush_interval` seconds by a background thread. Repeated subscription changes of a customer (or url changes of
+    a website) still pending are coalesced into a single event, queued at the place of the last one. When
+    `max_pending` events are queued, the code changing the customers blocks until the subscribers catch up.
+
+    Subscribers are called with each batch (a list of ChangeEvent objects) from the flushing thread, and
+    shouldn't change the customers themselves.
+    """
+
+    def __init__(self, batch_size=500, flush_interval=1.0, max_pending=10000):
+        """
+        :param batch_size=500: Maximum number of events per batch, which are flushed once that many are pending
+        :param flush_interval=1.0: Seconds between flushes of the background thread started by start(). With None,
+            no thread is used and events are flushed by the code changing the customers, or by calling flush().
+        :param max_pending=10000: Number of queued events blocking further changes, until some are flushed
+        """
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max(max_pending, batch_size)
+        self.subscribers = []
+
+        # Coalescing key -> event, where events which can't be coalesced get a key of their own
+        self._pending = OrderedDict()
+        self._keys = itertools.count()
+        self._condition = threading.Condition()
+        # Serializes the deliveries, so that the subscribers get the batches in order
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+        subscription_changed.connect(self._subscription_changed)
+        websites_added.connect(self._websites_added)
+        websites_removed.connect(self._websites_removed)
+        website_url_changed.connect(self._website_url_changed)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def subscribe(self, subscriber):
+        """
+        :param subscriber: Callable to be called with each batch of events
+        """
+        # The subscribers list is replaced rather than changed, so that it can be iterated while delivering
+        self.subscribers = self.subscribers + [subscriber]
+
+    def unsubscribe(self, subscriber):
+        self.subscribers = [registered for registered in self.subscribers if registered is not subscriber]
+
+    def start(self):
+        """Starts the background thread flushing the events every flush_interval seconds (if any)."""
+        if self.flush_interval is not None and self._thread is None:
+            self._closed = False
+            self._thread = threading.Thread(target=self._run, name='subscription-events', daemon=True)
+            self._thread.start()
+
+    def close(self):
+        """Stops following the changes and the background thread, flushing every pending event."""
+        subscription_changed.disconnect(self._subscription_changed)
+        websites_added.disconnect(self._websites_added)
+        websites_removed.disconnect(self._websites_removed)
+        website_url_changed.disconnect(self._website_url_changed)
+
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        self.flush()
+
+    def flush(self):
+        """Delivers every pending event, in batches."""
+        while self._flush_batch():
+            pass
+
+    def publish(self, event, key=None):
+        """
+        Queues an event, coalescing it with the pending one of the same key, if any.
+
+        :param event: ChangeEvent object
+        :param key=None: Coalescing key of the event. Defaults to not coalescing it.
+        """
+        with self._condition:
+            if key is None:
+                key = next(self._keys)
+            else:
+                event = self._coalesce(self._pending.get(key), event)
+                if event is None:
+                    # The changes undid each other
+                    self._pending.pop(key, None)
+                    return
+
+            self._pending[key] = event
+            # A coalesced event goes after the events queued since the first change it merges
+            self._pending.move_to_end(key)
+
+            if len(self._pending) >= self.batch_size:
+                self._condition.notify_all()
+
+            while self._thread is not None and len(self._pending) >= self.max_pending and not self._closed:
+                self._condition.wait()
+
+        if self._thread is None and len(self._pending) >= self.batch_size:
+            self._flush_batch()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._closed or len(self._pending) >= self.batch_size, timeout=self.flush_interval
+                )
+                if self._closed:
+                    return
+
+            self.flush()
+
+    def _flush_batch(self):
+        """Delivers a batch of the pending events, returning whether there was any."""
+        with self._flush_lock:
+            with self._condition:
+                batch = [self._pending.popitem(last=False)[1] for _ in range(min(self.batch_size, len(self._pending)))]
+                # Changes blocked by the back-pressure can go on
+                self._condition.notify_all()
+
+            if not batch:
+                return False
+
+            for subscriber in self.subscribers:
+                try:
+                    subscriber(batch)
+                except Exception:
+                    logger.exception('Subscriber %r failed handling a batch of %d events', subscriber, len(batch))
+
+            return True
+
+    @staticmethod
+    def _coalesce(pending_event, event):
+        """Merges an event into the pending one with the same key, returning None if nothing changed after all."""
+        if pending_event is None:
+            return event
+
+        data = dict(event.data)
+        if event.kind == 'subscription_changed':
+            data['old_subscription'] = pending_event.data['old_subscription']
+            data['old_subscription_date'] = pending_event.data['old_subscription_date']
+            unchanged = (
+                data['old_subscription'] is data['subscription']
+                and data['old_subscription_date'] == data['subscription_date']
+            )
+        else:
+            data['old_url'] = pending_event.data['old_url']
+            unchanged = data['old_url'] == data['url']
+
+        return None if unchanged else ChangeEvent(event.kind, event.customer, data)
+
+    def _subscription_changed(self, sender, instance, old_subscription, old_subscription_date, **kwargs):
+        self.publish(ChangeEvent('subscription_changed', instance, {
+            'old_subscription': old_subscription,
+            'old_subscription_date': old_subscription_date,
+            'subscription': instance.subscription,
+            'subscription_date': instance.subscription_date,
+        }), key=('subscription', id(instance)))
+
+    def _websites_added(self, sender, instance, websites, **kwargs):
+        self.publish(ChangeEvent('websites_added', instance, {'urls': [website.url for website in websites]}))
+
+    def _websites_removed(self, sender, instance, websites, **kwargs):
+        self.publish(ChangeEvent('websites_removed', instance, {'urls': [website.url for website in websites]}))
+
+    def _website_url_changed(self, sender, instance, website, old_url, **kwargs):
+        self.publish(ChangeEvent('website_url_changed', instance, {
+            'website': website,
+            'old_url': old_url,
+            'url': website.url,
+        }), key=('url', id(instance), id(website)))
@@ -2,5 +2,17 @@ class CustomerAddWebsitePermissionDenied(Exception):
     pass
 
 
+class CustomerChangePlanPermissionDenied(Exception):
+    pass
+
+
 class ObjectDoesNotExist(Exception):
     pass
+
+
+class WebsiteAlreadyRegistered(Exception):
+    pass
+
+
+class InvalidWebsiteURL(ValueError):
+    pass
@@ -0,0 +1,216 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from . import settings
+
+ALGORITHM = 'pbkdf2_sha256'
+DEFAULT_ITERATIONS = 600000
+
+
+def encode_password(password, salt, iterations):
+    """Hashes a password, returning it encoded as 'pbkdf2_sha256$<iterations>$<salt>$<hash>'."""
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), iterations)
+    return '{}${}${}${}'.format(ALGORITHM, iterations, salt, base64.b64encode(digest).decode('ascii'))
+
+
+def verify_password(password, encoded, plain_text=False):
+    """
+    Checks a password against an encoded one, in constant time. Passwords not yet hashed (e.g. loaded from
+    older snapshots or exports) are only compared as they are with plain_text, while they're being migrated.
+    """
+    if not is_password_hashed(encoded):
+        return plain_text and hmac.compare_digest(password.encode(), (encoded or '').encode())
+
+    iterations = get_iterations(encoded)
+    if iterations is None:
+        return False
+
+    salt = encoded.split('$', 3)[2]
+    return hmac.compare_digest(encode_password(password, salt, iterations).encode(), encoded.encode())
+
+
+def is_password_hashed(encoded):
+    return bool(encoded) and encoded.startswith(ALGORITHM + '$') and encoded.count('$') == 3
+
+
+def get_iterations(encoded):
+    """Returns the iterations of a hashed password, or None when they aren't a positive number (e.g. corrupted)."""
+    try:
+        iterations = int(encoded.split('$', 2)[1])
+    except ValueError:
+        return None
+
+    return iterations if iterations > 0 else None
+
+
+def make_salt():
+    return base64.b64encode(os.urandom(12)).decode('ascii')
+
+
+class PasswordHasher:
+    """
+    Hashes and verifies customers passwords with PBKDF2-SHA256, on an executor so that the key derivation doesn't
+    run on the caller thread (or event loop), with a short-lived LRU cache of the successful verifications.
+
+    Every operation has a sync entry point, waiting for the executor, and an async one (prefixed with `a`).
+    Encoding and verification are module functions, so any executor can be used, a ProcessPoolExecutor included.
+    """
+
+    def __init__(self, iterations=None, executor=None, cache_size=1024, cache_ttl=60, plain_text_until=None):
+        """
+        :param iterations=None: PBKDF2 iterations (the hashing cost). Defaults to settings.PASSWORD_HASH_ITERATIONS,
+            or DEFAULT_ITERATIONS.
+        :param executor=None: concurrent.futures.Executor hashing the passwords. Defaults to hashing them on the
+            caller thread for sync calls, and on the event loop default executor for async ones.
+        :param cache_size=1024: Maximum number of successful verifications cached, where 0 disables the cache
+        :param cache_ttl=60: Seconds a successful verification is cached for
+        :param plain_text_until=None: Last day (a date) passwords still in plain text are verified (and then hashed,
+            by check_password), while migrating them. Defaults to settings.PLAIN_TEXT_PASSWORDS_UNTIL, or never.
+        """
+        self.iterations = iterations or getattr(settings, 'PASSWORD_HASH_ITERATIONS', DEFAULT_ITERATIONS)
+        self.executor = executor
+        self.plain_text_until = plain_text_until
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+
+        # Keyed digest of (encoded password, password) -> expiry time, so no password is kept in memory
+        self._cache = OrderedDict()
+        self._cache_secret = os.urandom(32)
+        self._cache_lock = threading.Lock()
+
+    def hash(self, password):
+        """Returns the encoded hash of a password."""
+        return self._call(encode_password, password, make_salt(), self.iterations)
+
+    async def ahash(self, password):
+        return await self._acall(encode_password, password, make_salt(), self.iterations)
+
+    def verify(self, password, encoded):
+        """Returns whether a password matches an encoded one."""
+        key = self._cache_key(password, encoded)
+        if self._cached(key):
+            return True
+
+        return self._cache_result(key, self._call(verify_password, password, encoded, self._accepts_plain_text()))
+
+    async def averify(self, password, encoded):
+        key = self._cache_key(password, encoded)
+        if self._cached(key):
+            return True
+
+        return self._cache_result(
+            key, await self._acall(verify_password, password, encoded, self._accepts_plain_text())
+        )
+
+    def needs_rehash(self, encoded):
+        """Returns whether an encoded password isn't hashed, or was hashed with another cost."""
+        return not is_password_hashed(encoded) or get_iterations(encoded) != self.iterations
+
+    def set_password(self, customer, password):
+        customer.password = self.hash(password)
+
+    async def aset_password(self, customer, password):
+        customer.password = await self.ahash(password)
+
+    def check_password(self, customer, password):
+        """
+        Returns whether a password matches the customer one, which is rehashed (with the password given)
+        when it needs so, e.g. after the hashing cost changed.
+        """
+        encoded = customer.password
+        verified = self.verify(password, encoded)
+        if verified and self.needs_rehash(encoded):
+            self.set_password(customer, password)
+
+        return verified
+
+    async def acheck_password(self, customer, password):
+        encoded = customer.password
+        verified = await self.averify(password, encoded)
+        if verified and self.needs_rehash(encoded):
+            await self.aset_password(customer, password)
+
+        return verified
+
+    def bulk_hash(self, passwords):
+        """Returns the encoded hashes of many passwords, all hashed at once on the executor."""
+        args = [(password, make_salt(), self.iterations) for password in passwords]
+
+        if self.executor is None or not args:
+            return [encode_password(*arguments) for arguments in args]
+        return list(self.executor.map(encode_password, *zip(*args)))
+
+    def bulk_rehash(self, customers):
+        """
+        Hashes the passwords of the customers still having them in plain text (e.g. loaded from older snapshots),
+        all at once on the executor, returning the number of passwords hashed. Passwords hashed with another cost
+        can only be rehashed once verified, by check_password.
+        """
+        customers = [customer for customer in customers if not is_password_hashed(customer.password)]
+
+        for customer, encoded in zip(customers, self.bulk_hash(customer.password for customer in customers)):
+            customer.password = encoded
+
+        return len(customers)
+
+    def clear_cache(self):
+        with self._cache_lock:
+            self._cache.clear()
+
+    def _accepts_plain_text(self):
+        # Checked on the caller side, as executors on other processes don't share the settings
+        plain_text_until = self.plain_text_until or getattr(settings, 'PLAIN_TEXT_PASSWORDS_UNTIL', None)
+        return plain_text_until is not None and date.today() <= plain_text_until
+
+    def _call(self, func, *args):
+        if self.executor is None:
+            return func(*args)
+        return self.executor.submit(func, *args).result()
+
+    async def _acall(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    def _cache_key(self, password, encoded):
+        # Passwords in plain text aren't cached, so they're no longer verified once plain_text_until is over
+        if not self.cache_size or not is_password_hashed(encoded):
+            return None
+
+        message = '{}\0{}'.format(encoded, password).encode()
+        return hmac.new(self._cache_secret, message, hashlib.sha256).digest()
+
+    def _cached(self, key):
+        if key is None:
+            return False
+
+        with self._cache_lock:
+            expiry = self._cache.get(key)
+            if expiry is None:
+                return False
+            if expiry < time.monotonic():
+                del self._cache[key]
+                return False
+
+            self._cache.move_to_end(key)
+            return True
+
+    def _cache_result(self, key, verified):
+        if verified and key is not None:
+            with self._cache_lock:
+                self._cache[key] = time.monotonic() + self.cache_ttl
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        return verified
+
+
+# The default hasher derives the keys on a pool shared by the whole process, whose threads are started on demand
+password_hasher = PasswordHasher(executor=ThreadPoolExecutor(thread_name_prefix='subscription-hasher'))
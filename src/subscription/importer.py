@@ -0,0 +1,248 @@
+import csv
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from .catalog import PlanCatalog
+from .exceptions import (
+    CustomerAddWebsitePermissionDenied, InvalidWebsiteURL, ObjectDoesNotExist, WebsiteAlreadyRegistered,
+)
+from .hashers import is_password_hashed, password_hasher
+from .models import Customer, Plan, Website
+from .registry import CustomerRegistry
+from .urls import normalize_url
+
+FIELDS = ('email', 'name', 'password', 'plan_name', 'plan_price', 'plan_type', 'total_websites_allowed', 'url')
+REQUIRED_FIELDS = ('email', 'name', 'password', 'plan_name', 'plan_price', 'plan_type')
+
+
+def parse_row(row):
+    """
+    Parses and validates an exported row, returning its (customer, plan, url) values.
+    Raises ValueError when the row isn't valid, e.g. with an unknown plan type, too many websites allowed or an url
+    which can't be parsed.
+    """
+    # JSON lines exports keep the values types, e.g. a plan_price of 0 for free plans, which isn't missing
+    missing = [field for field in REQUIRED_FIELDS if row.get(field) in (None, '')]
+    if missing:
+        raise ValueError('Missing fields: {}'.format(', '.join(missing)))
+
+    total_websites_allowed = row.get('total_websites_allowed')
+    try:
+        total_websites_allowed = int(total_websites_allowed) if total_websites_allowed not in (None, '') else 1
+    except ValueError:
+        raise ValueError('Invalid total_websites_allowed: {}'.format(total_websites_allowed))
+
+    # Plan validates the plan type (among Plan.PLAN_TYPE_RULES) and its total websites allowed
+    plan = Plan(row['plan_name'], row['plan_price'], row['plan_type'], total_websites_allowed)
+
+    url = row.get('url') or None
+    if url:
+        # Urls which can't be parsed (e.g. with a port out of range) are rejected along with their rows
+        normalize_url(url)
+
+    return (
+        (row['email'], row['name'], str(row['password'])),
+        (plan.name, str(plan.price), plan.plan_type, plan.total_websites_allowed),
+        url,
+    )
+
+
+def parse_rows(rows):
+    """Parses a chunk of (line number, row) pairs, returning (line number, row, parsed values, error) tuples."""
+    parsed_rows = []
+    for line, row in rows:
+        try:
+            parsed_rows.append((line, row, parse_row(row), None))
+        except (ValueError, ArithmeticError, TypeError) as error:
+            parsed_rows.append((line, row, None, str(error) or error.__class__.__name__))
+
+    return parsed_rows
+
+
+def read_rows(path, file_format=None):
+    """Streams the (line number, row) pairs of a CSV (with a header) or JSON lines file."""
+    file_format = file_format or ('jsonl' if path.endswith(('.jsonl', '.json')) else 'csv')
+
+    with open(path, newline='') as rows_file:
+        if file_format == 'csv':
+            reader = csv.DictReader(rows_file)
+            for row in reader:
+                yield reader.line_num, row
+        else:
+            for line, text in enumerate(rows_file, 1):
+                if not text.strip():
+                    continue
+                try:
+                    row = json.loads(text)
+                except ValueError:
+                    row = {'raw': text.rstrip('\n')}
+                yield line, row if isinstance(row, dict) else {'raw': row}
+
+
+class Importer:
+    """
+    Bulk importer of customers, plans and websites from CSV or JSON lines exports, one website per row.
+
+    Rows are streamed in chunks, which are parsed and validated on a process pool (with a bounded number of chunks
+    in flight, so memory doesn't grow with the file size). The passwords of the customers created by a chunk are
+    hashed at once, on the password hasher executor, so no customer is created with a plain text one. Plans quotas
+    are checked before linking anything, and the websites are then added through WebsiteManager.bulk_add. Invalid
+    rows, and rows whose website can't be added (e.g. with an url registered by another customer on an URLIndex),
+    are written to a reject file (as JSON lines with the line number, the row and the error) instead of aborting the
+    import.
+    """
+
+    def __init__(self, registry=None, reject_path=None, processes=None, chunk_size=1000, hasher=None):
+        """
+        :param registry=None: CustomerRegistry object to import the customers into. Defaults to a new one.
+        :param reject_path=None: Path of the file where rejected rows are written. Defaults to not writing them.
+        :param processes=None: Number of parsing processes. Defaults to the CPUs count, and 0 parses in process.
+        :param chunk_size=1000: Number of rows parsed at once by a process
+        :param hasher=None: PasswordHasher hashing the customers passwords. Defaults to the default one (on a thread
+            pool).
+        """
+        self.registry = registry if registry is not None else CustomerRegistry()
+        self.hasher = hasher or password_hasher
+        self.reject_path = reject_path
+        self.processes = os.cpu_count() if processes is None else processes
+        self.chunk_size = chunk_size
+        # Customers subscribing identical plans share them
+        self.plans = PlanCatalog()
+
+        self.imported_rows = 0
+        self.rejected_rows = 0
+
+    def import_file(self, path, file_format=None):
+        """Imports a CSV or JSON lines file, returning the number of imported and rejected rows."""
+        return self.import_rows(read_rows(path, file_format))
+
+    def import_rows(self, rows):
+        """Imports an iterable of (line number, row) pairs, returning the number of imported and rejected rows."""
+        reject_file = open(self.reject_path, 'a') if self.reject_path else None
+        try:
+            for parsed_rows in self._parse(rows):
+                self._import_chunk(parsed_rows, reject_file)
+        finally:
+            if reject_file:
+                reject_file.close()
+
+        return self.imported_rows, self.rejected_rows
+
+    def _parse(self, rows):
+        rows = iter(rows)
+        chunks = iter(lambda: list(islice(rows, self.chunk_size)), [])
+
+        if not self.processes:
+            for chunk in chunks:
+                yield parse_rows(chunk)
+            return
+
+        with ProcessPoolExecutor(max_workers=self.processes) as executor:
+            # Chunks are submitted as earlier ones are consumed, and yielded in the file order
+            pending = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(parse_rows, chunk))
+                if len(pending) >= self.processes * 2:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+
+    def _import_chunk(self, parsed_rows, reject_file):
+        rejects = []
+        websites_by_customer = {}
+        passwords = self._hash_passwords(parsed_rows)
+
+        for line, row, values, error in parsed_rows:
+            if error is None:
+                customer_values, plan_key, url = values
+                customer, error = self._get_customer(customer_values, plan_key, passwords)
+
+            if error is not None:
+                rejects.append((line, row, error))
+            elif url:
+                websites_by_customer.setdefault(customer, []).append((line, row, url))
+            else:
+                self.imported_rows += 1
+
+        for customer, websites in websites_by_customer.items():
+            # The quota is checked before linking anything, so rows over it are rejected and the rest is added at once
+            limit = customer.subscription.websites_limit
+            allowed = len(websites) if limit is None else max(0, limit - customer.websites.count())
+
+            for line, row, _ in websites[allowed:]:
+                rejects.append((line, row, 'Customer can\'t have more websites. Total allowed: {}'.format(limit)))
+
+            rejects.extend(self._add_websites(customer, websites[:allowed]))
+
+        self.rejected_rows += len(rejects)
+        if reject_file:
+            for line, row, error in sorted(rejects, key=lambda reject: reject[0]):
+                reject_file.write(json.dumps({'line': line, 'row': row, 'error': error}) + '\n')
+
+    def _add_websites(self, customer, websites):
+        """
+        Adds the (line number, row, url) websites of a customer at once, or one by one when that fails (e.g. when
+        an url is already registered by another customer), returning the rows rejected.
+        """
+        try:
+            customer.websites.bulk_add(Website(url) for _, _, url in websites)
+        except (CustomerAddWebsitePermissionDenied, InvalidWebsiteURL, WebsiteAlreadyRegistered):
+            pass
+        else:
+            self.imported_rows += len(websites)
+            return []
+
+        rejects = []
+        for line, row, url in websites:
+            try:
+                customer.websites.add(Website(url))
+            except (CustomerAddWebsitePermissionDenied, InvalidWebsiteURL, WebsiteAlreadyRegistered) as error:
+                rejects.append((line, row, str(error)))
+            else:
+                self.imported_rows += 1
+
+        return rejects
+
+    def _hash_passwords(self, parsed_rows):
+        """Returns the hashed passwords of the customers a chunk creates, by email, all hashed at once."""
+        passwords = {}
+        for _, _, values, error in parsed_rows:
+            if error is not None:
+                continue
+
+            email, _, password = values[0]
+            if email in passwords or is_password_hashed(password):
+                continue
+            try:
+                self.registry.get(email)
+            except ObjectDoesNotExist:
+                passwords[email] = password
+
+        return dict(zip(passwords, self.hasher.bulk_hash(passwords.values())))
+
+    def _get_customer(self, customer_values, plan_key, passwords):
+        """
+        Returns the customer of a row, creating it (with its password hashed, as found on passwords) if needed, and
+        an error if the row doesn't match it.
+        """
+        email, name, password = customer_values
+
+        plan = self.plans.get(*plan_key)
+
+        try:
+            customer = self.registry.get(email)
+        except ObjectDoesNotExist:
+            customer = Customer(name, passwords.get(email, password), email, plan)
+            self.registry.add(customer)
+            return customer, None
+
+        if not customer.subscription:
+            customer.subscribe_plan(plan)
+        elif self.plans.key(customer.subscription) != self.plans.key(plan):
+            return None, 'Customer {} is already subscribed to another plan'.format(email)
+
+        return customer, None
@@ -0,0 +1,181 @@
+import cProfile
+import pstats
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from time import perf_counter
+
+# Metrics recorded by the models and managers hot paths, when instrumentation is enabled
+METRICS = {
+    'subscription_can_add_website_total': ('counter', 'Customer.can_add_website calls'),
+    'subscription_plan_changes_total': ('counter', 'Customer.change_plan calls changing the plan'),
+    'subscription_websites_added_total': ('counter', 'Websites added through WebsiteManager.add/bulk_add'),
+    'subscription_websites_add_denied_total': ('counter', 'CustomerAddWebsitePermissionDenied raised on additions'),
+    'subscription_websites_add_seconds': ('histogram', 'WebsiteManager.add/bulk_add batches latency'),
+    'subscription_websites_remove_seconds': ('histogram', 'WebsiteManager.remove latency'),
+}
+
+# Upper bounds (in seconds) of the latency histograms buckets, besides the +Inf one
+DEFAULT_BUCKETS = (1e-6, 5e-6, 1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, 0.1, 0.5, 1.0, 5.0)
+
+
+class Histogram:
+    """Counts of the observed values per bucket, along with their total count and sum."""
+
+    __slots__ = ('buckets', 'counts', 'count', 'sum')
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets=DEFAULT_BUCKETS: Sorted upper bounds of the buckets, besides the +Inf one
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        # Buckets upper bounds are inclusive, and values over all of them go to the last (+Inf) one
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class BaseSink:
+    """Receiver of the recorded metrics, e.g. to collect them in memory or to forward them to a monitoring system."""
+
+    def increment(self, name, value=1):
+        raise NotImplementedError
+
+    def observe(self, name, value):
+        raise NotImplementedError
+
+
+class MemorySink(BaseSink):
+    """Collects the counters and histograms in memory."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        :param buckets=DEFAULT_BUCKETS: Upper bounds of the histograms buckets
+        """
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+
+class PrometheusSink(MemorySink):
+    """Collects the metrics in memory, rendering them on the Prometheus text exposition format."""
+
+    def render(self):
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+
+        lines = []
+        for name, value in counters:
+            lines.extend(self._header(name, 'counter'))
+            lines.append('{} {}'.format(name, value))
+
+        for name, histogram in histograms:
+            lines.extend(self._header(name, 'histogram'))
+            cumulative_count = 0
+            for bucket, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                cumulative_count += count
+                bucket = '+Inf' if bucket == float('inf') else repr(float(bucket))
+                lines.append('{}_bucket{{le="{}"}} {}'.format(name, bucket, cumulative_count))
+            lines.append('{}_sum {!r}'.format(name, histogram.sum))
+            lines.append('{}_count {}'.format(name, histogram.count))
+
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    @staticmethod
+    def _header(name, metric_type):
+        if name in METRICS:
+            yield '# HELP {} {}'.format(name, METRICS[name][1])
+        yield '# TYPE {} {}'.format(name, metric_type)
+
+
+class Metrics:
+    """
+    Dispatches the recorded metrics to the registered sinks. Instrumentation is disabled while there are no sinks.
+
+    Hot paths check `metrics.sinks` before recording anything, so disabled instrumentation costs a single
+    attribute lookup.
+    """
+
+    def __init__(self):
+        self.sinks = []
+
+    def add_sink(self, sink):
+        # The sinks list is replaced rather than changed, so that it can be iterated while sinks come and go
+        self.sinks = self.sinks + [sink]
+
+    def remove_sink(self, sink):
+        self.sinks = [registered_sink for registered_sink in self.sinks if registered_sink is not sink]
+
+    def increment(self, name, value=1):
+        for sink in self.sinks:
+            sink.increment(name, value)
+
+    def observe(self, name, value):
+        for sink in self.sinks:
+            sink.observe(name, value)
+
+    @contextmanager
+    def timer(self, name):
+        """Observes the time (in seconds) spent within the context on the `name` histogram."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - start)
+
+
+metrics = Metrics()
+
+
+class Profile(MemorySink):
+    """MemorySink collected by profile(), along with the cProfile statistics of the profiled code."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        super().__init__(buckets)
+        self.stats = None
+
+
+@contextmanager
+def profile(cprofile=False):
+    """
+    Profiles the operations run within the context (e.g. a single one), yielding a Profile object with their metrics.
+    Metrics recorded meanwhile by other threads are collected too.
+
+    :param cprofile=False: Also runs cProfile, keeping its pstats.Stats on the Profile object `stats`
+    """
+    sink = Profile()
+    profiler = cProfile.Profile() if cprofile else None
+
+    metrics.add_sink(sink)
+    try:
+        if profiler:
+            profiler.enable()
+        yield sink
+    finally:
+        if profiler:
+            profiler.disable()
+            sink.stats = pstats.Stats(profiler)
+        metrics.remove_sink(sink)
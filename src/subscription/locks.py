@@ -0,0 +1,43 @@
+import threading
+
+
+class LockStripes:
+    """
+    A fixed pool of re-entrant locks, where each customer is hashed into one of them.
+    Customers share locks instead of each one having its own, which would cost memory for millions of customers.
+    """
+
+    def __init__(self, size=64):
+        """
+        :param size=64: Number of locks on the pool
+        """
+        self.locks = [threading.RLock() for _ in range(size)]
+
+    def hold(self, *customers):
+        """
+        Returns a context manager holding the locks of all the given customers,
+        always acquired in the same order to avoid deadlocks.
+        """
+        # Objects addresses are aligned, so the lowest bits are dropped before hashing them into a lock
+        if len(customers) == 1:
+            # The lock itself is the cheapest context manager for the usual single customer case
+            return self.locks[(id(customers[0]) >> 4) % len(self.locks)]
+
+        positions = sorted({(id(customer) >> 4) % len(self.locks) for customer in customers})
+        return _Locks([self.locks[position] for position in positions])
+
+
+class _Locks:
+    def __init__(self, locks):
+        self.locks = locks
+
+    def __enter__(self):
+        for lock in self.locks:
+            lock.acquire()
+
+    def __exit__(self, *exc_info):
+        for lock in reversed(self.locks):
+            lock.release()
+
+
+customer_locks = LockStripes()
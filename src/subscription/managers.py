@@ -1,42 +1,266 @@
-from .exceptions import CustomerAddWebsitePermissionDenied, ObjectDoesNotExist
+from collections import deque
+from itertools import islice
+
+from .exceptions import CustomerAddWebsitePermissionDenied, CustomerChangePlanPermissionDenied, ObjectDoesNotExist
+from .instrumentation import metrics
+from .locks import customer_locks
+from .query import WebsiteQuerySet, WebsitesSnapshot
+from .signals import (
+    website_pre_url_change, website_url_change_failed, website_url_changed, websites_add_failed, websites_added,
+    websites_pre_add, websites_removed, websites_suspended,
+)
+from .storage import MemoryStorage
 
 
 class WebsiteManager:
     """Class responsible of handling Customer "crud" operations regarding Website object."""
 
-    def __init__(self, customer):
+    # What enforce_quota() does with the websites over a quota
+    QUOTA_POLICIES = ('reject', 'trim_oldest', 'trim_newest', 'suspend')
+
+    # Storage keys of the websites suspended by enforce_quota(), only set on the managers having any
+    _suspended = None
+
+    def __init__(self, customer, storage=None):
+        """
+        :param customer: Customer owning the websites
+        :param storage=None: Storage of the websites (a BaseStorage object). Defaults to MemoryStorage object.
+        """
         self.customer = customer
-        # TODO: use an iterator (yield) instead of the a list?
-        self.queryset = []
+        self.storage = storage if storage is not None else MemoryStorage()
+        self.storage.bind(customer)
+
+    def __contains__(self, obj):
+        return obj in self.storage
 
     def get(self, obj):
-        try:
-            position = self.queryset.index(obj)
-        except ValueError:
+        website = self.storage.get(obj)
+        if website is None:
             raise ObjectDoesNotExist('Website doesn\'t exist on the Customer websites list')
 
-        return self.queryset[position]
+        return website
+
+    def get_by_url(self, url):
+        """Returns the first website added with the given url."""
+        website = self.storage.get_by_url(url)
+        if website is None:
+            raise ObjectDoesNotExist('Website with url {} doesn\'t exist on the Customer websites list'.format(url))
+
+        return website
 
     def add(self, *args):
-        for arg in args:
-            if not arg.customer:
-                arg.customer = self.customer
-            else:
-                self.queryset.append(arg)
+        self.bulk_add(args)
+
+    def bulk_add(self, websites):
+        """
+        Adds all the websites at once, checking the customer plan quota only once for the whole batch.
+        Either every website is added or, if the quota doesn't allow it, none is.
+
+        The quota check and the websites storage happen as one operation under the customer lock,
+        so concurrent additions can't both pass the check and go over the quota.
+        """
+        # Websites have no equality defined, so this drops repeated objects while keeping their order
+        websites = list(dict.fromkeys(websites))
+
+        if metrics.sinks:
+            with metrics.timer('subscription_websites_add_seconds'):
+                return self._locked_bulk_add(websites)
+
+        return self._locked_bulk_add(websites)
+
+    def _locked_bulk_add(self, websites):
+        while True:
+            # Websites being moved from their previous customers need those customers locks too
+            previous_customers = {website._customer for website in websites} - {None}
+
+            with customer_locks.hold(self.customer, *previous_customers):
+                if previous_customers == {website._customer for website in websites} - {None}:
+                    return self._bulk_add(websites)
+
+    def _bulk_add(self, websites):
+        # Storages such as SQLiteStorage identify websites by url, where only the customer ones are already stored,
+        # while other websites with their urls can't be stored
+        websites = [
+            website for website in websites if website._customer is not self.customer or website not in self.storage
+        ]
+        if not websites:
+            return
+
+        if not self.customer.can_add_website(len(websites)):
+            if metrics.sinks:
+                metrics.increment('subscription_websites_add_denied_total')
+            raise CustomerAddWebsitePermissionDenied(
+                'Customer can\'t have more websites. Total allowed: {}'.format(
+                    self.customer.get_total_websites_allowed()
+                )
+            )
+
+        # Nothing is changed (websites aren't moved out of their previous customers) if they can't be stored
+        self.storage.check_insert(websites)
+
+        try:
+            if websites_pre_add.receivers:
+                websites_pre_add.send(sender=WebsiteManager, instance=self.customer, websites=websites)
+
+            for website in websites:
+                # A website can only belong to one customer, so it's moved out of the previous one
+                if website.customer:
+                    website.customer.websites.remove(website)
+
+            self.storage.insert(websites)
+        except BaseException:
+            if websites_add_failed.receivers:
+                websites_add_failed.send(sender=WebsiteManager, instance=self.customer, websites=websites)
+            raise
+
+        for website in websites:
+            website._customer = self.customer
+
+        if metrics.sinks:
+            metrics.increment('subscription_websites_added_total', len(websites))
+
+        if websites_added.receivers:
+            websites_added.send(sender=WebsiteManager, instance=self.customer, websites=websites)
 
     def update(self, obj, **kwargs):
         for attr_name, value in kwargs.items():
             setattr(obj, attr_name, value)
 
     def remove(self, obj):
-        try:
-            obj.customer = None
-            self.queryset.remove(obj)
-        except ValueError:
-            raise ObjectDoesNotExist('Website doesn\'t exist on the Customer websites list')
+        if metrics.sinks:
+            with metrics.timer('subscription_websites_remove_seconds'):
+                return self._remove(obj)
+
+        return self._remove(obj)
+
+    def _remove(self, obj):
+        with customer_locks.hold(self.customer):
+            if obj not in self.storage:
+                raise ObjectDoesNotExist('Website doesn\'t exist on the Customer websites list')
+
+            if self._suspended:
+                self._suspended.discard(self.storage.key(obj))
+            self.storage.discard(obj)
+            obj._customer = None
+
+            # Sent under the lock, as websites_added is, so receivers (e.g. a Journal) get the changes of a customer
+            # in the order they happened
+            if websites_removed.receivers:
+                websites_removed.send(sender=WebsiteManager, instance=self.customer, websites=[obj])
+
+    def enforce_quota(self, limit, policy='reject'):
+        """
+        Brings the websites within a quota, e.g. before changing to a smaller plan, returning the websites removed
+        or suspended for being over it. The overage comes from the websites count, and the websites over the quota
+        are all found in a single pass and removed at once.
+
+        :param limit: Maximum number of websites (e.g. a plan websites_limit), or None when unlimited
+        :param policy='reject': What to do with the websites over the quota: 'reject' raises
+            CustomerChangePlanPermissionDenied, 'trim_oldest' and 'trim_newest' remove the oldest or the newest ones,
+            and 'suspend' suspends the newest ones. Websites previously suspended and now within the quota are resumed.
+        """
+        if policy not in self.QUOTA_POLICIES:
+            raise ValueError('The quota policy has to be one of these values: {}. Policy inserted: {}'.format(
+                ', '.join(self.QUOTA_POLICIES), policy
+            ))
+
+        with customer_locks.hold(self.customer):
+            overage = 0 if limit is None else len(self.storage) - limit
+            if overage > 0 and policy == 'reject':
+                raise CustomerChangePlanPermissionDenied(
+                    'Customer has {} websites over the quota of {}'.format(overage, limit)
+                )
+
+            resumed, self._suspended = self._suspended, None
+            websites = []
+            if overage > 0:
+                pairs = self.storage.iterate()
+                if policy == 'trim_oldest':
+                    pairs = list(islice(pairs, overage))
+                else:
+                    pairs = list(deque(pairs, maxlen=overage))
+
+                # Websites are told apart by their keys, since several of them may share an url
+                keys = [key for key, _ in pairs]
+                websites = [website for _, website in pairs]
+
+                if policy == 'suspend':
+                    self._suspended = set(keys)
+                else:
+                    self.storage.bulk_discard(websites, keys)
+                    for website in websites:
+                        website._customer = None
+
+            if websites_suspended.receivers and (resumed or self._suspended):
+                websites_suspended.send(sender=WebsiteManager, instance=self.customer, websites=list(self.suspended()))
+
+            if websites and policy != 'suspend' and websites_removed.receivers:
+                websites_removed.send(sender=WebsiteManager, instance=self.customer, websites=websites)
+
+        return websites
+
+    def is_suspended(self, obj):
+        return bool(self._suspended) and self.storage.key(obj) in self._suspended
+
+    def suspended(self):
+        """Returns the websites suspended for being over the plan quota."""
+        return WebsiteQuerySet(self, keys=self._suspended or frozenset())
 
     def all(self):
-        return self.queryset
+        return WebsiteQuerySet(self)
+
+    def _suspended_positions(self):
+        """Returns the positions, by insertion order, of the suspended websites (as persisted by snapshots)."""
+        if not self._suspended:
+            return []
+
+        return [position for position, (key, _) in enumerate(self.storage.iterate()) if key in self._suspended]
+
+    def _suspend_positions(self, positions):
+        """Suspends the websites at the given positions, by insertion order (as loaded from snapshots)."""
+        positions = set(positions)
+        keys = {key for position, (key, _) in enumerate(self.storage.iterate()) if position in positions}
+        self._suspended = keys or None
+
+    def filter(self, *predicates, **lookups):
+        return self.all().filter(*predicates, **lookups)
 
     def count(self):
-        return len(self.queryset)
+        return len(self.storage)
+
+    def snapshot(self):
+        """
+        Returns an immutable view of the websites as they are now (a WebsitesSnapshot object), which can be read while
+        websites keep being added and removed. Memory and array storages take it in O(1), sharing their state with
+        the snapshot until it's changed.
+        """
+        with customer_locks.hold(self.customer):
+            return WebsitesSnapshot(self.customer, self.storage.snapshot())
+
+    def _pre_url_change(self, obj, url):
+        """Lets the receivers of website_pre_url_change prevent a website url from being changed."""
+        if website_pre_url_change.receivers:
+            try:
+                website_pre_url_change.send(sender=WebsiteManager, instance=self.customer, website=obj, url=url)
+            except BaseException:
+                self._url_change_failed(obj, url)
+                raise
+
+    def _reindex_url(self, obj, old_url):
+        """Updates the storage of a website, whose url has been changed."""
+        try:
+            self.storage.reindex_url(obj, old_url)
+        except BaseException:
+            self._url_change_failed(obj, obj.url)
+            raise
+
+        if website_url_changed.receivers:
+            website_url_changed.send(sender=WebsiteManager, instance=self.customer, website=obj, old_url=old_url)
+
+    def _reindex_email(self, old_email):
+        """Updates the storage of the websites, once the customer email has been changed from old_email."""
+        self.storage.reindex_email(old_email)
+
+    def _url_change_failed(self, obj, url):
+        if website_url_change_failed.receivers:
+            website_url_change_failed.send(sender=WebsiteManager, instance=self.customer, website=obj, url=url)
@@ -2,42 +2,105 @@ from datetime import date, timedelta
 from decimal import Decimal
 
 from . import settings
+from .hashers import is_password_hashed, password_hasher
+from .instrumentation import metrics
+from .locks import customer_locks
+from .signals import customer_email_changed, customer_pre_email_change, subscription_changed
 from .utils import get_year_total_days
-from .exceptions import CustomerAddWebsitePermissionDenied
 from .managers import WebsiteManager
+from .storage import BaseStorage
 
 
 class Customer:
     """A Customer class that can have a subscription (Plan object), and manage Website instances."""
 
+    # Slotted classes don't carry a per-instance __dict__, which matters when holding millions of objects
+    __slots__ = ('name', 'password', '_email', '_subscription_date', '_subscription', 'websites')
+
     def __init__(self, name, password, email, subscription=None, websites=None):
         """
         :param name: Customer's name
-        :param password: Customer's password
+        :param password: Customer's password, in plain text (hashed here, through the default PasswordHasher) or
+            already hashed (e.g. by PasswordHasher.bulk_hash, as the importer does for many customers at once)
         :param email: Customer's email
         :param subscription=None: Customer's subscription (a Plan object)
-        :param websites=None: Customer Websites Manager. Defaults to WebsiteManager object.
+        :param websites=None: Customer Websites Manager, or the storage of its websites (a BaseStorage object, e.g.
+            SQLiteStorage). Defaults to WebsiteManager object, keeping the websites in memory.
         """
         self.name = name
-        self.password = password
-        self.email = email
-
-        self.subscription_date = None
-        self.subscription = subscription
+        # Passwords are never kept in plain text, while hashed ones (e.g. loaded from a snapshot) are kept as they are
+        self.password = password_hasher.hash(password) if password and not is_password_hashed(password) else password
+        self._email = email
 
+        if isinstance(websites, BaseStorage):
+            websites = WebsiteManager(self, websites)
         self.websites = websites or WebsiteManager(self)
 
+        self._subscription_date = None
+        self._subscription = None
+        self.subscription = subscription
+
     def __str__(self):
         return 'Customer: {}'.format(self.name)
 
+    @property
+    def email(self):
+        return self._email
+
+    @email.setter
+    def email(self, email):
+        """Setting the email, while keeping the websites storage and the registries the customer is on up to date"""
+        old_email = self._email
+        if old_email == email:
+            return
+
+        # Receivers can reject the change, e.g. a registry with another customer with that email
+        if customer_pre_email_change.receivers:
+            customer_pre_email_change.send(sender=Customer, instance=self, email=email)
+
+        self._email = email
+        try:
+            # Storages such as SQLiteStorage keep the websites of a customer by its email
+            self.websites._reindex_email(old_email)
+        except BaseException:
+            self._email = old_email
+            raise
+
+        if customer_email_changed.receivers:
+            customer_email_changed.send(sender=Customer, instance=self, old_email=old_email)
+
     @property
     def subscription(self):
         return self._subscription
 
     @subscription.setter
     def subscription(self, subscription):
-        self.subscription_date = None if not subscription else date.today()
+        old_subscription, old_subscription_date = self._subscription, self._subscription_date
+        self._subscription_date = None if not subscription else date.today()
         self._subscription = subscription
+        self._subscription_changed(old_subscription, old_subscription_date)
+
+    @property
+    def subscription_date(self):
+        return self._subscription_date
+
+    @subscription_date.setter
+    def subscription_date(self, subscription_date):
+        old_subscription_date = self._subscription_date
+        self._subscription_date = subscription_date
+        self._subscription_changed(self._subscription, old_subscription_date)
+
+    def _subscription_changed(self, old_subscription, old_subscription_date):
+        unchanged = old_subscription is self._subscription and old_subscription_date == self._subscription_date
+
+        # Checking for receivers first keeps the setters cheap when nothing is listening
+        if subscription_changed.receivers and not unchanged:
+            subscription_changed.send(
+                sender=Customer,
+                instance=self,
+                old_subscription=old_subscription,
+                old_subscription_date=old_subscription_date,
+            )
 
     @property
     def sub_renewal_date(self):
@@ -52,13 +115,24 @@ class Customer:
 
         return renewal_date
 
-    def can_add_website(self):
-        """This method checks if user is allowed to add another website to his list or not."""
+    def set_password(self, raw_password):
+        """Hashes and sets the customer password, through the default PasswordHasher."""
+        password_hasher.set_password(self, raw_password)
+
+    def check_password(self, raw_password):
+        """Checks a password against the customer one, through the default PasswordHasher."""
+        return password_hasher.check_password(self, raw_password)
+
+    def can_add_website(self, total=1):
+        """This method checks if user is allowed to add another website (or a total of them) to his list or not."""
         if not self.subscription:
             raise ValueError('Customer Subscription doesn\'t exist')
 
-        allows_infinite = self.subscription.plan_type == 'infinite'
-        return allows_infinite or self.websites.count() + 1 <= self.subscription.total_websites_allowed
+        if metrics.sinks:
+            metrics.increment('subscription_can_add_website_total')
+
+        limit = self.subscription.websites_limit
+        return limit is None or self.websites.count() + total <= limit
 
     def get_total_websites_allowed(self):
         """Shortcut method to access directly the subscription 'total_websites_allowed' property."""
@@ -74,23 +148,54 @@ class Customer:
 
         return self.subscription
 
-    def change_plan(self, new_plan):
-        """Method responsible of substituting the customer current subscription with another."""
+    def change_plan(self, new_plan, over_quota='reject'):
+        """
+        Method responsible of substituting the customer current subscription with another.
+
+        :param new_plan: Customer's new subscription (a Plan object)
+        :param over_quota='reject': What to do when the customer has more websites than the new plan allows:
+            'reject' the change (raising CustomerChangePlanPermissionDenied), remove the oldest ('trim_oldest') or
+            the newest ('trim_newest') websites over it, or 'suspend' the newest ones. See WebsiteManager.enforce_quota.
+        """
         if not self.subscription:
             raise ValueError('There\'s no subscription plan to update')
         if self.subscription == new_plan:
             raise ValueError('This plan ({}) is already associated with the customer'.format(new_plan))
 
-        self.subscription = new_plan
+        if over_quota not in WebsiteManager.QUOTA_POLICIES:
+            raise ValueError('The quota policy has to be one of these values: {}. Policy inserted: {}'.format(
+                ', '.join(WebsiteManager.QUOTA_POLICIES), over_quota
+            ))
+
+        # The quota is only enforced when the new plan has one, or when suspended websites may have to be resumed
+        limit = new_plan.websites_limit
+        if limit is None and not self.websites._suspended:
+            self.subscription = new_plan
+        else:
+            # No websites can be added meanwhile, going over the new plan quota
+            with customer_locks.hold(self):
+                if limit is None or self.websites._suspended or self.websites.count() > limit:
+                    self.websites.enforce_quota(limit, over_quota)
+                self.subscription = new_plan
+
+        if metrics.sinks:
+            metrics.increment('subscription_plan_changes_total')
+
         return True
 
 
 class Plan:
     """A Plan object that based on the type defines how many websites a customer can manage."""
 
+    # Maximum websites allowed by each plan type, where None means unlimited
+    PLAN_TYPE_RULES = {'single': 1, 'plus': 3, 'infinite': None}
+
     # Initialized a tuple, an Immutable object, 
     # to make sure that the plan types can't changed besides these three ('single', 'plus', 'infinite')
-    PLAN_TYPE_CHOICES = ('single', 'plus', 'infinite')
+    PLAN_TYPE_CHOICES = tuple(PLAN_TYPE_RULES)
+
+    # _websites_limit is derived from the plan type and total websites allowed, so quota checks don't look at them
+    __slots__ = ('name', 'price', '_plan_type', '_total_websites_allowed', '_websites_limit')
 
     def __init__(self, name, price, plan_type='single', total_websites_allowed=1):
         """
@@ -110,7 +215,7 @@ class Plan:
 
     @plan_type.setter
     def plan_type(self, plan_type):
-        if not plan_type in self.PLAN_TYPE_CHOICES:
+        if not plan_type in self.PLAN_TYPE_RULES:
             raise ValueError(
                 'The plan type has to be one of these values: {}. Plan inserted: {}'.format(
                     ', '.join(self.PLAN_TYPE_CHOICES), plan_type
@@ -118,6 +223,7 @@ class Plan:
             )
 
         self._plan_type = plan_type
+        self._update_websites_limit()
 
     @property
     def total_websites_allowed(self):
@@ -126,12 +232,25 @@ class Plan:
     @total_websites_allowed.setter
     def total_websites_allowed(self, total_websites_allowed):
         """Setting total_websites_allowed while making sure then plan type rules are respected"""
-        if self.plan_type == 'single' and total_websites_allowed > 1:
-            raise ValueError('The plan type \'single\' only allows 1 website max')
-        if self.plan_type == 'plus' and total_websites_allowed > 3:
-            raise ValueError('The plan type \'plus\' only allows 3 websites max')
+        max_websites = self.PLAN_TYPE_RULES[self.plan_type]
+        if max_websites is not None and total_websites_allowed > max_websites:
+            raise ValueError('The plan type \'{}\' only allows {} website{} max'.format(
+                self.plan_type, max_websites, 's' if max_websites > 1 else ''
+            ))
 
         self._total_websites_allowed = total_websites_allowed
+        self._update_websites_limit()
+
+    @property
+    def websites_limit(self):
+        """Maximum number of websites a customer subscribing the plan can have, or None when unlimited."""
+        return self._websites_limit
+
+    def _update_websites_limit(self):
+        max_websites = self.PLAN_TYPE_RULES[self._plan_type]
+        # While being initialized, the plan type is set before the total websites allowed
+        total_websites_allowed = getattr(self, '_total_websites_allowed', max_websites)
+        self._websites_limit = None if max_websites is None else min(total_websites_allowed, max_websites)
 
     def __str__(self):
         return 'Plan: {}'.format(self.plan_type)
@@ -140,32 +259,58 @@ class Plan:
 class Website:
     """A Website class with an url and customer properties"""
 
+    __slots__ = ('_url', '_customer')
+
     def __init__(self, url, customer=None):
         """
         :param url: Website's url
         :param customer=None: Website's Customer
         """
+        self._customer = None
+        self._url = None
         self.url = url
         self.customer = customer
 
+    @property
+    def url(self):
+        return self._url
+
+    @url.setter
+    def url(self, url):
+        """Setting the url, while keeping the customer websites url index up to date"""
+        customer = self.customer
+        if customer and self._url != url:
+            customer.websites._pre_url_change(self, url)
+
+        old_url, self._url = self._url, url
+
+        if customer and old_url != url:
+            try:
+                customer.websites._reindex_url(self, old_url)
+            except BaseException:
+                # The storage still has the website under its previous url
+                self._url = old_url
+                raise
+
     @property
     def customer(self):
-        return self._customer
+        customer = self._customer
+        # Storages creating the Website objects when read can't unlink the other objects of the websites they no
+        # longer have (e.g. trimmed over a quota), which are unlinked once accessed instead
+        if customer is not None and not customer.websites.storage.KEEPS_WEBSITE_OBJECTS:
+            if self not in customer.websites.storage:
+                self._customer = customer = None
+
+        return customer
 
     @customer.setter
     def customer(self, customer):
         """Setting a customer, while validanting if he's allowed to have another Website"""
-        self._customer = customer
-
-        if not customer:
-            return
-
-        if not customer.can_add_website():
-            raise CustomerAddWebsitePermissionDenied(
-                'Customer can\'t have more websites. Total allowed: {}'.format(customer.get_total_websites_allowed())
-            )
-        else:
+        if customer:
+            # The customer websites manager validates the plan quota and links both objects
             customer.websites.add(self)
+        elif self.customer:
+            self._customer.websites.remove(self)
 
     def __str__(self):
         return 'Website: {}'.format(self.url)
@@ -0,0 +1,479 @@
+"""
+Persistence of customers, plans and websites, as a binary snapshot plus an append-only journal of changes.
+
+A snapshot is written with Snapshot.write() and opened with Snapshot(), which maps the file into memory and only
+decodes the customers actually accessed. A Journal records, while open, every subscription and websites change,
+which replay() applies on top of the snapshot to get back to the same state.
+
+Snapshot layout (little-endian): magic, plans count, customers count, plans table, customers offsets table,
+and customers records sorted by email, so that a customer is found by a binary search over the offsets table.
+Records end with the positions of the customer suspended websites, which snapshots of the first layout (SUBSNAP1)
+don't have.
+"""
+import mmap
+import os
+import struct
+import threading
+from datetime import date
+
+from .catalog import PlanCatalog
+from .models import Customer, Website
+from .signals import (
+    customer_email_changed, subscription_changed, website_url_changed, websites_added, websites_removed,
+    websites_suspended,
+)
+
+SNAPSHOT_MAGIC = b'SUBSNAP2'
+SNAPSHOT_MAGICS = (b'SUBSNAP1', SNAPSHOT_MAGIC)
+JOURNAL_MAGIC = b'SUBJRNL1'
+
+HEADER = struct.Struct('<8sII')
+OFFSET = struct.Struct('<Q')
+UINT = struct.Struct('<I')
+INT = struct.Struct('<i')
+
+NO_PLAN = -1
+NO_DATE = 0
+# Total websites allowed of the plans without a limit (None)
+NO_LIMIT = -1
+
+OP_CUSTOMER = b'C'
+OP_SUBSCRIPTION = b'S'
+OP_ADD = b'A'
+OP_REMOVE = b'R'
+OP_URL = b'U'
+OP_SUSPEND = b'P'
+OP_EMAIL = b'E'
+
+
+def _pack_string(value):
+    encoded = value.encode('utf-8')
+    return UINT.pack(len(encoded)) + encoded
+
+
+def _unpack_string(buffer, offset):
+    length, = UINT.unpack_from(buffer, offset)
+    offset += UINT.size
+    return bytes(buffer[offset:offset + length]).decode('utf-8'), offset + length
+
+
+def _pack_int(value):
+    return INT.pack(value)
+
+
+def _unpack_int(buffer, offset):
+    return INT.unpack_from(buffer, offset)[0], offset + INT.size
+
+
+def _plan_key(plan):
+    return plan.name, str(plan.price), plan.plan_type, plan.total_websites_allowed
+
+
+def _pack_plan(plan):
+    name, price, plan_type, total_websites_allowed = _plan_key(plan)
+    total_websites_allowed = NO_LIMIT if total_websites_allowed is None else total_websites_allowed
+    return _pack_string(name) + _pack_string(price) + _pack_string(plan_type) + _pack_int(total_websites_allowed)
+
+
+def _unpack_plan_key(buffer, offset):
+    name, offset = _unpack_string(buffer, offset)
+    price, offset = _unpack_string(buffer, offset)
+    plan_type, offset = _unpack_string(buffer, offset)
+    total_websites_allowed, offset = _unpack_int(buffer, offset)
+    total_websites_allowed = None if total_websites_allowed == NO_LIMIT else total_websites_allowed
+    return (name, price, plan_type, total_websites_allowed), offset
+
+
+def _pack_date(day):
+    return _pack_int(day.toordinal() if day else NO_DATE)
+
+
+def _unpack_date(buffer, offset):
+    ordinal, offset = _unpack_int(buffer, offset)
+    return (date.fromordinal(ordinal) if ordinal != NO_DATE else None), offset
+
+
+def _pack_urls(urls):
+    return UINT.pack(len(urls)) + b''.join(_pack_string(url) for url in urls)
+
+
+def _unpack_urls(buffer, offset):
+    total, = UINT.unpack_from(buffer, offset)
+    offset += UINT.size
+    urls = []
+    for _ in range(total):
+        url, offset = _unpack_string(buffer, offset)
+        urls.append(url)
+    return urls, offset
+
+
+def _pack_positions(positions):
+    return UINT.pack(len(positions)) + b''.join(UINT.pack(position) for position in positions)
+
+
+def _unpack_positions(buffer, offset):
+    total, = UINT.unpack_from(buffer, offset)
+    offset += UINT.size
+    positions = [UINT.unpack_from(buffer, offset + index * UINT.size)[0] for index in range(total)]
+    return positions, offset + total * UINT.size
+
+
+class Snapshot:
+    """A memory mapped snapshot file, working as a mapping of email -> Customer decoded on first access."""
+
+    def __init__(self, path):
+        """
+        :param path: Path of a file written by Snapshot.write()
+        """
+        self.path = path
+        self._file = open(path, 'rb')
+        self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, plans_count, self._count = HEADER.unpack_from(self._buffer, 0)
+        if magic not in SNAPSHOT_MAGICS:
+            raise ValueError('{} is not a subscription snapshot file'.format(path))
+        self._has_suspensions = magic == SNAPSHOT_MAGIC
+
+        # Plans are few, so they're all decoded straight away and shared by the customers subscribing them
+        self.plans = PlanCatalog()
+        self._plans = []
+        offset = HEADER.size
+        for _ in range(plans_count):
+            key, offset = _unpack_plan_key(self._buffer, offset)
+            self._plans.append(self.get_plan(key))
+
+        self._offsets = offset
+        # email -> Customer, for the customers decoded so far (by their emails on the file) and for the ones created
+        # afterwards (e.g. by replay)
+        self._loaded = {}
+        self._created = {}
+        # Emails on the file of the customers renamed afterwards, and new email -> Customer of those customers
+        self._renamed = set()
+        self._renames = {}
+
+    def __len__(self):
+        return self._count + len(self._created)
+
+    def __contains__(self, email):
+        if email in self._created or email in self._renames:
+            return True
+
+        return email not in self._renamed and (email in self._loaded or self._find(email) is not None)
+
+    def __iter__(self):
+        """Yields every customer, decoding the ones not yet accessed."""
+        for position in range(self._count):
+            yield self._customer_at(position)
+
+        yield from list(self._created.values())
+
+    def get(self, email, default=None):
+        customer = self._created.get(email) or self._renames.get(email)
+        if customer is not None:
+            return customer
+        if email in self._renamed:
+            return default
+
+        customer = self._loaded.get(email)
+        if customer is not None:
+            return customer
+
+        position = self._find(email)
+        return default if position is None else self._customer_at(position)
+
+    def add(self, customer):
+        """Adds a customer, created after the snapshot was written."""
+        if customer.email in self:
+            raise ValueError('A customer with the email {} already exists'.format(customer.email))
+
+        self._created[customer.email] = customer
+
+    def rename(self, email, new_email):
+        """Changes the email of a customer (e.g. replaying a journal), which is found by the new one afterwards."""
+        customer = self.get(email)
+        if customer is None:
+            raise ValueError('A customer with the email {} doesn\'t exist'.format(email))
+        if new_email in self:
+            raise ValueError('A customer with the email {} already exists'.format(new_email))
+
+        customer.email = new_email
+        if email in self._created:
+            self._created[new_email] = self._created.pop(email)
+        else:
+            self._renames.pop(email, None)
+            self._renamed.add(email)
+            self._renames[new_email] = customer
+
+    def get_plan(self, key):
+        """Returns the plan for a (name, price, plan type, total websites allowed) key, creating it if needed."""
+        return self.plans.get(*key)
+
+    def close(self):
+        self._buffer.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _offset(self, position):
+        return OFFSET.unpack_from(self._buffer, self._offsets + position * OFFSET.size)[0]
+
+    def _find(self, email):
+        """Returns the position of the customer with the given email on the snapshot, or None."""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            middle_email, _ = _unpack_string(self._buffer, self._offset(middle))
+            if middle_email < email:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self._count and _unpack_string(self._buffer, self._offset(low))[0] == email:
+            return low
+
+        return None
+
+    def _customer_at(self, position):
+        buffer = self._buffer
+        email, offset = _unpack_string(buffer, self._offset(position))
+
+        customer = self._loaded.get(email)
+        if customer is not None:
+            return customer
+
+        name, offset = _unpack_string(buffer, offset)
+        password, offset = _unpack_string(buffer, offset)
+        plan_index, offset = _unpack_int(buffer, offset)
+        subscription_date, offset = _unpack_date(buffer, offset)
+        urls, offset = _unpack_urls(buffer, offset)
+        suspended_positions, offset = _unpack_positions(buffer, offset) if self._has_suspensions else ([], offset)
+
+        # Loading isn't a change, so the state is restored straight on the objects, with no signals sent
+        customer = Customer(name, password, email)
+        customer._subscription = self._plans[plan_index] if plan_index != NO_PLAN else None
+        customer._subscription_date = subscription_date
+
+        websites = [Website(url) for url in urls]
+        customer.websites.storage.insert(websites)
+        for website in websites:
+            website._customer = customer
+        if suspended_positions:
+            customer.websites._suspend_positions(suspended_positions)
+
+        self._loaded[email] = customer
+        return customer
+
+    @staticmethod
+    def write(path, customers):
+        """Writes the given customers, with their plans and websites, to a snapshot file at path."""
+        customers = sorted(customers, key=lambda customer: customer.email)
+
+        plans = {}
+        for customer in customers:
+            if customer.subscription and id(customer.subscription) not in plans:
+                plans[id(customer.subscription)] = (len(plans), customer.subscription)
+
+        records = []
+        for customer in customers:
+            plan_index = plans[id(customer.subscription)][0] if customer.subscription else NO_PLAN
+            records.append(b''.join((
+                _pack_string(customer.email),
+                _pack_string(customer.name),
+                _pack_string(customer.password),
+                _pack_int(plan_index),
+                _pack_date(customer.subscription_date),
+                _pack_urls([website.url for website in customer.websites.all()]),
+                _pack_positions(customer.websites._suspended_positions()),
+            )))
+
+        plans_table = b''.join(_pack_plan(plan) for _, plan in plans.values())
+        offset = HEADER.size + len(plans_table) + OFFSET.size * len(records)
+
+        # The snapshot is written aside and then moved, so a failure never leaves a partial snapshot behind
+        temporary_path = '{}.tmp'.format(path)
+        with open(temporary_path, 'wb') as snapshot_file:
+            snapshot_file.write(HEADER.pack(SNAPSHOT_MAGIC, len(plans), len(records)))
+            snapshot_file.write(plans_table)
+            for record in records:
+                snapshot_file.write(OFFSET.pack(offset))
+                offset += len(record)
+            for record in records:
+                snapshot_file.write(record)
+
+        os.replace(temporary_path, path)
+
+
+class Journal:
+    """
+    Append-only journal of the changes made while it's open: subscriptions (subscribe_plan, change_plan, ...),
+    emails, and websites additions, removals, url changes and suspensions, of every customer.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path of the journal file, created if it doesn't exist
+        """
+        self.path = path
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(JOURNAL_MAGIC)
+
+        # Emails of the customers already recorded by this journal, whose details don't need to be written again
+        self._customers = set()
+        # Changes of different customers are signaled from different threads at the same time, while the records of
+        # a customer have to follow its details
+        self._lock = threading.Lock()
+
+        self._receivers = (
+            (subscription_changed, self._subscription_changed),
+            (websites_added, self._websites_added),
+            (websites_removed, self._websites_removed),
+            (website_url_changed, self._website_url_changed),
+            (websites_suspended, self._websites_suspended),
+            (customer_email_changed, self._email_changed),
+        )
+        for signal, receiver in self._receivers:
+            signal.connect(receiver)
+
+    def close(self):
+        for signal, receiver in self._receivers:
+            signal.disconnect(receiver)
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _record(self, customer, op, payload):
+        with self._lock:
+            if customer.email not in self._customers:
+                self._customers.add(customer.email)
+                self._write(OP_CUSTOMER, customer.email, _pack_string(customer.name) + _pack_string(customer.password))
+
+            self._write(op, customer.email, payload)
+            self._file.flush()
+
+    def _write(self, op, email, payload):
+        # Records are length prefixed, so that a record partially written (e.g. by a crash) is detected on replay
+        record = op + _pack_string(email) + payload
+        self._file.write(UINT.pack(len(record)) + record)
+
+    def _subscription_changed(self, sender, instance, **kwargs):
+        plan = _pack_int(1) + _pack_plan(instance.subscription) if instance.subscription else _pack_int(0)
+        self._record(instance, OP_SUBSCRIPTION, _pack_date(instance.subscription_date) + plan)
+
+    def _websites_added(self, sender, instance, websites, **kwargs):
+        self._record(instance, OP_ADD, _pack_urls([website.url for website in websites]))
+
+    def _websites_removed(self, sender, instance, websites, **kwargs):
+        self._record(instance, OP_REMOVE, _pack_urls([website.url for website in websites]))
+
+    def _website_url_changed(self, sender, instance, website, old_url, **kwargs):
+        self._record(instance, OP_URL, _pack_string(old_url) + _pack_string(website.url))
+
+    def _websites_suspended(self, sender, instance, **kwargs):
+        # Websites are recorded by position, since several of them may share an url
+        self._record(instance, OP_SUSPEND, _pack_positions(instance.websites._suspended_positions()))
+
+    def _email_changed(self, sender, instance, old_email, **kwargs):
+        # Records go by email, so the customer is renamed on replay before the records of its new email
+        with self._lock:
+            self._write(OP_EMAIL, old_email, _pack_string(instance.email))
+            self._file.flush()
+
+            if old_email in self._customers:
+                self._customers.remove(old_email)
+                self._customers.add(instance.email)
+
+
+def replay(path, snapshot):
+    """
+    Applies the changes recorded on a journal file to the customers of a snapshot (customers the snapshot doesn't
+    have are created and added to it). Must not run while a Journal is open, or the changes are recorded again.
+    Websites are restored as they were added, with no quota checks, so that changes recorded out of order (e.g.
+    by different threads) never keep the journal from being replayed. Returns the number of changes applied.
+    """
+    changes = 0
+
+    with open(path, 'rb') as journal_file:
+        if os.fstat(journal_file.fileno()).st_size <= len(JOURNAL_MAGIC):
+            return changes
+
+        with mmap.mmap(journal_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            if buffer[:len(JOURNAL_MAGIC)] != JOURNAL_MAGIC:
+                raise ValueError('{} is not a subscription journal file'.format(path))
+
+            offset = len(JOURNAL_MAGIC)
+            while offset + UINT.size <= len(buffer):
+                length, = UINT.unpack_from(buffer, offset)
+                offset += UINT.size
+                if offset + length > len(buffer):
+                    # The last record was partially written, so it never took place
+                    break
+
+                _apply(snapshot, buffer, offset)
+                offset += length
+                changes += 1
+
+    return changes
+
+
+def _apply(snapshot, buffer, offset):
+    op = bytes(buffer[offset:offset + 1])
+    email, offset = _unpack_string(buffer, offset + 1)
+    customer = snapshot.get(email)
+
+    if op == OP_CUSTOMER:
+        if customer is None:
+            name, offset = _unpack_string(buffer, offset)
+            password, offset = _unpack_string(buffer, offset)
+            snapshot.add(Customer(name, password, email))
+
+    elif op == OP_SUBSCRIPTION:
+        subscription_date, offset = _unpack_date(buffer, offset)
+        has_plan, offset = _unpack_int(buffer, offset)
+        plan = None
+        if has_plan:
+            key, offset = _unpack_plan_key(buffer, offset)
+            plan = snapshot.get_plan(key)
+
+        customer.subscription = plan
+        customer.subscription_date = subscription_date
+
+    elif op == OP_ADD:
+        urls, offset = _unpack_urls(buffer, offset)
+        # The websites were added already, so they're restored straight on the storage, as when loaded
+        websites = [Website(url) for url in urls]
+        customer.websites.storage.insert(websites)
+        for website in websites:
+            website._customer = customer
+
+    elif op == OP_REMOVE:
+        urls, offset = _unpack_urls(buffer, offset)
+        for url in urls:
+            customer.websites.remove(customer.websites.get_by_url(url))
+
+    elif op == OP_URL:
+        old_url, offset = _unpack_string(buffer, offset)
+        url, offset = _unpack_string(buffer, offset)
+        customer.websites.get_by_url(old_url).url = url
+
+    elif op == OP_SUSPEND:
+        positions, offset = _unpack_positions(buffer, offset)
+        customer.websites._suspend_positions(positions)
+
+    elif op == OP_EMAIL:
+        new_email, offset = _unpack_string(buffer, offset)
+        # Customers neither on the snapshot nor recorded before are recorded by their new email afterwards
+        if customer is not None:
+            snapshot.rename(email, new_email)
+
+    else:
+        raise ValueError('Unknown journal record {!r}'.format(op))
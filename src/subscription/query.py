@@ -0,0 +1,185 @@
+from itertools import islice
+
+
+class WebsiteQuerySet:
+    """
+    A lazy query over the websites of a WebsiteManager, by insertion order.
+    Nothing is read from the manager until the query is iterated, and then websites are streamed one by one.
+    """
+
+    LOOKUPS = {
+        'exact': lambda value, arg: value == arg,
+        'iexact': lambda value, arg: value.lower() == arg.lower(),
+        'contains': lambda value, arg: arg in value,
+        'icontains': lambda value, arg: arg.lower() in value.lower(),
+        'startswith': lambda value, arg: value.startswith(arg),
+        'endswith': lambda value, arg: value.endswith(arg),
+        'in': lambda value, arg: value in arg,
+    }
+
+    def __init__(self, manager, predicates=(), url=None, start=0, stop=None, keys=None):
+        """
+        :param manager: WebsiteManager object being queried
+        :param predicates=(): Callables that a website must satisfy to be part of the query
+        :param url=None: Exact url of the websites, answered by the manager url index
+        :param start=0: Position of the first website on the query
+        :param stop=None: Position after the last website on the query
+        :param keys=None: Storage keys of the websites on the query (a set), e.g. of the suspended ones
+        """
+        self.manager = manager
+        self.predicates = tuple(predicates)
+        self.url = url
+        self.start = start
+        self.stop = stop
+        self.keys = keys
+
+    def __iter__(self):
+        return (website for _, website in islice(self._pairs(), self.start, self.stop))
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            if item.step is not None:
+                return list(islice(self, item.start, item.stop, item.step))
+            if (item.start or 0) < 0 or (item.stop or 0) < 0:
+                raise ValueError('Negative indexing is not supported.')
+
+            start = self.start + (item.start or 0)
+            stop = self.stop if item.stop is None else self.start + item.stop
+            if self.stop is not None:
+                stop = min(stop, self.stop)
+
+            # An open-ended slice of an open-ended query stays open-ended
+            return self._clone(start=start, stop=stop if stop is None else max(start, stop))
+
+        if item < 0:
+            raise ValueError('Negative indexing is not supported.')
+
+        try:
+            return next(iter(self[item:item + 1]))
+        except StopIteration:
+            raise IndexError('WebsiteQuerySet index out of range')
+
+    def __contains__(self, obj):
+        if self._is_unrestricted():
+            return obj in self.manager
+
+        return any(website is obj for website in self)
+
+    def __bool__(self):
+        return self.exists()
+
+    def filter(self, *predicates, **lookups):
+        """
+        Returns a new query narrowed by the given predicates (callables receiving a website)
+        and lookups, written as `<attribute>__<lookup>=value` (e.g. url__startswith='https://').
+        """
+        if self._is_sliced():
+            raise TypeError('Cannot filter a query once a slice has been taken.')
+
+        url = self.url
+        predicates = self.predicates + predicates
+
+        for key, arg in lookups.items():
+            attr_name, _, lookup = key.partition('__')
+
+            if attr_name == 'url' and lookup in ('', 'exact') and url is None:
+                url = arg
+                continue
+
+            try:
+                test = self.LOOKUPS[lookup or 'exact']
+            except KeyError:
+                raise ValueError('Unsupported lookup \'{}\' on {}'.format(lookup, key))
+
+            predicates += (self._lookup_predicate(attr_name, test, arg),)
+
+        return self._clone(predicates=predicates, url=url)
+
+    def first(self):
+        return next(iter(self), None)
+
+    def exists(self):
+        return self.first() is not None
+
+    def count(self):
+        if not self.predicates and self.url is None and self.keys is None:
+            total = self.manager.count()
+            stop = total if self.stop is None else min(self.stop, total)
+            return max(0, stop - self.start)
+
+        return sum(1 for _ in self)
+
+    def paginate(self, size, cursor=None):
+        """
+        Returns a page with up to `size` websites after the `cursor` of the previous page, and the cursor to fetch
+        the next page (None on the last page). Seeking a page doesn't depend on how many pages come before it.
+        """
+        if self._is_sliced():
+            raise TypeError('Cannot paginate a query once a slice has been taken.')
+        if size < 1:
+            raise ValueError('The page size has to be at least 1. Size inserted: {}'.format(size))
+
+        pairs = list(islice(self._pairs(after=cursor), size + 1))
+        next_cursor = pairs[size - 1][0] if len(pairs) > size else None
+
+        return [website for _, website in pairs[:size]], next_cursor
+
+    def _pairs(self, after=None):
+        """Yields the (key, website) pairs of the query, by insertion order."""
+        if self.url is None:
+            pairs = self.manager.storage.iterate(after)
+        else:
+            pairs = self.manager.storage.iterate_url(self.url, after)
+
+        for key, website in pairs:
+            if (self.keys is None or key in self.keys) and all(predicate(website) for predicate in self.predicates):
+                yield key, website
+
+    def _clone(self, **kwargs):
+        attrs = dict(predicates=self.predicates, url=self.url, start=self.start, stop=self.stop, keys=self.keys)
+        attrs.update(kwargs)
+        return type(self)(self.manager, **attrs)
+
+    def _is_sliced(self):
+        return self.start or self.stop is not None
+
+    def _is_unrestricted(self):
+        return not self.predicates and self.url is None and self.keys is None and not self._is_sliced()
+
+    @staticmethod
+    def _lookup_predicate(attr_name, test, arg):
+        return lambda website: test(getattr(website, attr_name), arg)
+
+
+class WebsitesSnapshot:
+    """
+    Immutable view of a customer websites as they were when WebsiteManager.snapshot() was called, queried as the
+    manager itself (all, filter, count). Later additions and removals don't change it, though the Website objects
+    are still the customer ones.
+    """
+
+    def __init__(self, customer, storage):
+        """
+        :param customer: Customer owning the websites
+        :param storage: Read-only storage of the snapshot (e.g. a PagedSnapshot object)
+        """
+        self.customer = customer
+        self.storage = storage
+
+    def __contains__(self, obj):
+        return obj in self.storage
+
+    def __iter__(self):
+        return iter(self.all())
+
+    def __len__(self):
+        return len(self.storage)
+
+    def all(self):
+        return WebsiteQuerySet(self)
+
+    def filter(self, *predicates, **lookups):
+        return self.all().filter(*predicates, **lookups)
+
+    def count(self):
+        return len(self.storage)
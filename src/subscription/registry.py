@@ -0,0 +1,204 @@
+import itertools
+import threading
+from heapq import merge
+
+from .exceptions import ObjectDoesNotExist
+from .signals import customer_email_changed, customer_pre_email_change, subscription_changed
+
+# The customers and emails indexes are split into buckets, so that the first change of a bucket after a snapshot
+# only copies that bucket, rather than the whole index
+BUCKETS = 256
+
+
+def _customer_bucket(customer):
+    # Objects addresses are aligned, so the lowest bits are dropped before hashing them into a bucket
+    return (id(customer) >> 4) % BUCKETS
+
+
+def _email_bucket(email):
+    return hash(email) % BUCKETS
+
+
+class BaseRegistry:
+    """Lookups over the customers indexes by email, by subscription plan and by plan type."""
+
+    def __contains__(self, customer):
+        return id(customer) in self._customers[_customer_bucket(customer)]
+
+    def __iter__(self):
+        # Each bucket keeps its customers by registration order, so merging them gets the registration order back
+        return iter([customer for _, customer in merge(*(bucket.values() for bucket in self._customers))])
+
+    def __len__(self):
+        return self._count
+
+    def get(self, email):
+        try:
+            return self._emails[_email_bucket(email)][email]
+        except KeyError:
+            raise ObjectDoesNotExist('Customer with email {} doesn\'t exist on the registry'.format(email))
+
+    def by_plan(self, plan):
+        """Returns the customers subscribed to the given plan, in the order they joined it."""
+        return list(self._plans.get(id(plan), {}).values())
+
+    def by_plan_type(self, plan_type):
+        """Returns the customers subscribed to a plan of the given type, in the order they joined it."""
+        return list(self._plan_types.get(plan_type, {}).values())
+
+    def count_by_plan(self, plan):
+        return len(self._plans.get(id(plan), ()))
+
+    def count_by_plan_type(self, plan_type):
+        return len(self._plan_types.get(plan_type, ()))
+
+
+class CustomerRegistry(BaseRegistry):
+    """
+    Collection of customers, with hash indexes by email, by subscription plan and by plan type.
+
+    The plan indexes follow Customer.subscription changes (thus subscribe_plan and change_plan) of the registered
+    customers, through the subscription_changed signal, and the email index follows their Customer.email changes,
+    through customer_email_changed (rejecting, with ValueError, emails of other registered customers through
+    customer_pre_email_change).
+    """
+
+    def __init__(self, customers=()):
+        """
+        :param customers=(): Customers to register straight away
+        """
+        # Buckets of {customer identity: (registration number, customer)}, working as insertion-ordered sets, and
+        # buckets of {email: customer}
+        self._customers = [{} for _ in range(BUCKETS)]
+        self._emails = [{} for _ in range(BUCKETS)]
+        self._count = 0
+        self._registrations = itertools.count()
+        # customer identity -> the email it's indexed under, which is how it's unindexed even if changed meanwhile
+        self._indexed_emails = {}
+        self._plans = {}
+        self._plan_types = {}
+        # Once a snapshot is taken, the indexes (and each of their buckets, plans or plan types customers) are shared
+        # with it until copied by their first change, as tracked by _copied
+        self._snapshot_taken = False
+        self._copied = set()
+        # Signals of different customers may be sent from different threads at the same time, while changes copy the
+        # indexes shared with a snapshot before changing them
+        self._lock = threading.Lock()
+
+        self.add(*customers)
+
+        subscription_changed.connect(self._subscription_changed)
+        customer_pre_email_change.connect(self._pre_email_change)
+        customer_email_changed.connect(self._email_changed)
+
+    def add(self, *customers):
+        with self._lock:
+            for customer in customers:
+                if customer in self:
+                    continue
+                if customer.email in self._emails[_email_bucket(customer.email)]:
+                    raise ValueError('A customer with the email {} is already registered'.format(customer.email))
+
+                customer_bucket = self._writable('_customers', _customer_bucket(customer))
+                customer_bucket[id(customer)] = (next(self._registrations), customer)
+                self._writable('_emails', _email_bucket(customer.email))[customer.email] = customer
+                self._indexed_emails[id(customer)] = customer.email
+                self._count += 1
+                self._index_plan(customer, customer.subscription)
+
+    def remove(self, customer):
+        with self._lock:
+            if customer not in self:
+                raise ObjectDoesNotExist('Customer doesn\'t exist on the registry')
+
+            del self._writable('_customers', _customer_bucket(customer))[id(customer)]
+            email = self._indexed_emails.pop(id(customer))
+            del self._writable('_emails', _email_bucket(email))[email]
+            self._count -= 1
+            self._unindex_plan(customer, customer.subscription)
+
+    def snapshot(self):
+        """
+        Returns an immutable view of the registry as it is now (a RegistrySnapshot object), in O(1). Registry changes
+        afterwards copy the index buckets they touch, instead of the snapshot copying the indexes.
+        """
+        with self._lock:
+            self._snapshot_taken = True
+            self._copied = set()
+            return RegistrySnapshot(self._customers, self._emails, self._count, self._plans, self._plan_types)
+
+    def _writable(self, name, key):
+        """
+        Returns the bucket, or the customers of a plan or plan type (created if needed), of an index to be changed,
+        copying it (and the index) first if it's shared with a snapshot. Called under the registry lock.
+        """
+        index = getattr(self, name)
+        if self._snapshot_taken and name not in self._copied:
+            # Copying the index copies the references to its buckets (or plans customers), not their customers
+            index = list(index) if isinstance(index, list) else dict(index)
+            setattr(self, name, index)
+            self._copied.add(name)
+
+        customers = index[key] if isinstance(index, list) else index.get(key)
+        if customers is None:
+            customers = index[key] = {}
+            if self._snapshot_taken:
+                self._copied.add((name, key))
+        elif self._snapshot_taken and (name, key) not in self._copied:
+            customers = index[key] = dict(customers)
+            self._copied.add((name, key))
+
+        return customers
+
+    def _index_plan(self, customer, plan):
+        if plan:
+            self._writable('_plans', id(plan))[id(customer)] = customer
+            self._writable('_plan_types', plan.plan_type)[id(customer)] = customer
+
+    def _unindex_plan(self, customer, plan):
+        if not plan:
+            return
+
+        for name, key in (('_plans', id(plan)), ('_plan_types', plan.plan_type)):
+            customers = self._writable(name, key)
+            del customers[id(customer)]
+            if not customers:
+                del getattr(self, name)[key]
+
+    def _subscription_changed(self, sender, instance, old_subscription, **kwargs):
+        if instance in self and old_subscription is not instance.subscription:
+            with self._lock:
+                self._unindex_plan(instance, old_subscription)
+                self._index_plan(instance, instance.subscription)
+
+    def _pre_email_change(self, sender, instance, email, **kwargs):
+        if instance in self and self._emails[_email_bucket(email)].get(email, instance) is not instance:
+            raise ValueError('A customer with the email {} is already registered'.format(email))
+
+    def _email_changed(self, sender, instance, **kwargs):
+        if instance not in self:
+            return
+
+        with self._lock:
+            old_email = self._indexed_emails[id(instance)]
+            del self._writable('_emails', _email_bucket(old_email))[old_email]
+            self._writable('_emails', _email_bucket(instance.email))[instance.email] = instance
+            self._indexed_emails[id(instance)] = instance.email
+
+
+class RegistrySnapshot(BaseRegistry):
+    """
+    Immutable view of a CustomerRegistry as it was when CustomerRegistry.snapshot() was called: its customers and
+    their plans, unaffected by later registrations or subscription changes.
+    """
+
+    def __init__(self, customers, emails, count, plans, plan_types):
+        self._customers = customers
+        self._emails = emails
+        self._count = count
+        self._plans = plans
+        self._plan_types = plan_types
+
+    def websites(self, customer):
+        """Returns a snapshot of the customer websites, as they are now (see WebsiteManager.snapshot)."""
+        return customer.websites.snapshot()
@@ -0,0 +1,118 @@
+import threading
+from bisect import bisect_left, bisect_right, insort
+
+from .signals import subscription_changed
+
+
+class RenewalIndex:
+    """
+    Calendar of customers by subscription renewal date, answering which customers renew on a day or
+    between two days in time proportional to the result size.
+
+    The index follows the Customer.subscription and subscription_date changes (thus subscribe_plan and change_plan)
+    of its members, the customers added to it, through the subscription_changed signal. Members without a
+    subscription (or popped by pop_due) are left out of the renewal dates until their subscription changes.
+    """
+
+    def __init__(self, customers=()):
+        """
+        :param customers=(): Customers to add to the index straight away
+        """
+        # renewal date -> {customer identity: customer}, and the sorted list of those renewal dates
+        self._buckets = {}
+        self._dates = []
+        # customer identity -> customer renewal date
+        self._renewals = {}
+        # customer identity -> customer, of the customers added (and not discarded) whose changes are followed
+        self._members = {}
+        # Signals of different customers may be sent from different threads at the same time
+        self._lock = threading.Lock()
+
+        for customer in customers:
+            self.add(customer)
+
+        subscription_changed.connect(self._subscription_changed)
+
+    def __len__(self):
+        return len(self._renewals)
+
+    def __contains__(self, customer):
+        return id(customer) in self._renewals
+
+    def add(self, customer):
+        """
+        Adds (or moves) a customer to its renewal date. Customers without a subscription are left out of the renewal
+        dates, but added once they subscribe a plan.
+        """
+        with self._lock:
+            self._members[id(customer)] = customer
+            self._index(customer)
+
+    def discard(self, customer):
+        """Removes a customer from the index, whose subscription changes are no longer followed."""
+        with self._lock:
+            self._members.pop(id(customer), None)
+            self._unindex(customer)
+
+    def _index(self, customer):
+        self._unindex(customer)
+
+        renewal_date = customer.sub_renewal_date
+        if renewal_date is None:
+            return
+
+        bucket = self._buckets.get(renewal_date)
+        if bucket is None:
+            bucket = self._buckets[renewal_date] = {}
+            insort(self._dates, renewal_date)
+
+        bucket[id(customer)] = customer
+        self._renewals[id(customer)] = renewal_date
+
+    def _unindex(self, customer):
+        renewal_date = self._renewals.pop(id(customer), None)
+        if renewal_date is None:
+            return
+
+        bucket = self._buckets[renewal_date]
+        del bucket[id(customer)]
+        if not bucket:
+            del self._buckets[renewal_date]
+            del self._dates[bisect_left(self._dates, renewal_date)]
+
+    def due_on(self, day):
+        """Returns the customers renewing on the given day."""
+        with self._lock:
+            return list(self._buckets.get(day, {}).values())
+
+    def due_between(self, start, end):
+        """Returns the customers renewing between start and end days (both included), by renewal date."""
+        with self._lock:
+            dates = self._dates[bisect_left(self._dates, start):bisect_right(self._dates, end)]
+            return [customer for day in dates for customer in self._buckets[day].values()]
+
+    def pop_due(self, now):
+        """
+        Removes and returns the customers renewing until the given day (included), by renewal date. They're still
+        members, added back to their next renewal date once renewed (i.e. their subscription date changes).
+        """
+        with self._lock:
+            position = bisect_right(self._dates, now)
+            dates, self._dates[:position] = self._dates[:position], []
+
+            customers = []
+            for day in dates:
+                for customer in self._buckets.pop(day).values():
+                    del self._renewals[id(customer)]
+                    customers.append(customer)
+
+        return customers
+
+    def _subscription_changed(self, sender, instance, **kwargs):
+        # Every customer subscription change is signaled, so the ones of customers not on the index are ignored
+        if id(instance) not in self._members:
+            return
+
+        with self._lock:
+            if id(instance) in self._members:
+                self._index(instance)
@@ -0,0 +1,59 @@
+import asyncio
+
+
+class AsyncSubscriptionService:
+    """
+    Asyncio facade over the customers subscriptions and websites operations.
+
+    Operations on the same customer are serialized by a per-customer asyncio.Lock, while operations on different
+    customers run concurrently. They run on an executor when given one (e.g. for websites kept on a SQLiteStorage),
+    or otherwise straight on the event loop, where they never block nor interleave with each other.
+    """
+
+    def __init__(self, executor=None):
+        """
+        :param executor=None: concurrent.futures.Executor to run the operations on. Defaults to the event loop itself.
+        """
+        self.executor = executor
+        # customer identity -> [lock, number of operations using it], so that unused locks are dropped
+        self._locks = {}
+
+    async def subscribe_plan(self, customer, plan):
+        return await self._run(customer, customer.subscribe_plan, plan)
+
+    async def change_plan(self, customer, new_plan, over_quota='reject'):
+        return await self._run(customer, customer.change_plan, new_plan, over_quota)
+
+    async def add_websites(self, customer, *websites):
+        return await self._run(customer, customer.websites.bulk_add, websites)
+
+    async def remove_website(self, customer, website):
+        return await self._run(customer, customer.websites.remove, website)
+
+    async def bulk_add_websites(self, items):
+        """
+        Adds websites to many customers concurrently, from (customer, websites) pairs.
+        Returns, for each pair, None or the exception raised (e.g. CustomerAddWebsitePermissionDenied).
+        """
+        return await asyncio.gather(
+            *(self.add_websites(customer, *websites) for customer, websites in items), return_exceptions=True
+        )
+
+    async def _run(self, customer, func, *args):
+        if self.executor is None:
+            # Operations on the event loop never await, so they can't interleave and don't need the lock
+            return func(*args)
+
+        key = id(customer)
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+
+        try:
+            async with entry[0]:
+                return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
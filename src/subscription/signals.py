@@ -0,0 +1,70 @@
+import weakref
+
+
+class Signal:
+    """
+    A minimal take on django signals, to let other objects (indexes, registries, ...) know about models changes.
+    Receivers are called with the sender and the keyword arguments of each sent signal.
+    """
+
+    def __init__(self):
+        self.receivers = []
+
+    def connect(self, receiver, weak=True):
+        """
+        :param receiver: Callable to be called when the signal is sent
+        :param weak=True: Keeps only a weak reference to the receiver, so it's disconnected once garbage collected
+        """
+        if weak:
+            reference = weakref.WeakMethod(receiver) if hasattr(receiver, '__self__') else weakref.ref(receiver)
+        else:
+            reference = lambda: receiver  # noqa: E731
+
+        self.disconnect(receiver)
+        self.receivers.append(reference)
+
+    def disconnect(self, receiver):
+        self.receivers = [reference for reference in self.receivers if reference() not in (None, receiver)]
+
+    def send(self, sender, **kwargs):
+        collected = False
+        for reference in self.receivers:
+            receiver = reference()
+            if receiver is None:
+                collected = True
+            else:
+                receiver(sender=sender, **kwargs)
+
+        if collected:
+            self.receivers = [reference for reference in self.receivers if reference() is not None]
+
+
+# Sent by Customer whenever its subscription plan or date changes, with the customer as `instance`
+# and its previous plan and date as `old_subscription` and `old_subscription_date`.
+subscription_changed = Signal()
+
+# Sent by Customer with the customer as `instance`, before its email changes to `email`, and once it changed from
+# `old_email`. Receivers of customer_pre_email_change can raise an exception to prevent the change.
+customer_pre_email_change = Signal()
+customer_email_changed = Signal()
+
+# Sent by WebsiteManager with the customer as `instance`, once `websites` (a list) are added to it or removed from it.
+websites_added = Signal()
+websites_removed = Signal()
+
+# Sent by WebsiteManager with the customer as `instance`, once a `website` url changes from `old_url`.
+website_url_changed = Signal()
+
+# Sent by WebsiteManager with the customer as `instance`, once the websites suspended for being over a quota change
+# (see WebsiteManager.enforce_quota), with the ones suspended now as `websites` (a list).
+websites_suspended = Signal()
+
+# Sent by WebsiteManager with the customer as `instance`, before `websites` (a list) are added to it, and before a
+# `website` url changes to `url`. Receivers can raise an exception to prevent the change.
+websites_pre_add = Signal()
+website_pre_url_change = Signal()
+
+# Sent by WebsiteManager with the same arguments as websites_pre_add (or website_pre_url_change) when the websites
+# addition (or the url change) fails afterwards, so that receivers can undo what they did before it.
+websites_add_failed = Signal()
+website_url_change_failed = Signal()
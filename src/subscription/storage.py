@@ -0,0 +1,727 @@
+import sqlite3
+import threading
+from array import array
+from bisect import bisect_right
+from contextlib import contextmanager
+from itertools import chain
+
+from .exceptions import WebsiteAlreadyRegistered
+
+
+class BaseStorage:
+    """
+    Storage of the websites behind a WebsiteManager.
+    Every website gets an increasing key when stored, so websites are iterated by insertion order
+    and a key works as a pagination cursor.
+    """
+
+    # Removed websites leave an empty slot behind. Slots are compacted once there are more empty ones than
+    # websites, so that removals stay O(1) without letting the storage grow forever.
+    MIN_HOLES_TO_COMPACT = 64
+
+    # Whether the Website objects stored are kept (and returned) as they are, rather than created when read
+    KEEPS_WEBSITE_OBJECTS = False
+
+    customer = None
+
+    def bind(self, customer):
+        """Binds the storage to the customer owning its websites."""
+        from .models import Website
+
+        self.customer = customer
+        self._website_class = Website
+
+    def __contains__(self, website):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def get(self, website):
+        """Returns the stored website matching the given one, or None."""
+        raise NotImplementedError
+
+    def get_by_url(self, url):
+        """Returns the first stored website with the given url, or None."""
+        raise NotImplementedError
+
+    def key(self, website):
+        """Returns the key of a stored website, or None."""
+        raise NotImplementedError
+
+    def check_insert(self, websites):
+        """
+        Raises WebsiteAlreadyRegistered if a list of websites can't be stored (e.g. for having an url stored already),
+        without changing anything, so that it's known before the websites are moved out of their previous customers.
+        """
+
+    def insert(self, websites):
+        """Stores a list of websites, which aren't yet stored."""
+        raise NotImplementedError
+
+    def discard(self, website):
+        """Removes a stored website."""
+        raise NotImplementedError
+
+    def bulk_discard(self, websites, keys=None):
+        """
+        Removes a list of stored websites.
+
+        :param websites: Websites to remove
+        :param keys=None: Keys of the websites (e.g. read from iterate), identifying them on storages where
+            several websites may share an url
+        """
+        for website in websites:
+            self.discard(website)
+
+    def reindex_url(self, website, old_url):
+        """Updates a stored website whose url has been changed from old_url."""
+        raise NotImplementedError
+
+    def reindex_email(self, old_email):
+        """
+        Updates the storage of a customer whose email has been changed from old_email, raising ValueError if the
+        storage can't take the new one.
+        """
+
+    def iterate(self, after=None):
+        """Yields (key, website) pairs by insertion order, starting after the given key."""
+        raise NotImplementedError
+
+    def iterate_url(self, url, after=None):
+        """Yields (key, website) pairs of the websites with the given url, by insertion order."""
+        return ((key, website) for key, website in self.iterate(after) if website.url == url)
+
+    def snapshot(self):
+        """
+        Returns a read-only storage with the websites stored now, unaffected by later changes.
+        Defaults to reading them all, for storages which can't share their state with the snapshot.
+        """
+        pairs = list(self.iterate())
+        websites = [website for _, website in pairs]
+        snapshot = PagedSnapshot([websites], [key for key, _ in pairs], len(pairs), len(pairs), max(1, len(pairs)))
+        snapshot.bind(self.customer)
+        return snapshot
+
+    def _website(self, url):
+        """Creates a Website object for a stored url, for storages not keeping Website objects."""
+        website = self._website_class.__new__(self._website_class)
+        website._url = url
+        website._customer = self.customer
+        return website
+
+
+class MemoryStorage(BaseStorage):
+    """
+    Keeps the Website objects on fixed size pages, with hash indexes by website identity and by url.
+
+    Snapshots share the pages with the storage, which are only copied once a website on them is removed afterwards
+    (additions go past the websites a snapshot sees), so taking one is O(1) and removals pay for a page at most.
+    """
+
+    PAGE_SIZE = 1024
+
+    KEEPS_WEBSITE_OBJECTS = True
+
+    def __init__(self):
+        # Website objects by insertion order, on pages of PAGE_SIZE (None on removed slots), and their keys
+        self.pages = []
+        self.keys = []
+        self._next_key = 0
+        # website identity -> position on the websites pages
+        self._positions = {}
+        # url -> website, or a list of websites when more than one share the same url
+        self._urls = {}
+        self._holes = 0
+        self._compactions = 0
+        # Whether the pages list is shared with a snapshot, the number of leading pages shared with it and
+        # the ones since copied
+        self._pages_shared = False
+        self._shared_pages = 0
+        self._copied_pages = set()
+
+    def __contains__(self, website):
+        return id(website) in self._positions
+
+    def __len__(self):
+        return len(self._positions)
+
+    def get(self, website):
+        return website if id(website) in self._positions else None
+
+    def get_by_url(self, url):
+        websites = self._urls.get(url)
+        return websites[0] if isinstance(websites, list) else websites
+
+    def key(self, website):
+        position = self._positions.get(id(website))
+        return None if position is None else self.keys[position]
+
+    def insert(self, websites):
+        for website in websites:
+            position = len(self.keys)
+            if not position % self.PAGE_SIZE:
+                self.pages.append([])
+
+            self.pages[-1].append(website)
+            self._positions[id(website)] = position
+            self.keys.append(self._next_key)
+            self._next_key += 1
+            self._index_url(website, website.url)
+
+    def discard(self, website):
+        page, offset = divmod(self._positions.pop(id(website)), self.PAGE_SIZE)
+        self._writable_page(page)[offset] = None
+        self._holes += 1
+        self._unindex_url(website, website.url)
+
+        if self._holes > self.MIN_HOLES_TO_COMPACT and self._holes > len(self._positions):
+            self._compact()
+
+    def reindex_url(self, website, old_url):
+        self._unindex_url(website, old_url)
+        self._index_url(website, website.url)
+
+    def iterate(self, after=None):
+        key = -1 if after is None else after
+        position = bisect_right(self.keys, key)
+        compactions = self._compactions
+
+        while position < len(self.keys):
+            if compactions != self._compactions:
+                # The websites were compacted while iterating, so the position of the last key has moved
+                compactions = self._compactions
+                position = bisect_right(self.keys, key)
+                continue
+
+            website = self.pages[position // self.PAGE_SIZE][position % self.PAGE_SIZE]
+            position += 1
+
+            if website is not None:
+                key = self.keys[position - 1]
+                yield key, website
+
+    def iterate_url(self, url, after=None):
+        websites = self._urls.get(url, ())
+        if not isinstance(websites, list):
+            websites = [websites]
+
+        pairs = sorted((self.keys[self._positions[id(website)]], website) for website in websites)
+        return ((key, website) for key, website in pairs if after is None or key > after)
+
+    def snapshot(self):
+        self._pages_shared = True
+        self._shared_pages = len(self.pages)
+        self._copied_pages = set()
+
+        snapshot = PagedSnapshot(self.pages, self.keys, len(self.keys), len(self._positions), self.PAGE_SIZE)
+        snapshot.bind(self.customer)
+        return snapshot
+
+    def _writable_page(self, page):
+        """Returns a page to be changed, copying it first if it's shared with a snapshot."""
+        if page < self._shared_pages and page not in self._copied_pages:
+            if self._pages_shared:
+                self.pages = list(self.pages)
+                self._pages_shared = False
+
+            self.pages[page] = list(self.pages[page])
+            self._copied_pages.add(page)
+
+        return self.pages[page]
+
+    def _index_url(self, website, url):
+        # Most urls belong to a single website, which is then stored on its own instead of inside a container
+        current = self._urls.setdefault(url, website)
+        if current is website:
+            return
+        if isinstance(current, list):
+            current.append(website)
+        else:
+            self._urls[url] = [current, website]
+
+    def _unindex_url(self, website, url):
+        current = self._urls[url]
+        if not isinstance(current, list):
+            del self._urls[url]
+            return
+
+        current.remove(website)
+        if len(current) == 1:
+            self._urls[url] = current[0]
+
+    def _compact(self):
+        # New pages and keys lists are built, so the ones shared with snapshots are left as they are
+        entries = [
+            (key, website) for key, website in zip(self.keys, chain.from_iterable(self.pages)) if website is not None
+        ]
+        websites = [website for _, website in entries]
+        self.keys = [key for key, _ in entries]
+        self.pages = [websites[start:start + self.PAGE_SIZE] for start in range(0, len(websites), self.PAGE_SIZE)]
+        self._positions = {id(website): position for position, website in enumerate(websites)}
+        self._holes = 0
+        self._compactions += 1
+        self._pages_shared = False
+        self._shared_pages = 0
+        self._copied_pages = set()
+
+
+class PagedSnapshot(BaseStorage):
+    """
+    Read-only storage of a snapshot, over the first `length` slots of websites pages and keys (possibly shared
+    with the storage it was taken from, which only appends to them past those slots).
+    """
+
+    PAGE_SIZE = MemoryStorage.PAGE_SIZE
+
+    def __init__(self, pages, keys, length, count, page_size=PAGE_SIZE):
+        """
+        :param pages: Lists of websites by insertion order, with None on removed slots
+        :param keys: Keys of the websites slots
+        :param length: Number of slots on the snapshot
+        :param count: Number of websites on the snapshot
+        :param page_size=PAGE_SIZE: Number of slots per page
+        """
+        self.pages = pages
+        self.keys = keys
+        self.length = length
+        self.count = count
+        self.page_size = page_size
+
+    def __contains__(self, website):
+        return any(stored is website for _, stored in self.iterate())
+
+    def __len__(self):
+        return self.count
+
+    def get(self, website):
+        return website if website in self else None
+
+    def get_by_url(self, url):
+        return next((website for _, website in self.iterate_url(url)), None)
+
+    def iterate(self, after=None):
+        start = bisect_right(self.keys, -1 if after is None else after, 0, self.length)
+
+        for position in range(start, self.length):
+            website = self.pages[position // self.page_size][position % self.page_size]
+            if website is not None:
+                yield self.keys[position], website
+
+
+class WebsiteTable:
+    """
+    Columnar table of websites, which can be shared by many customers' ArrayStorage.
+    Urls are interned (each distinct url string is kept once), customers are referenced by integer ids
+    and each url belongs to, at most, one customer.
+    """
+
+    NO_CUSTOMER = -1
+
+    def __init__(self):
+        # url id -> url, and url -> url id
+        self.urls = []
+        self.url_ids = {}
+        # url id -> id of the customer owning the url, and the url position on that customer storage
+        self.owners = array('l')
+        self.positions = array('l')
+        # customer id -> customer, and customer identity -> customer id
+        self.customers = []
+        self.customer_ids = {}
+
+    def intern(self, url):
+        """Returns the id of the url, adding it to the table if needed."""
+        url_id = self.url_ids.get(url)
+        if url_id is None:
+            url_id = self.url_ids[url] = len(self.urls)
+            self.urls.append(url)
+            self.owners.append(self.NO_CUSTOMER)
+            self.positions.append(-1)
+
+        return url_id
+
+    def customer_id(self, customer):
+        """Returns the id of the customer, adding it to the table if needed."""
+        customer_id = self.customer_ids.get(id(customer))
+        if customer_id is None:
+            customer_id = self.customer_ids[id(customer)] = len(self.customers)
+            self.customers.append(customer)
+
+        return customer_id
+
+
+class ArrayStorage(BaseStorage):
+    """
+    Compact websites storage on top of a WebsiteTable, for customers with huge websites inventories.
+    Only integer arrays are kept per customer: websites are identified by url (so adding another website with a
+    stored url raises WebsiteAlreadyRegistered), and the Website objects returned are created when read.
+
+    Snapshots share the rows array with the storage, which is copied (as a single memory block) by the first
+    removal or url change afterwards.
+    """
+
+    def __init__(self, table=None):
+        """
+        :param table=None: WebsiteTable object holding the websites. Defaults to a new WebsiteTable object.
+        """
+        self.table = table if table is not None else WebsiteTable()
+        # url ids by insertion order (-1 on removed slots), and their keys
+        self.rows = array('l')
+        self.keys = array('q')
+        self._next_key = 0
+        self._count = 0
+        self._holes = 0
+        self._compactions = 0
+        self._rows_shared = False
+
+    def bind(self, customer):
+        super().bind(customer)
+        self._customer_id = self.table.customer_id(customer)
+
+    def __contains__(self, website):
+        return self._url_id(website.url) is not None
+
+    def __len__(self):
+        return self._count
+
+    def get(self, website):
+        return self.get_by_url(website.url)
+
+    def get_by_url(self, url):
+        url_id = self._url_id(url)
+        return None if url_id is None else self._website(self.table.urls[url_id])
+
+    def key(self, website):
+        url_id = self._url_id(website.url)
+        return None if url_id is None else self.keys[self.table.positions[url_id]]
+
+    def check_insert(self, websites):
+        # Urls are owned by a single customer of the table, which can be the one the website is moved from
+        self._check_urls(websites, moved=True)
+
+    def insert(self, websites):
+        self._check_urls(websites)
+        url_ids = [self.table.intern(website.url) for website in websites]
+
+        for url_id in url_ids:
+            self._take(url_id, len(self.rows))
+            self.rows.append(url_id)
+            self.keys.append(self._next_key)
+            self._next_key += 1
+
+        self._count += len(url_ids)
+
+    def discard(self, website):
+        url_id = self._url_id(website.url)
+        self._writable_rows()[self.table.positions[url_id]] = -1
+        self.table.owners[url_id] = WebsiteTable.NO_CUSTOMER
+        self._count -= 1
+        self._holes += 1
+
+        if self._holes > self.MIN_HOLES_TO_COMPACT and self._holes > self._count:
+            self._compact()
+
+    def reindex_url(self, website, old_url):
+        old_url_id = self._url_id(old_url)
+        self._check_urls([website])
+        url_id = self.table.intern(website.url)
+
+        position = self.table.positions[old_url_id]
+        self.table.owners[old_url_id] = WebsiteTable.NO_CUSTOMER
+        self._take(url_id, position)
+        self._writable_rows()[position] = url_id
+
+    def iterate(self, after=None):
+        key = -1 if after is None else after
+        position = bisect_right(self.keys, key)
+        compactions = self._compactions
+
+        while position < len(self.rows):
+            if compactions != self._compactions:
+                # The rows were compacted while iterating, so the position of the last key has moved
+                compactions = self._compactions
+                position = bisect_right(self.keys, key)
+                continue
+
+            url_id = self.rows[position]
+            position += 1
+
+            if url_id != -1:
+                key = self.keys[position - 1]
+                yield key, self._website(self.table.urls[url_id])
+
+    def iterate_url(self, url, after=None):
+        url_id = self._url_id(url)
+        if url_id is None:
+            return iter(())
+
+        key = self.keys[self.table.positions[url_id]]
+        return iter([(key, self._website(url))] if after is None or key > after else [])
+
+    def snapshot(self):
+        self._rows_shared = True
+
+        snapshot = ArraySnapshot(self.table.urls, self.rows, self.keys, len(self.rows), self._count)
+        snapshot.bind(self.customer)
+        return snapshot
+
+    def _writable_rows(self):
+        """Returns the rows to be changed, copying them first if they're shared with a snapshot."""
+        if self._rows_shared:
+            self.rows = array('l', self.rows)
+            self._rows_shared = False
+
+        return self.rows
+
+    def _url_id(self, url):
+        """Returns the url id, if the url is owned by this storage customer, or None."""
+        url_id = self.table.url_ids.get(url)
+        if url_id is None or self.table.owners[url_id] != self._customer_id:
+            return None
+
+        return url_id
+
+    def _check_urls(self, websites, moved=False):
+        """
+        Raises WebsiteAlreadyRegistered if any of the websites urls is repeated, or owned by a customer of the table
+        (other than the one the website is moved from, when they're still to be moved).
+        """
+        table = self.table
+        urls = set()
+        for website in websites:
+            url_id = table.url_ids.get(website.url)
+            owner = table.NO_CUSTOMER if url_id is None else table.owners[url_id]
+            previous_customer = website._customer if moved else None
+            if owner != table.NO_CUSTOMER and table.customers[owner] is not previous_customer:
+                raise WebsiteAlreadyRegistered('Website with url {} is already stored'.format(website.url))
+            if website.url in urls:
+                raise WebsiteAlreadyRegistered('Websites with repeated urls can\'t be stored')
+            urls.add(website.url)
+
+    def _take(self, url_id, position):
+        self.table.owners[url_id] = self._customer_id
+        self.table.positions[url_id] = position
+
+    def _compact(self):
+        keys = array('q')
+        rows = array('l')
+        for key, url_id in zip(self.keys, self.rows):
+            if url_id != -1:
+                self.table.positions[url_id] = len(rows)
+                rows.append(url_id)
+                keys.append(key)
+
+        self.keys, self.rows = keys, rows
+        self._holes = 0
+        self._compactions += 1
+        self._rows_shared = False
+
+
+class ArraySnapshot(PagedSnapshot):
+    """Read-only storage of an ArrayStorage snapshot, over the first `length` rows (of url ids) and keys."""
+
+    def __init__(self, urls, rows, keys, length, count):
+        """
+        :param urls: Urls of the WebsiteTable, by url id
+        :param rows: Url ids by insertion order, with -1 on removed slots
+        :param keys: Keys of the rows
+        :param length: Number of rows on the snapshot
+        :param count: Number of websites on the snapshot
+        """
+        super().__init__([rows], keys, length, count, max(1, length))
+        self.urls = urls
+
+    def __contains__(self, website):
+        return self.get_by_url(website.url) is not None
+
+    def iterate(self, after=None):
+        start = bisect_right(self.keys, -1 if after is None else after, 0, self.length)
+
+        for position in range(start, self.length):
+            url_id = self.pages[0][position]
+            if url_id != -1:
+                yield self.keys[position], self._website(self.urls[url_id])
+
+
+class SQLiteConnection(sqlite3.Connection):
+    """
+    sqlite3.Connection usable from any thread, with a lock serializing the statements (and transactions) of the
+    SQLiteStorage objects sharing it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs['check_same_thread'] = False
+        super().__init__(*args, **kwargs)
+        self.lock = threading.RLock()
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Websites storage on a SQLite database, so that a customer websites inventory doesn't have to sit in memory.
+    Websites are identified by url (so adding another website with a stored url raises WebsiteAlreadyRegistered),
+    with the Website objects returned being created when read. Rows are bound to an owner id, which is bound to the
+    customer email (following its changes), so a customer finds its websites again once the database is reopened.
+    Counting and url lookups are answered by indexed queries.
+
+    The storage can be used from any thread (e.g. by AsyncSubscriptionService on a thread pool), with the statements
+    on its connection serialized by the connection lock.
+    """
+
+    # Websites are read from the database in batches while iterating, instead of all at once
+    ITERATE_BATCH_SIZE = 1000
+    # Urls looked up per query when checking an insert, within the SQLite limit of variables per statement
+    CHECK_BATCH_SIZE = 500
+
+    def __init__(self, database=':memory:'):
+        """
+        :param database=':memory:': Path of the database file, or a connection (e.g. shared by customers). Connections
+            shared by storages used from several threads have to be SQLiteConnection objects, such as the connection
+            of another SQLiteStorage, or one opened with sqlite3.connect(path, factory=SQLiteConnection).
+        """
+        if isinstance(database, sqlite3.Connection):
+            self.connection = database
+        else:
+            self.connection = sqlite3.connect(database, factory=SQLiteConnection)
+        self.lock = getattr(self.connection, 'lock', None) or threading.RLock()
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS customers ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, email TEXT NOT NULL UNIQUE)'
+            )
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS websites ('
+                'key INTEGER PRIMARY KEY AUTOINCREMENT, customer INTEGER NOT NULL, url TEXT NOT NULL)'
+            )
+            # A customer can't have two websites with the same url, even if written bypassing check_insert
+            self.connection.execute(
+                'CREATE UNIQUE INDEX IF NOT EXISTS websites_customer_url ON websites (customer, url)'
+            )
+
+    def bind(self, customer):
+        super().bind(customer)
+        with self.lock:
+            with self.connection:
+                self.connection.execute('INSERT OR IGNORE INTO customers (email) VALUES (?)', (customer.email,))
+            self._owner = self._fetchone('SELECT id FROM customers WHERE email = ?', (customer.email,))[0]
+
+    def __contains__(self, website):
+        return self._url_key(website.url) is not None
+
+    def __len__(self):
+        return self._fetchone('SELECT COUNT(*) FROM websites WHERE customer = ?', (self._owner,))[0]
+
+    def get(self, website):
+        return self.get_by_url(website.url)
+
+    def get_by_url(self, url):
+        return None if self._url_key(url) is None else self._website(url)
+
+    def key(self, website):
+        return self._url_key(website.url)
+
+    def check_insert(self, websites):
+        # Websites are identified by url, so a customer can't have two with the same one
+        urls = [website.url for website in websites]
+        if len(set(urls)) != len(urls):
+            raise WebsiteAlreadyRegistered('Websites with repeated urls can\'t be stored')
+
+        for start in range(0, len(urls), self.CHECK_BATCH_SIZE):
+            batch = urls[start:start + self.CHECK_BATCH_SIZE]
+            placeholders = ', '.join('?' * len(batch))
+            row = self._fetchone(
+                'SELECT url FROM websites WHERE customer = ? AND url IN ({}) LIMIT 1'.format(placeholders),
+                [self._owner] + batch,
+            )
+            if row is not None:
+                raise WebsiteAlreadyRegistered('Website with url {} is already stored'.format(row[0]))
+
+    def insert(self, websites):
+        # A single transaction for the whole batch: either every website is stored or none is
+        with self._transaction():
+            self.connection.executemany(
+                'INSERT INTO websites (customer, url) VALUES (?, ?)',
+                ((self._owner, website.url) for website in websites),
+            )
+
+    def discard(self, website):
+        with self._transaction():
+            self.connection.execute(
+                'DELETE FROM websites WHERE customer = ? AND url = ?', (self._owner, website.url)
+            )
+
+    def bulk_discard(self, websites, keys=None):
+        # A single transaction for the whole batch, as on insert
+        with self._transaction():
+            if keys is not None:
+                self.connection.executemany('DELETE FROM websites WHERE key = ?', ((key,) for key in keys))
+                return
+
+            self.connection.executemany(
+                'DELETE FROM websites WHERE customer = ? AND url = ?',
+                ((self._owner, website.url) for website in websites),
+            )
+
+    def reindex_url(self, website, old_url):
+        self.check_insert([website])
+        with self._transaction():
+            self.connection.execute(
+                'UPDATE websites SET url = ? WHERE customer = ? AND url = ?', (website.url, self._owner, old_url)
+            )
+
+    def reindex_email(self, old_email):
+        try:
+            with self.lock, self.connection:
+                self.connection.execute(
+                    'UPDATE customers SET email = ? WHERE id = ?', (self.customer.email, self._owner)
+                )
+        except sqlite3.IntegrityError:
+            raise ValueError('A customer with the email {} already has websites on the database'.format(
+                self.customer.email
+            ))
+
+    def iterate(self, after=None):
+        key = -1 if after is None else after
+
+        while True:
+            # The lock is only held per batch, never while the batch is being consumed
+            with self.lock:
+                rows = self.connection.execute(
+                    'SELECT key, url FROM websites WHERE customer = ? AND key > ? ORDER BY key LIMIT ?',
+                    (self._owner, key, self.ITERATE_BATCH_SIZE),
+                ).fetchall()
+
+            for key, url in rows:
+                yield key, self._website(url)
+
+            if len(rows) < self.ITERATE_BATCH_SIZE:
+                return
+
+    def iterate_url(self, url, after=None):
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT key FROM websites WHERE customer = ? AND url = ? AND key > ? ORDER BY key',
+                (self._owner, url, -1 if after is None else after),
+            ).fetchall()
+        return ((key, self._website(url)) for key, in rows)
+
+    def close(self):
+        self.connection.close()
+
+    def _fetchone(self, query, parameters):
+        with self.lock:
+            return self.connection.execute(query, parameters).fetchone()
+
+    @contextmanager
+    def _transaction(self):
+        """Holds the connection lock over a transaction, raising WebsiteAlreadyRegistered for urls already stored."""
+        try:
+            with self.lock, self.connection:
+                yield
+        except sqlite3.IntegrityError as error:
+            raise WebsiteAlreadyRegistered('Websites with urls already stored can\'t be stored ({})'.format(error))
+
+    def _url_key(self, url):
+        """Returns the key of the stored website with the given url, or None."""
+        row = self._fetchone('SELECT key FROM websites WHERE customer = ? AND url = ?', (self._owner, url))
+        return None if row is None else row[0]
@@ -1,9 +1,59 @@
-from datetime import date
+import asyncio
+import csv
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
 from decimal import Decimal
-from unittest import mock, TestCase
+from unittest import mock, skipUnless, TestCase
 
-from .exceptions import CustomerAddWebsitePermissionDenied
+from . import benchmarks, importer, persistence, settings, utils
+from . import registry as registry_module
+from .aggregates import SubscriptionAggregates
+from .catalog import PlanCatalog
+from .events import EventBus
+from .hashers import PasswordHasher, is_password_hashed, password_hasher, verify_password
+from .exceptions import (
+    CustomerAddWebsitePermissionDenied, CustomerChangePlanPermissionDenied, InvalidWebsiteURL, ObjectDoesNotExist,
+    WebsiteAlreadyRegistered,
+)
+from .importer import Importer
+from .instrumentation import MemorySink, PrometheusSink, metrics, profile
+from .managers import WebsiteManager
 from .models import Customer, Plan, Website
+from .persistence import Journal, Snapshot, replay
+from .registry import CustomerRegistry
+from .renewals import RenewalIndex
+from .services import AsyncSubscriptionService
+from .signals import website_pre_url_change, websites_added, websites_pre_add, websites_removed
+from .storage import ArrayStorage, MemoryStorage, SQLiteStorage, WebsiteTable
+from .urls import URLIndex, normalize_url, registrable_domain
+
+# Customers hash their passwords when created, through the default hasher, whose cost is lowered for the tests
+iterations_patcher = mock.patch.object(password_hasher, 'iterations', 1)
+
+
+def setUpModule():
+    iterations_patcher.start()
+
+
+def tearDownModule():
+    iterations_patcher.stop()
+
+
+def create_customer(storage=None, total=5):
+    """Returns a customer subscribed to an infinite plan, with a total of websites kept on the given storage"""
+    customer = Customer('foo', 'bar', 'foo@bar.com', Plan('Infinite', 249.0, 'infinite'), storage)
+    customer.websites.bulk_add(Website('https://foo{}.bar'.format(i)) for i in range(total))
+    return customer
+
+
+def website_urls(websites):
+    return [website.url for website in websites]
 
 
 class CustomerTestCase(TestCase):
@@ -99,6 +149,41 @@ class CustomerTestCase(TestCase):
         self.assertFalse(website in customer_with_plan.websites.all())
         self.assertIsNone(website.customer)
 
+    def test_customer_website_lookups(self):
+        """Test Website lookups by identity and by url, made by Customer object"""
+        customer = Customer('foo', 'bar', 'foo@bar.com', Plan('Plus', 99.0, 'plus', total_websites_allowed=3))
+        website1 = Website('https://foo.bar', customer)
+        website2 = Website('https://bar.foo', customer)
+
+        self.assertTrue(website1 in customer.websites)
+        self.assertFalse(Website('https://foo.bar') in customer.websites)
+        self.assertEqual(customer.websites.get_by_url('https://bar.foo'), website2)
+
+        # The url index follows url changes made through the manager or straight on the website object
+        customer.websites.update(website1, url='https://example.com')
+        self.assertEqual(customer.websites.get_by_url('https://example.com'), website1)
+        with self.assertRaises(ObjectDoesNotExist):
+            customer.websites.get_by_url('https://foo.bar')
+
+        customer.websites.remove(website2)
+        with self.assertRaises(ObjectDoesNotExist):
+            customer.websites.get(website2)
+        with self.assertRaises(ObjectDoesNotExist):
+            customer.websites.remove(website2)
+
+    def test_customer_website_removals_keep_insertion_order(self):
+        """Test that removing websites keeps the remaining ones by insertion order"""
+        customer = Customer('foo', 'bar', 'foo@bar.com', Plan('Infinite', 249.0, 'infinite'))
+        websites = [Website('https://foo{}.bar'.format(i), customer) for i in range(500)]
+
+        # Removes enough websites to trigger, at least, one compaction of the websites list
+        for website in websites[:300:2] + websites[300:]:
+            customer.websites.remove(website)
+
+        self.assertEqual(list(customer.websites.all()), websites[1:300:2])
+        self.assertEqual(customer.websites.count(), 150)
+        self.assertEqual(customer.websites.get(websites[299]), websites[299])
+
     def test_customer_can_not_add_website_if_no_subscription(self):
         # self.customer = Customer('foo', 'bar', 'foo@bar.com')
         self.assertIsNone(self.customer.subscription)
@@ -107,6 +192,1669 @@ class CustomerTestCase(TestCase):
             self.customer.websites.add(Website('https://foo.bar'))
 
 
+class WebsiteQuerySetTestCase(TestCase):
+    def setUp(self):
+        self.customer = Customer('foo', 'bar', 'foo@bar.com', Plan('Infinite', 249.0, 'infinite'))
+        self.websites = [
+            Website('https://foo{}.bar'.format(i) if i % 2 else 'http://bar{}.foo'.format(i), self.customer)
+            for i in range(100)
+        ]
+
+    def test_query_is_lazy(self):
+        """Test that a query only reads the manager websites when iterated"""
+        with mock.patch.object(self.customer.websites.storage, 'iterate') as iterate:
+            query = self.customer.websites.filter(url__startswith='https://')[10:20]
+            iterate.assert_not_called()
+
+            iterate.return_value = iter([])
+            self.assertEqual(list(query), [])
+            iterate.assert_called_once_with(None)
+
+    def test_query_filter_and_slicing(self):
+        """Test filtering, slicing and the shortcut methods of a query"""
+        query = self.customer.websites.all()
+        https = query.filter(url__startswith='https://')
+
+        self.assertEqual(query.count(), 100)
+        self.assertEqual(query[95:200].count(), 5)
+        self.assertEqual(list(https[2:5]), self.websites[5:11:2])
+        self.assertEqual(list(https[2:5][1:]), self.websites[7:11:2])
+        self.assertEqual(list(query[95:]), self.websites[95:])
+        self.assertEqual(list(https[45:][2:]), self.websites[95::2])
+        self.assertEqual(https[3], self.websites[7])
+        self.assertEqual(https.count(), 50)
+        self.assertEqual(https.first(), self.websites[1])
+        self.assertEqual(query.filter(url='http://bar4.foo').first(), self.websites[4])
+        self.assertEqual(query.filter(lambda website: website.url.endswith('9.bar'), url__contains='foo').count(), 10)
+        self.assertTrue(self.websites[3] in https)
+        self.assertFalse(self.websites[4] in https)
+        self.assertFalse(query.filter(url__in=['https://example.com']).exists())
+
+        with self.assertRaises(IndexError):
+            https[50]
+        with self.assertRaises(TypeError):
+            query[:10].filter(url__contains='foo')
+        with self.assertRaises(ValueError):
+            query.filter(url__regex='foo')
+
+    def test_query_pagination(self):
+        """Test that pages are fetched after a cursor, even if websites are removed meanwhile"""
+        page, cursor = self.customer.websites.all().paginate(30)
+        self.assertEqual(page, self.websites[:30])
+
+        # Removes enough websites to compact the manager websites list between pages
+        for website in self.websites[:90]:
+            if website not in page:
+                self.customer.websites.remove(website)
+
+        page, cursor = self.customer.websites.all().paginate(30, cursor)
+        self.assertEqual(page, self.websites[90:])
+        self.assertIsNone(cursor)
+
+        page, cursor = self.customer.websites.filter(url__startswith='http:').paginate(5, cursor=10)
+        self.assertEqual(page, self.websites[12:21:2])
+
+        with self.assertRaises(ValueError):
+            self.customer.websites.all().paginate(0)
+
+
+class ArrayStorageTestCase(TestCase):
+    def setUp(self):
+        self.table = WebsiteTable()
+        self.customer = Customer('foo', 'bar', 'foo@bar.com', Plan('Infinite', 249.0, 'infinite'))
+        self.customer.websites = WebsiteManager(self.customer, ArrayStorage(self.table))
+
+    def test_models_have_no_instance_dict(self):
+        """Test that models are slotted, so they don't carry a per-instance __dict__"""
+        for obj in (self.customer, self.customer.subscription, Website('https://foo.bar')):
+            self.assertFalse(hasattr(obj, '__dict__'))
+
+    def test_array_storage_crud_operations(self):
+        """Test Website object crud operations, with the websites kept as arrays of interned urls"""
+        website = Website('https://foo.bar', self.customer)
+        self.customer.websites.add(*[Website('https://foo{}.bar'.format(i)) for i in range(200)])
+
+        self.assertEqual(self.customer.websites.count(), 201)
+        self.assertTrue(Website('https://foo.bar') in self.customer.websites)
+        self.assertEqual(self.customer.websites.get(website).url, 'https://foo.bar')
+        self.assertEqual(self.customer.websites.get_by_url('https://foo7.bar').customer, self.customer)
+
+        self.customer.websites.update(website, url='https://example.com')
+        self.assertEqual(self.customer.websites.all().first().url, 'https://example.com')
+        with self.assertRaises(ObjectDoesNotExist):
+            self.customer.websites.get_by_url('https://foo.bar')
+
+        for i in range(150):
+            self.customer.websites.remove(Website('https://foo{}.bar'.format(i)))
+
+        urls = [website.url for website in self.customer.websites.all()]
+        self.assertEqual(urls, ['https://example.com'] + ['https://foo{}.bar'.format(i) for i in range(150, 200)])
+        self.assertEqual(self.customer.websites.filter(url='https://foo160.bar').count(), 1)
+
+    def test_array_storage_shares_table_between_customers(self):
+        """Test that customers storing websites on the same table have urls interned once and can't share them"""
+        other_customer = Customer('bar', 'foo', 'bar@foo.com', Plan('Infinite', 249.0, 'infinite'))
+        other_customer.websites = WebsiteManager(other_customer, ArrayStorage(self.table))
+
+        website = Website('https://foo.bar', self.customer)
+        with self.assertRaises(WebsiteAlreadyRegistered):
+            other_customer.websites.add(Website('https://foo.bar'))
+
+        # Moving the website to another customer releases the url from the previous one
+        website.customer = other_customer
+        self.assertEqual(self.customer.websites.count(), 0)
+        self.assertEqual(other_customer.websites.get_by_url('https://foo.bar').customer, other_customer)
+        self.assertEqual(self.table.urls, ['https://foo.bar'])
+
+    def test_websites_which_cant_be_stored_stay_with_their_customer(self):
+        """Test that a website whose url is stored by another customer of the table isn't moved out of its own"""
+        other_customer = Customer('bar', 'foo', 'bar@foo.com', Plan('Infinite', 249.0, 'infinite'))
+        other_customer.websites = WebsiteManager(other_customer, ArrayStorage(self.table))
+        Website('https://foo.bar', other_customer)
+        website = Website('https://bar.foo', other_customer)
+        memory_customer = Customer('foobar', 'bar', 'foobar@bar.com', Plan('Infinite', 249.0, 'infinite'))
+        memory_website = Website('https://foo.bar', memory_customer)
+
+        with self.assertRaises(WebsiteAlreadyRegistered):
+            self.customer.websites.add(Website('https://foo1.bar'), memory_website)
+        with self.assertRaises(WebsiteAlreadyRegistered):
+            other_customer.websites.update(website, url='https://foo.bar')
+
+        self.assertIs(memory_website.customer, memory_customer)
+        self.assertIn(memory_website, memory_customer.websites)
+        self.assertEqual(self.customer.websites.count(), 0)
+        self.assertEqual(website.url, 'https://bar.foo')
+        urls = [website.url for website in other_customer.websites.all()]
+        self.assertEqual(urls, ['https://foo.bar', 'https://bar.foo'])
+
+
+class SQLiteStorageTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.database = os.path.join(directory.name, 'websites.sqlite3')
+
+        self.storage = SQLiteStorage(self.database)
+        self.addCleanup(self.storage.close)
+        self.customer = Customer('foo', 'bar', 'foo@bar.com', Plan('Plus', 99.0, 'plus', 3), websites=self.storage)
+
+    def test_sqlite_storage_crud_operations(self):
+        """Test Website object crud operations, with the websites kept on a SQLite database"""
+        website = Website('https://foo.bar', self.customer)
+        self.customer.websites.add(Website('https://bar.foo'))
+
+        self.assertEqual(self.customer.websites.count(), 2)
+        self.assertTrue(Website('https://bar.foo') in self.customer.websites)
+        self.assertEqual(self.customer.websites.get(website).url, 'https://foo.bar')
+
+        with self.assertRaises(CustomerAddWebsitePermissionDenied):
+            self.customer.websites.add(Website('https://foo.com'), Website('https://bar.com'))
+        self.assertEqual(self.customer.websites.count(), 2)
+
+        self.customer.websites.update(website, url='https://example.com')
+        self.customer.websites.remove(self.customer.websites.get_by_url('https://bar.foo'))
+        self.customer.websites.add(Website('https://foo.com'))
+
+        urls = [website.url for website in self.customer.websites.all()]
+        self.assertEqual(urls, ['https://example.com', 'https://foo.com'])
+        self.assertEqual(self.customer.websites.filter(url='https://foo.com').first().customer, self.customer)
+
+        # Websites are kept by customer on the database, so another customer doesn't see them
+        other_customer = Customer('bar', 'foo', 'bar@foo.com', websites=SQLiteStorage(self.storage.connection))
+        self.assertEqual(other_customer.websites.count(), 0)
+
+        # And they're still there once the database is opened again
+        storage = SQLiteStorage(self.database)
+        self.addCleanup(storage.close)
+        self.assertEqual(Customer('foo', 'bar', 'foo@bar.com', websites=storage).websites.count(), 2)
+
+    def test_sqlite_storage_pagination(self):
+        """Test that websites are paginated in batches from the database"""
+        self.customer.subscription = Plan('Infinite', 249.0, 'infinite')
+        self.storage.ITERATE_BATCH_SIZE = 7
+        websites = [Website('https://foo{}.bar'.format(i)) for i in range(30)]
+        self.customer.websites.bulk_add(websites)
+
+        page, cursor = self.customer.websites.all().paginate(20)
+        self.assertEqual([website.url for website in page], [website.url for website in websites[:20]])
+        page, cursor = self.customer.websites.all().paginate(20, cursor)
+        self.assertEqual([website.url for website in page], [website.url for website in websites[20:]])
+        self.assertIsNone(cursor)
+
+    def test_websites_with_a_stored_url_cant_be_added(self):
+        """Test that storages identifying websites by url don't drop other websites with a stored url"""
+        for storage in (self.storage, ArrayStorage()):
+            customer = Customer('bar', 'foo', 'bar@foo.com', Plan('Plus', 99.0, 'plus', 3), websites=storage)
+            customer.websites.add(Website('https://foo.bar'))
+
+            # The stored website is already there, while another one with its url can't be stored
+            customer.websites.add(customer.websites.get_by_url('https://foo.bar'))
+            website = Website('https://foo.bar')
+            with self.assertRaises(WebsiteAlreadyRegistered):
+                customer.websites.add(website)
+            with self.assertRaises(WebsiteAlreadyRegistered):
+                customer.websites.add(Website('https://bar.foo'), Website('https://bar.foo'))
+
+            other = Website('https://bar.foo', customer)
+            with self.assertRaises(WebsiteAlreadyRegistered):
+                other.url = 'https://foo.bar'
+
+            self.assertIsNone(website.customer)
+            self.assertEqual(other.url, 'https://bar.foo')
+            self.assertEqual(customer.websites.count(), 2)
+
+        # The database rejects them too, even if written without being checked first
+        with self.assertRaises(WebsiteAlreadyRegistered):
+            self.storage.insert([Website('https://foo.bar')])
+        self.assertEqual(customer.websites.count(), 2)
+
+    def test_sqlite_storage_is_used_from_other_threads(self):
+        """Test that customers sharing a database can be changed concurrently from a thread pool"""
+        customers = [
+            Customer('foo{}'.format(i), 'bar', 'foo{}@bar.com'.format(i), Plan('Infinite', 249.0, 'infinite'),
+                     websites=SQLiteStorage(self.storage.connection))
+            for i in range(4)
+        ]
+        service = AsyncSubscriptionService(executor=ThreadPoolExecutor(max_workers=4))
+        self.addCleanup(service.executor.shutdown)
+
+        async def operations():
+            return await asyncio.gather(*(
+                service.add_websites(customer, Website('https://foo{}.bar'.format(i)))
+                for customer in customers for i in range(25)
+            ), return_exceptions=True)
+
+        self.assertEqual(asyncio.run(operations()), [None] * 100)
+        self.assertEqual([customer.websites.count() for customer in customers], [25] * 4)
+
+    def test_websites_follow_email_changes(self):
+        """Test that websites stay with their customer once its email changes, and not with the email"""
+        Website('https://foo.bar', self.customer)
+        self.customer.email = 'bar@foo.com'
+
+        other_customer = Customer('bar', 'foo', 'foo@bar.com', websites=SQLiteStorage(self.storage.connection))
+        self.assertEqual(other_customer.websites.count(), 0)
+        storage = SQLiteStorage(self.database)
+        self.addCleanup(storage.close)
+        self.assertEqual(Customer('foo', 'bar', 'bar@foo.com', websites=storage).websites.count(), 1)
+
+        # Emails of other customers on the database are rejected
+        with self.assertRaises(ValueError):
+            self.customer.email = 'foo@bar.com'
+        self.assertEqual(self.customer.email, 'bar@foo.com')
+        self.assertEqual(self.customer.websites.count(), 1)
+
+    def test_sqlite_storage_counts_with_an_index(self):
+        """Test that counting a customer websites doesn't scan the websites table"""
+        plan = self.storage.connection.execute(
+            'EXPLAIN QUERY PLAN SELECT COUNT(*) FROM websites WHERE customer = ?', (self.storage._owner,)
+        ).fetchall()
+        self.assertIn('USING COVERING INDEX websites_customer_url', plan[0][-1])
+
+
+class RenewalIndexTestCase(TestCase):
+    def setUp(self):
+        self.plan = Plan('Single', 49.0, 'single')
+        self.customers = [Customer('foo{}'.format(i), 'bar', 'foo{}@bar.com'.format(i)) for i in range(6)]
+
+    def subscribe(self, customer, day, plan=None):
+        with mock.patch('subscription.models.date') as mock_date:
+            mock_date.today.return_value = day
+            customer.subscribe_plan(plan or self.plan)
+
+    def test_index_follows_subscription_changes(self):
+        """Test that the renewal index is kept up to date when customers subscriptions change"""
+        index = RenewalIndex(self.customers[:2])
+        self.assertEqual(len(index), 0)
+        self.subscribe(self.customers[0], date(2019, 3, 1))
+        self.subscribe(self.customers[1], date(2019, 3, 1))
+
+        self.assertEqual(index.due_on(date(2020, 3, 1)), self.customers[:2])
+
+        with mock.patch('subscription.models.date') as mock_date:
+            mock_date.today.return_value = date(2019, 5, 1)
+            self.customers[1].change_plan(Plan('Plus', 99.0, 'plus'))
+
+        self.assertEqual(index.due_on(date(2020, 3, 1)), self.customers[:1])
+        self.assertEqual(index.due_on(date(2020, 5, 1)), self.customers[1:2])
+
+        self.customers[0].subscription = None
+        self.assertFalse(self.customers[0] in index)
+        self.assertEqual(index.due_on(date(2020, 3, 1)), [])
+
+        self.customers[1].subscription_date = date(2019, 6, 1)
+        self.assertEqual(index.due_on(date(2020, 6, 1)), self.customers[1:2])
+        self.assertEqual(len(index), 1)
+
+    def test_index_due_between_and_pop_due(self):
+        """Test renewal queries over date ranges, by renewal date"""
+        days = [date(2018, 1, 10), date(2018, 1, 1), date(2018, 2, 1), date(2018, 1, 10), date(2018, 3, 1)]
+        for customer, day in zip(self.customers, days):
+            self.subscribe(customer, day)
+
+        # Customers subscribed before the index exists are added explicitly
+        index = RenewalIndex(self.customers)
+        self.assertEqual(len(index), 5)
+
+        due = index.due_between(date(2019, 1, 1), date(2019, 2, 1))
+        self.assertEqual(due, [self.customers[1], self.customers[0], self.customers[3], self.customers[2]])
+        self.assertEqual(index.due_between(date(2020, 1, 1), date(2020, 2, 1)), [])
+
+        self.assertEqual(index.pop_due(date(2019, 1, 10)), [self.customers[1], self.customers[0], self.customers[3]])
+        self.assertEqual(index.pop_due(date(2019, 1, 10)), [])
+        self.assertEqual(index.due_between(date(2018, 1, 1), date(2020, 1, 1)), [self.customers[2], self.customers[4]])
+
+        # Popped customers are still on the index once renewed
+        self.customers[1].subscription_date = date(2019, 3, 1)
+        self.assertEqual(index.due_on(date(2020, 3, 1)), [self.customers[1]])
+
+    def test_index_ignores_other_customers(self):
+        """Test that subscription changes of customers not on the index (or discarded from it) are ignored"""
+        index = RenewalIndex(self.customers[:2])
+        self.subscribe(self.customers[1], date(2019, 3, 1))
+        self.subscribe(self.customers[2], date(2019, 3, 1))
+        self.assertEqual(index.due_on(date(2020, 3, 1)), [self.customers[1]])
+
+        index.discard(self.customers[1])
+        self.customers[1].subscription_date = date(2019, 4, 1)
+        self.customers[2].subscription_date = date(2019, 4, 1)
+        self.subscribe(self.customers[3], date(2019, 4, 1))
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.due_between(date(2020, 1, 1), date(2020, 12, 31)), [])
+
+        index.add(self.customers[2])
+        self.assertEqual(index.due_on(date(2020, 4, 1)), [self.customers[2]])
+
+    def test_index_follows_concurrent_changes(self):
+        """Test that subscription changes signaled from many threads at once are all indexed"""
+        customers = [Customer('foo{}'.format(i), 'bar', 'foo{}@bar.com'.format(i), self.plan) for i in range(400)]
+        index = RenewalIndex(customers)
+        self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+        sys.setswitchinterval(1e-6)
+
+        def renew(customers):
+            for i, customer in enumerate(customers):
+                customer.subscription_date = date(2019, 3, 1) + timedelta(days=i % 7)
+                index.due_between(date(2020, 3, 1), date(2020, 3, 7))
+
+        threads = [threading.Thread(target=renew, args=(customers[i::8],)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(index), 400)
+        due = index.due_between(date(2020, 3, 1), date(2020, 3, 7))
+        self.assertEqual(sorted(map(id, due)), sorted(map(id, customers)))
+
+
+class RenewalDatesTestCase(TestCase):
+    def setUp(self):
+        # Every 7th day from 1999 until 2021, leap days included
+        self.days = [date(1999, 1, 1) + timedelta(days=i) for i in range(0, 8036, 7)] + [date(2000, 2, 29)]
+        self.customers = [Customer('foo', 'bar', 'foo@bar.com') for _ in self.days]
+
+        plan = Plan('Single', 49.0, 'single')
+        for customer, day in zip(self.customers, self.days):
+            customer.subscribe_plan(plan)
+            customer.subscription_date = day
+        self.customers.append(Customer('bar', 'foo', 'bar@foo.com'))
+
+    def assertSameAsProperty(self, use_numpy):
+        expected = [customer.sub_renewal_date for customer in self.customers]
+
+        self.assertEqual(utils.get_renewal_dates(self.customers, use_numpy=use_numpy), expected)
+        self.assertEqual(utils.get_renewal_dates(self.days + [None], use_numpy=use_numpy), expected)
+
+        with mock.patch.object(settings, 'SUBSCRIPTION_TTL_DAYS', 30, create=True):
+            expected = [customer.sub_renewal_date for customer in self.customers]
+            self.assertEqual(utils.get_renewal_dates(self.customers, use_numpy=use_numpy), expected)
+
+    def test_batch_renewal_dates(self):
+        """Test that renewal dates calculated at once are the same as the ones given by the customer property"""
+        self.assertSameAsProperty(use_numpy=False)
+
+    @skipUnless(utils.numpy, 'NumPy is not installed')
+    def test_batch_renewal_dates_with_numpy(self):
+        """Test that renewal dates calculated with NumPy are the same as the ones given by the customer property"""
+        self.assertSameAsProperty(use_numpy=True)
+
+
+class CustomerRegistryTestCase(TestCase):
+    def setUp(self):
+        self.single_plan = Plan('Single', 49.0, 'single')
+        self.other_single_plan = Plan('Single', 39.0, 'single')
+        self.infinite_plan = Plan('Infinite', 249.0, 'infinite')
+
+        self.customers = [Customer('foo{}'.format(i), 'bar', 'foo{}@bar.com'.format(i)) for i in range(4)]
+        self.customers[0].subscribe_plan(self.single_plan)
+        self.registry = CustomerRegistry(self.customers[:3])
+
+    def test_registry_lookup_by_email(self):
+        """Test that registered customers can be found by email, which has to be unique"""
+        self.assertEqual(self.registry.get('foo1@bar.com'), self.customers[1])
+        self.assertEqual(len(self.registry), 3)
+        self.assertEqual(list(self.registry), self.customers[:3])
+
+        with self.assertRaises(ValueError):
+            self.registry.add(Customer('bar', 'foo', 'foo2@bar.com'))
+
+        self.registry.remove(self.customers[1])
+        self.assertFalse(self.customers[1] in self.registry)
+        with self.assertRaises(ObjectDoesNotExist):
+            self.registry.get('foo1@bar.com')
+        with self.assertRaises(ObjectDoesNotExist):
+            self.registry.remove(self.customers[1])
+
+    def test_registry_follows_subscription_changes(self):
+        """Test that the plan indexes are kept up to date when registered customers subscriptions change"""
+        self.customers[1].subscribe_plan(self.other_single_plan)
+        self.customers[2].subscribe_plan(self.single_plan)
+        # Customers out of the registry are left out of the indexes
+        self.customers[3].subscribe_plan(self.single_plan)
+
+        self.assertEqual(self.registry.by_plan(self.single_plan), [self.customers[0], self.customers[2]])
+        self.assertEqual(self.registry.by_plan_type('single'), self.customers[:3])
+
+        # Migrating customers while iterating them
+        for customer in self.registry.by_plan_type('single'):
+            customer.change_plan(self.infinite_plan)
+
+        self.assertEqual(self.registry.by_plan(self.single_plan), [])
+        self.assertEqual(self.registry.count_by_plan_type('single'), 0)
+        self.assertEqual(self.registry.by_plan(self.infinite_plan), self.customers[:3])
+        self.assertEqual(self.registry.count_by_plan(self.infinite_plan), 3)
+
+        self.customers[0].subscription = None
+        self.registry.remove(self.customers[1])
+        self.assertEqual(self.registry.by_plan_type('infinite'), self.customers[2:3])
+
+    def test_registry_follows_email_changes(self):
+        """Test that the email index is kept up to date when registered customers emails change"""
+        other_registry = CustomerRegistry(self.customers[1:])
+        snapshot = self.registry.snapshot()
+        self.customers[1].email = 'bar1@foo.com'
+
+        for registry in (self.registry, other_registry):
+            self.assertIs(registry.get('bar1@foo.com'), self.customers[1])
+            with self.assertRaises(ObjectDoesNotExist):
+                registry.get('foo1@bar.com')
+        self.assertIs(snapshot.get('foo1@bar.com'), self.customers[1])
+
+        # An email of another registered customer is rejected, by any of the registries
+        for email in ('foo2@bar.com', 'foo3@bar.com'):
+            with self.assertRaises(ValueError):
+                self.customers[1].email = email
+            self.assertEqual(self.customers[1].email, 'bar1@foo.com')
+            self.assertIs(self.registry.get('bar1@foo.com'), self.customers[1])
+            self.assertIs(other_registry.get('bar1@foo.com'), self.customers[1])
+
+        self.registry.remove(self.customers[1])
+        self.registry.add(Customer('foo', 'bar', 'bar1@foo.com'))
+        self.assertEqual(len(self.registry), 3)
+
+
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        self.customer = Customer('foo', 'bar', 'foo@bar.com', Plan('Plus', 99.0, 'plus', total_websites_allowed=3))
+
+    def test_disabled_instrumentation_records_nothing(self):
+        """Test that, while there are no sinks, the hot paths don't record (nor time) anything"""
+        self.assertEqual(metrics.sinks, [])
+
+        with mock.patch.object(metrics, 'increment') as increment, mock.patch.object(metrics, 'observe') as observe, \
+                mock.patch.object(metrics, 'timer') as timer:
+            self.customer.websites.add(Website('https://foo.bar'), Website('https://bar.foo'))
+            with self.assertRaises(CustomerAddWebsitePermissionDenied):
+                self.customer.websites.add(Website('https://foo.foo'), Website('https://bar.bar'))
+            self.customer.websites.remove(self.customer.websites.get_by_url('https://foo.bar'))
+            self.customer.change_plan(Plan('Infinite', 249.0, 'infinite'))
+
+        increment.assert_not_called()
+        observe.assert_not_called()
+        timer.assert_not_called()
+
+    def test_sinks_collect_the_hot_paths_metrics(self):
+        """Test that registered sinks get the counters and latencies of the hot paths"""
+        sink = MemorySink()
+        metrics.add_sink(sink)
+        self.addCleanup(metrics.remove_sink, sink)
+
+        self.customer.websites.add(Website('https://foo.bar'), Website('https://bar.foo'))
+        with self.assertRaises(CustomerAddWebsitePermissionDenied):
+            self.customer.websites.add(Website('https://foo.foo'), Website('https://bar.bar'))
+        self.customer.websites.remove(self.customer.websites.get_by_url('https://foo.bar'))
+        self.customer.change_plan(Plan('Infinite', 249.0, 'infinite'))
+
+        self.assertEqual(sink.counters, {
+            'subscription_can_add_website_total': 2,
+            'subscription_websites_added_total': 2,
+            'subscription_websites_add_denied_total': 1,
+            'subscription_plan_changes_total': 1,
+        })
+        self.assertEqual(sink.histograms['subscription_websites_add_seconds'].count, 2)
+        self.assertEqual(sum(sink.histograms['subscription_websites_remove_seconds'].counts), 1)
+
+    def test_prometheus_sink_renders_the_text_exposition_format(self):
+        """Test that PrometheusSink renders the counters and histograms as Prometheus text"""
+        sink = PrometheusSink(buckets=(0.1, 1.0))
+        sink.increment('subscription_can_add_website_total', 3)
+        sink.observe('subscription_websites_add_seconds', 0.05)
+        sink.observe('subscription_websites_add_seconds', 0.5)
+
+        self.assertEqual(sink.render(), '\n'.join([
+            '# HELP subscription_can_add_website_total Customer.can_add_website calls',
+            '# TYPE subscription_can_add_website_total counter',
+            'subscription_can_add_website_total 3',
+            '# HELP subscription_websites_add_seconds WebsiteManager.add/bulk_add batches latency',
+            '# TYPE subscription_websites_add_seconds histogram',
+            'subscription_websites_add_seconds_bucket{le="0.1"} 1',
+            'subscription_websites_add_seconds_bucket{le="1.0"} 2',
+            'subscription_websites_add_seconds_bucket{le="+Inf"} 2',
+            'subscription_websites_add_seconds_sum 0.55',
+            'subscription_websites_add_seconds_count 2',
+        ]) + '\n')
+
+    def test_profile_collects_the_metrics_of_a_single_operation(self):
+        """Test that profile() collects the metrics of the code within it only"""
+        with profile(cprofile=True) as profiled:
+            self.customer.websites.add(Website('https://foo.bar'))
+
+        self.assertEqual(metrics.sinks, [])
+        self.assertEqual(profiled.counters['subscription_websites_added_total'], 1)
+        self.assertEqual(profiled.histograms['subscription_websites_add_seconds'].count, 1)
+        self.assertGreater(profiled.stats.total_calls, 0)
+
+
+class EventBusTestCase(TestCase):
+    def setUp(self):
+        self.single_plan = Plan('Single', 49.0, 'single')
+        self.plus_plan = Plan('Plus', 99.0, 'plus', total_websites_allowed=3)
+        self.customer = Customer('foo', 'bar', 'foo@bar.com')
+        self.batches = []
+
+    def create_bus(self, **kwargs):
+        bus = EventBus(**kwargs)
+        bus.subscribe(self.batches.append)
+        self.addCleanup(bus.close)
+        return bus
+
+    def test_changes_are_delivered_in_batches_of_batch_size(self):
+        """Test that changes are delivered in order, in batches of up to batch_size events"""
+        bus = self.create_bus(batch_size=2, flush_interval=None)
+        website = Website('https://foo.bar')
+
+        self.customer.subscribe_plan(self.plus_plan)
+        self.customer.websites.add(website)
+        self.assertEqual(len(self.batches), 1)
+
+        self.customer.websites.update(website, url='https://bar.foo')
+        self.customer.websites.update(website, customer=None)
+        self.customer.change_plan(self.single_plan)
+        self.assertEqual(len(bus), 1)
+
+        bus.flush()
+        events = [event for batch in self.batches for event in batch]
+        self.assertEqual([len(batch) for batch in self.batches], [2, 2, 1])
+        self.assertEqual([event.kind for event in events], [
+            'subscription_changed', 'websites_added', 'website_url_changed', 'websites_removed',
+            'subscription_changed',
+        ])
+        self.assertTrue(all(event.customer is self.customer for event in events))
+        # Websites are given by the urls they had then
+        self.assertEqual(events[1].data, {'urls': ['https://foo.bar']})
+        self.assertEqual(events[3].data, {'urls': ['https://bar.foo']})
+        self.assertEqual(events[2].data, {'website': website, 'old_url': 'https://foo.bar', 'url': 'https://bar.foo'})
+        self.assertIs(events[4].data['old_subscription'], self.plus_plan)
+        self.assertIs(events[4].data['subscription'], self.single_plan)
+
+    def test_pending_changes_are_coalesced(self):
+        """Test that pending changes of the same subscription (or url) are delivered as one event"""
+        bus = self.create_bus(flush_interval=None)
+        self.customer.subscribe_plan(self.single_plan)
+        website = Website('https://foo.bar', customer=self.customer)
+        bus.flush()
+
+        self.customer.change_plan(self.plus_plan)
+        website.url = 'https://bar.foo'
+        website.url = 'https://foobar.bar'
+        website.url = 'https://foo.bar'
+        self.customer.change_plan(Plan('Infinite', 249.0, 'infinite'))
+        bus.flush()
+
+        self.assertEqual(len(self.batches), 2)
+        self.assertEqual(len(self.batches[1]), 1)
+        self.assertIs(self.batches[1][0].data['old_subscription'], self.single_plan)
+        self.assertEqual(self.batches[1][0].data['subscription'].plan_type, 'infinite')
+
+    def test_coalesced_changes_keep_the_order_they_happened(self):
+        """Test that a coalesced event is delivered after the events queued since its first change"""
+        bus = self.create_bus(flush_interval=None)
+        self.customer.subscribe_plan(self.plus_plan)
+        website = Website('https://foo.bar', customer=self.customer)
+        bus.flush()
+
+        website.url = 'https://bar.foo'
+        self.customer.websites.add(Website('https://foobar.bar'))
+        website.url = 'https://barfoo.bar'
+        bus.flush()
+
+        self.assertEqual([event.kind for event in self.batches[1]], ['websites_added', 'website_url_changed'])
+        self.assertEqual(self.batches[1][1].data['old_url'], 'https://foo.bar')
+        self.assertEqual(self.batches[1][1].data['url'], 'https://barfoo.bar')
+
+    def test_background_thread_flushes_with_back_pressure(self):
+        """Test that the background thread delivers every change, blocking them past max_pending"""
+        def slow_subscriber(batch):
+            time.sleep(0.001)
+            pending.append(len(bus))
+
+        pending = []
+        self.customer.subscribe_plan(Plan('Infinite', 249.0, 'infinite'))
+        bus = self.create_bus(batch_size=10, flush_interval=0.01, max_pending=20)
+        bus.subscribe(slow_subscriber)
+
+        with bus:
+            for i in range(200):
+                self.customer.websites.add(Website('https://foo{}.bar'.format(i)))
+
+        events = [event for batch in self.batches for event in batch]
+        self.assertEqual(len(events), 200)
+        self.assertEqual([event.data['urls'][0] for event in events], [
+            'https://foo{}.bar'.format(i) for i in range(200)
+        ])
+        self.assertLessEqual(max(pending), 20)
+        self.assertTrue(all(len(batch) <= 10 for batch in self.batches))
+
+    def test_subscriber_failures_dont_stop_the_delivery(self):
+        """Test that a failing subscriber is logged, without stopping the batches delivery"""
+        bus = self.create_bus(flush_interval=None)
+        bus.subscribe(mock.Mock(side_effect=RuntimeError))
+        bus.subscribe(self.batches.append)
+
+        with self.assertLogs('subscription.events', level='ERROR'):
+            self.customer.subscribe_plan(self.single_plan)
+            bus.flush()
+
+        self.assertEqual(len(self.batches), 2)
+
+
+class URLIndexTestCase(TestCase):
+    def setUp(self):
+        plan = Plan('Infinite', 249.0, 'infinite')
+        self.foo = Customer('foo', 'bar', 'foo@bar.com', plan)
+        self.bar = Customer('bar', 'foo', 'bar@foo.com', plan)
+        self.website = Website('https://foo.bar', customer=self.foo)
+
+        self.index = URLIndex([self.foo])
+        self.addCleanup(self.index.close)
+
+    def test_normalize_url(self):
+        """Test that equivalent urls are normalized to the same one"""
+        self.assertEqual(normalize_url('HTTPS://Foo.Bar:443/A/?q=1#top'), 'https://foo.bar/A?q=1')
+        self.assertEqual(normalize_url('http://foo.bar:8080/'), 'http://foo.bar:8080')
+        self.assertEqual(normalize_url('Foo.bar/a/'), '//foo.bar/a')
+
+        for url in ('http://foo.bar:99999', 'http://foo.bar:port', 'http://[::1'):
+            with self.assertRaises(InvalidWebsiteURL):
+                normalize_url(url)
+
+        # Websites with those urls can't be added while they're indexed
+        with self.assertRaises(InvalidWebsiteURL):
+            self.foo.websites.add(Website('https://bar.foo'), Website('http://foo.bar:99999'))
+        self.assertEqual((self.foo.websites.count(), self.index._reserved), (1, {}))
+
+    def test_registrable_domain(self):
+        """Test that hosts are brought to the domain they were registered under"""
+        self.assertEqual(registrable_domain('www.blog.example.com'), 'example.com')
+        self.assertEqual(registrable_domain('www.example.co.uk'), 'example.co.uk')
+        self.assertEqual(registrable_domain('127.0.0.1'), '127.0.0.1')
+
+    def test_same_url_cant_be_registered_twice(self):
+        """Test that an url (or an equivalent one) can only be registered by one website"""
+        for customer in (self.foo, self.bar):
+            with self.assertRaises(WebsiteAlreadyRegistered):
+                Website('https://FOO.bar/', customer=customer)
+
+        with self.assertRaises(WebsiteAlreadyRegistered):
+            self.bar.websites.add(Website('https://bar.foo'), Website('https://bar.foo/'))
+
+        self.assertEqual(self.bar.websites.count(), 0)
+        self.assertIs(self.index.owner('https://foo.bar'), self.foo)
+
+    def test_index_follows_moves_removals_and_url_changes(self):
+        """Test that the index follows the websites moves, removals and url changes"""
+        self.website.customer = self.bar
+        self.assertIs(self.index.owner('https://foo.bar'), self.bar)
+
+        other = Website('https://bar.foo', customer=self.foo)
+        with self.assertRaises(WebsiteAlreadyRegistered):
+            other.url = 'https://foo.bar/'
+        self.assertEqual(other.url, 'https://bar.foo')
+
+        self.website.url = 'https://foobar.bar'
+        other.url = 'https://foo.bar'
+        self.bar.websites.remove(self.website)
+
+        self.assertIs(self.index.get('https://foo.bar'), other)
+        self.assertNotIn('https://foobar.bar', self.index)
+        self.assertEqual(len(self.index), 1)
+
+    def test_websites_under_domain(self):
+        """Test that the websites under a domain, subdomains included, are found"""
+        websites = [
+            Website(url, customer=self.bar)
+            for url in ('https://blog.foo.bar/a', 'http://www.blog.foo.bar', 'https://shop.foo.bar', 'https://bar.foo')
+        ]
+
+        self.assertEqual(self.index.under_domain('foo.bar'), [self.website] + websites[:3])
+        self.assertEqual(self.index.under_domain('https://blog.foo.bar'), websites[:2])
+        self.assertEqual(self.index.under_domain('other.bar'), [])
+
+    def test_concurrent_registrations_of_the_same_url(self):
+        """Test that only one of the customers adding the same url at the same time registers it"""
+        for trial in range(50):
+            url = 'https://concurrent{}.bar'.format(trial)
+            barrier = threading.Barrier(2)
+            results = []
+
+            def add_website(customer):
+                barrier.wait()
+                try:
+                    customer.websites.add(Website(url))
+                    results.append(customer)
+                except WebsiteAlreadyRegistered:
+                    pass
+
+            threads = [threading.Thread(target=add_website, args=(customer,)) for customer in (self.foo, self.bar)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            self.assertEqual(len(results), 1)
+            self.assertIs(self.index.owner(url), results[0])
+
+    def test_failed_changes_release_their_urls(self):
+        """Test that the urls checked for an addition or an url change which then fails can still be registered"""
+        def fail(**kwargs):
+            raise RuntimeError
+
+        for signal in (websites_pre_add, website_pre_url_change):
+            signal.connect(fail, weak=False)
+            self.addCleanup(signal.disconnect, fail)
+
+        with self.assertRaises(RuntimeError):
+            self.bar.websites.add(Website('https://bar.foo'))
+        with self.assertRaises(RuntimeError):
+            self.website.url = 'https://foobar.bar'
+
+        for signal in (websites_pre_add, website_pre_url_change):
+            signal.disconnect(fail)
+
+        self.foo.websites.add(Website('https://bar.foo'))
+        Website('https://foobar.bar', customer=self.bar)
+        self.assertIs(self.index.owner('https://bar.foo'), self.foo)
+        self.assertIs(self.index.owner('https://foobar.bar'), self.bar)
+
+    def test_array_storage_websites_can_be_moved(self):
+        """Test that websites read from an ArrayStorage can be moved to another customer"""
+        customer = Customer('foobar', 'bar', 'foobar@bar.com', Plan('Infinite', 249.0, 'infinite'), ArrayStorage())
+        customer.websites.add(Website('https://bar.foo'))
+
+        self.foo.websites.add(customer.websites.get_by_url('https://bar.foo'))
+        self.assertIs(self.index.owner('https://bar.foo'), self.foo)
+
+
+class PasswordHasherTestCase(TestCase):
+    def setUp(self):
+        self.hasher = PasswordHasher(iterations=1000)
+        self.customer = Customer('foo', 'bar', 'foo@bar.com')
+
+    def test_hash_and_verify(self):
+        """Test that passwords are hashed with a random salt, and verified against their hash"""
+        encoded = self.hasher.hash('bar')
+
+        self.assertTrue(encoded.startswith('pbkdf2_sha256$1000$'))
+        self.assertNotEqual(self.hasher.hash('bar'), encoded)
+        self.assertTrue(self.hasher.verify('bar', encoded))
+        self.assertFalse(self.hasher.verify('foo', encoded))
+        self.assertFalse(verify_password('bar', 'bar'))
+        self.assertTrue(verify_password('bar', 'bar', plain_text=True))
+
+    def test_customers_passwords_are_hashed_when_created(self):
+        """Test that customers are created with their passwords hashed, unless already hashed"""
+        self.assertTrue(is_password_hashed(self.customer.password))
+        self.assertTrue(self.customer.check_password('bar'))
+
+        encoded = self.hasher.hash('foobar')
+        self.assertEqual(Customer('foo', encoded, 'foo@bar.com').password, encoded)
+
+    def test_plain_text_passwords_are_verified_until_the_deadline(self):
+        """Test that passwords in plain text are only verified (and then hashed) until plain_text_until"""
+        self.customer.password = 'bar'
+        self.assertFalse(self.hasher.check_password(self.customer, 'bar'))
+
+        hasher = PasswordHasher(iterations=1000, plain_text_until=date.today() - timedelta(days=1))
+        self.assertFalse(hasher.check_password(self.customer, 'bar'))
+        self.assertEqual(self.customer.password, 'bar')
+
+        with mock.patch.object(settings, 'PLAIN_TEXT_PASSWORDS_UNTIL', date.today(), create=True):
+            self.assertFalse(self.hasher.check_password(self.customer, 'foo'))
+            self.assertTrue(self.hasher.check_password(self.customer, 'bar'))
+
+        self.assertTrue(self.customer.password.startswith('pbkdf2_sha256$1000$'))
+
+    def test_customer_passwords(self):
+        """Test that customers passwords are set and checked through the hasher"""
+        with mock.patch('subscription.models.password_hasher', self.hasher):
+            self.customer.set_password('foobar')
+
+            self.assertTrue(is_password_hashed(self.customer.password))
+            self.assertTrue(self.customer.check_password('foobar'))
+            self.assertFalse(self.customer.check_password('bar'))
+
+    def test_successful_verifications_are_cached(self):
+        """Test that successful verifications are cached until they expire"""
+        encoded = self.hasher.hash('bar')
+
+        with mock.patch('subscription.hashers.verify_password', wraps=verify_password) as verify:
+            for _ in range(3):
+                self.assertTrue(self.hasher.verify('bar', encoded))
+                self.assertFalse(self.hasher.verify('foo', encoded))
+
+            self.assertEqual(verify.call_count, 4)
+
+            with mock.patch('subscription.hashers.time.monotonic', return_value=time.monotonic() + 61):
+                self.assertTrue(self.hasher.verify('bar', encoded))
+            self.assertEqual(verify.call_count, 5)
+
+    def test_check_password_rehashes_outdated_passwords(self):
+        """Test that passwords in plain text or hashed with another cost are rehashed"""
+        self.customer.password = 'bar'
+        hasher = PasswordHasher(iterations=1000, plain_text_until=date.today())
+        self.assertTrue(hasher.check_password(self.customer, 'bar'))
+        self.assertTrue(self.customer.password.startswith('pbkdf2_sha256$1000$'))
+
+        PasswordHasher(iterations=2000).check_password(self.customer, 'bar')
+        self.assertTrue(self.customer.password.startswith('pbkdf2_sha256$2000$'))
+
+    def test_malformed_passwords_are_not_verified(self):
+        """Test that passwords with malformed iterations are neither verified nor rehashed, instead of raising"""
+        for encoded in ('pbkdf2_sha256$x$salt$hash', 'pbkdf2_sha256$$salt$hash', 'pbkdf2_sha256$-1$salt$hash'):
+            self.assertFalse(self.hasher.verify('bar', encoded))
+            self.assertTrue(self.hasher.needs_rehash(encoded))
+
+            self.customer.password = encoded
+            self.assertFalse(self.hasher.check_password(self.customer, 'bar'))
+            self.assertEqual(self.customer.password, encoded)
+
+    def test_default_hasher_runs_on_a_thread_pool(self):
+        """Test that the default hasher, used by customers, derives the keys off the caller thread"""
+        self.assertIsInstance(password_hasher.executor, ThreadPoolExecutor)
+
+        with mock.patch.object(password_hasher, 'iterations', 1000):
+            self.customer.set_password('foobar')
+            self.assertTrue(self.customer.check_password('foobar'))
+
+    def test_bulk_rehash_on_an_executor(self):
+        """Test that the passwords in plain text are hashed at once on an executor"""
+        customers = [Customer('foo', 'bar0', 'foo{}@bar.com'.format(i)) for i in range(10)]
+        # As loaded from older snapshots
+        for i, customer in enumerate(customers[1:], 1):
+            customer.password = 'bar{}'.format(i)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            hasher = PasswordHasher(iterations=1000, executor=executor)
+            self.assertEqual(hasher.bulk_rehash(customers), 9)
+            self.assertEqual(hasher.bulk_rehash(customers), 0)
+
+        self.assertTrue(all(
+            self.hasher.verify('bar{}'.format(i), customer.password) for i, customer in enumerate(customers)
+        ))
+
+    def test_async_entry_points(self):
+        """Test the async entry points of the hasher"""
+        async def authenticate():
+            await self.hasher.aset_password(self.customer, 'foobar')
+            return await self.hasher.acheck_password(self.customer, 'foobar'), await self.hasher.averify(
+                'bar', self.customer.password
+            )
+
+        self.assertEqual(asyncio.run(authenticate()), (True, False))
+
+
+class SnapshotTestCase(TestCase):
+    def setUp(self):
+        self.plan = Plan('Infinite', 249.0, 'infinite')
+
+    def test_snapshots_are_unaffected_by_later_changes(self):
+        """Test that snapshots of every storage keep the websites they were taken with"""
+        for storage_class in (MemoryStorage, ArrayStorage, SQLiteStorage):
+            with self.subTest(storage=storage_class.__name__):
+                customer = create_customer(storage_class())
+                snapshot = customer.websites.snapshot()
+
+                customer.websites.remove(customer.websites.get_by_url('https://foo1.bar'))
+                customer.websites.add(Website('https://bar.foo'))
+                customer.websites.get_by_url('https://foo3.bar').url = 'https://bar3.foo'
+
+                urls = ['https://foo{}.bar'.format(i) for i in range(5)]
+                if storage_class is MemoryStorage:
+                    # Website objects are still shared with the customer
+                    urls[3] = 'https://bar3.foo'
+                self.assertEqual(website_urls(snapshot), urls)
+                self.assertEqual(len(snapshot), 5)
+                self.assertEqual(snapshot.count(), 5)
+                self.assertEqual(website_urls(snapshot.filter(url__endswith='4.bar')), ['https://foo4.bar'])
+                self.assertEqual(customer.websites.count(), 5)
+
+                with self.assertRaises(NotImplementedError):
+                    snapshot.storage.insert([Website('https://foobar.bar')])
+
+    def test_snapshots_can_be_paginated(self):
+        """Test that snapshots are paginated as the manager itself"""
+        customer = create_customer()
+        snapshot = customer.websites.snapshot()
+        customer.websites.remove(customer.websites.get_by_url('https://foo0.bar'))
+
+        websites, cursor = snapshot.all().paginate(3)
+        self.assertEqual(website_urls(websites), ['https://foo0.bar', 'https://foo1.bar', 'https://foo2.bar'])
+        websites, cursor = snapshot.all().paginate(3, cursor)
+        self.assertEqual(website_urls(websites), ['https://foo3.bar', 'https://foo4.bar'])
+        self.assertIsNone(cursor)
+
+    def test_memory_storage_copies_only_the_pages_changed(self):
+        """Test that MemoryStorage only copies the pages changed after a snapshot"""
+        customer = create_customer(total=MemoryStorage.PAGE_SIZE * 3)
+        storage = customer.websites.storage
+        pages = list(storage.pages)
+
+        snapshot = customer.websites.snapshot()
+        self.assertIs(snapshot.storage.pages, storage.pages)
+
+        for website in list(customer.websites.all()[MemoryStorage.PAGE_SIZE:MemoryStorage.PAGE_SIZE + 10]):
+            customer.websites.remove(website)
+        customer.websites.add(Website('https://bar.foo'))
+
+        self.assertIs(snapshot.storage.pages[1], pages[1])
+        self.assertIsNot(storage.pages[1], pages[1])
+        self.assertIs(storage.pages[0], pages[0])
+        self.assertIs(storage.pages[2], pages[2])
+        self.assertEqual(len(snapshot), MemoryStorage.PAGE_SIZE * 3)
+        self.assertEqual(sum(1 for _ in snapshot), MemoryStorage.PAGE_SIZE * 3)
+
+    def test_registry_snapshot(self):
+        """Test that registry snapshots are unaffected by later registrations and plan changes"""
+        single_plan = Plan('Single', 49.0, 'single')
+        customers = [Customer('foo{}'.format(i), 'bar', 'foo{}@bar.com'.format(i), self.plan) for i in range(3)]
+        registry = CustomerRegistry(customers[:2])
+
+        snapshot = registry.snapshot()
+        registry.add(customers[2])
+        registry.remove(customers[0])
+        customers[1].change_plan(single_plan)
+
+        self.assertEqual(list(snapshot), customers[:2])
+        self.assertIs(snapshot.get('foo0@bar.com'), customers[0])
+        self.assertEqual(snapshot.by_plan(self.plan), customers[:2])
+        self.assertEqual(snapshot.count_by_plan_type('single'), 0)
+        self.assertEqual(registry.by_plan(self.plan), customers[2:])
+        self.assertEqual(registry.by_plan_type('single'), customers[1:2])
+        self.assertEqual(list(snapshot.websites(customers[0])), [])
+
+    def test_registry_changes_copy_only_the_buckets_touched(self):
+        """Test that changes after a registry snapshot copy the index buckets they change, not the whole indexes"""
+        customers = [Customer('foo{}'.format(i), 'bar', 'foo{}@bar.com'.format(i), self.plan) for i in range(1000)]
+        registry = CustomerRegistry(customers[:-1])
+
+        snapshot = registry.snapshot()
+        registry.add(customers[-1])
+
+        def copied(buckets, snapshot_buckets):
+            return [position for position, bucket in enumerate(buckets) if bucket is not snapshot_buckets[position]]
+
+        self.assertEqual(
+            copied(registry._customers, snapshot._customers), [registry_module._customer_bucket(customers[-1])]
+        )
+        self.assertEqual(copied(registry._emails, snapshot._emails), [registry_module._email_bucket('foo999@bar.com')])
+        self.assertEqual((len(snapshot), len(registry)), (999, 1000))
+        self.assertEqual(list(registry), customers)
+
+    def test_registry_follows_concurrent_changes(self):
+        """Test that changes signaled from many threads at once, while taking snapshots, are all indexed"""
+        single_plan = Plan('Single', 49.0, 'single')
+        customers = [Customer('foo{}'.format(i), 'bar', 'foo{}@bar.com'.format(i), self.plan) for i in range(400)]
+        registry = CustomerRegistry(customers)
+        self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+        sys.setswitchinterval(1e-6)
+
+        def change_plans(customers):
+            for customer in customers:
+                customer.change_plan(single_plan)
+                customer.email = 'bar-' + customer.email
+                registry.snapshot()
+
+        threads = [threading.Thread(target=change_plans, args=(customers[i::8],)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(registry.count_by_plan(single_plan), 400)
+        self.assertEqual(registry.count_by_plan(self.plan), 0)
+        self.assertTrue(all(registry.get('bar-' + customer.email[4:]) is customer for customer in customers))
+
+
+class PersistenceTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.snapshot_path = os.path.join(directory.name, 'customers.snapshot')
+        self.journal_path = os.path.join(directory.name, 'customers.journal')
+
+        self.plus_plan = Plan('Plus', 99.0, 'plus', total_websites_allowed=3)
+        self.infinite_plan = Plan('Infinite', 249.5, 'infinite')
+        self.customers = [Customer('foo{}'.format(i), 'bar', 'foo{}@bar.com'.format(i)) for i in range(20)]
+        for i, customer in enumerate(self.customers[:15]):
+            customer.subscribe_plan(self.plus_plan if i % 2 else self.infinite_plan)
+            customer.subscription_date = date(2019, 1, 1) + timedelta(days=i * 30)
+            customer.websites.add(Website('https://foo{}.bar'.format(i)), Website('https://bar{}.foo'.format(i)))
+
+    def assertSameState(self, customers, snapshot):
+        self.assertEqual(len(snapshot), len(customers))
+        for customer in customers:
+            loaded_customer = snapshot.get(customer.email)
+            self.assertEqual(loaded_customer.name, customer.name)
+            self.assertEqual(loaded_customer.sub_renewal_date, customer.sub_renewal_date)
+            self.assertEqual(
+                [website.url for website in loaded_customer.websites.all()],
+                [website.url for website in customer.websites.all()],
+            )
+            self.assertEqual(
+                [website.url for website in loaded_customer.websites.suspended()],
+                [website.url for website in customer.websites.suspended()],
+            )
+            if customer.subscription:
+                self.assertEqual(loaded_customer.subscription.price, customer.subscription.price)
+                self.assertEqual(loaded_customer.subscription.plan_type, customer.subscription.plan_type)
+            else:
+                self.assertIsNone(loaded_customer.subscription)
+
+    def test_snapshot_is_loaded_on_access(self):
+        """Test that a snapshot restores the customers it holds, decoding only the ones accessed"""
+        Snapshot.write(self.snapshot_path, self.customers)
+
+        with Snapshot(self.snapshot_path) as snapshot:
+            customer = snapshot.get('foo3@bar.com')
+            self.assertEqual(list(snapshot._loaded), ['foo3@bar.com'])
+            self.assertEqual(customer.websites.get_by_url('https://foo3.bar').customer, customer)
+            self.assertIsNone(snapshot.get('bar@foo.com'))
+            # Customers with the same plan share the same Plan object
+            self.assertIs(snapshot.get('foo5@bar.com').subscription, customer.subscription)
+
+            self.assertSameState(self.customers, snapshot)
+
+    def test_journal_replay(self):
+        """Test that replaying a journal over a snapshot reproduces the changes recorded by the journal"""
+        Snapshot.write(self.snapshot_path, self.customers)
+
+        with Journal(self.journal_path):
+            self.customers[0].change_plan(self.plus_plan)
+            self.customers[0].websites.remove(self.customers[0].websites.get_by_url('https://bar0.foo'))
+            website = self.customers[1].websites.get_by_url('https://foo1.bar')
+            self.customers[1].websites.update(website, url='https://x.y')
+            self.customers[2].websites.bulk_add(Website('https://foo{}.com'.format(i)) for i in range(100))
+            self.customers[16].subscribe_plan(self.infinite_plan)
+            self.customers[16].websites.add(Website('https://example.com'))
+
+            new_customer = Customer('new', 'bar', 'new@bar.com', self.plus_plan)
+            Website('https://new.com', new_customer)
+            self.customers.append(new_customer)
+
+        # Changes made once the journal is closed aren't recorded
+        subscription, subscription_date = self.customers[3].subscription, self.customers[3].subscription_date
+        self.customers[3].subscription = None
+
+        with Snapshot(self.snapshot_path) as snapshot:
+            self.assertEqual(replay(self.journal_path, snapshot), 13)
+
+            self.customers[3].subscription = subscription
+            self.customers[3].subscription_date = subscription_date
+            self.assertSameState(self.customers, snapshot)
+
+    def test_plans_without_a_limit_are_persisted(self):
+        """Test that plans allowing unlimited websites are written and read back, by snapshots and journals"""
+        self.customers[15].subscribe_plan(Plan('Inf', 1, 'infinite', None))
+        Snapshot.write(self.snapshot_path, self.customers)
+        with Journal(self.journal_path):
+            self.customers[16].subscribe_plan(Plan('Inf', 1, 'infinite', None))
+
+        with Snapshot(self.snapshot_path) as snapshot:
+            self.assertEqual(replay(self.journal_path, snapshot), 2)
+            self.assertSameState(self.customers, snapshot)
+            self.assertIsNone(snapshot.get('foo15@bar.com').subscription.total_websites_allowed)
+            self.assertIs(snapshot.get('foo16@bar.com').subscription, snapshot.get('foo15@bar.com').subscription)
+
+    def test_journal_replay_doesnt_check_the_quota(self):
+        """Test that changes recorded out of order, e.g. by different threads, are still replayed"""
+        Snapshot.write(self.snapshot_path, self.customers)
+        with Journal(self.journal_path):
+            self.customers[3].websites.remove(self.customers[3].websites.get_by_url('https://bar3.foo'))
+            self.customers[3].websites.add(Website('https://foo.com'), Website('https://bar.com'))
+
+        # The websites addition goes over the quota when replayed before the removal
+        with open(self.journal_path, 'rb') as journal_file:
+            journal = journal_file.read()
+        offset = len(persistence.JOURNAL_MAGIC)
+        records = []
+        while offset < len(journal):
+            length = persistence.UINT.unpack_from(journal, offset)[0] + persistence.UINT.size
+            records.append(journal[offset:offset + length])
+            offset += length
+        with open(self.journal_path, 'wb') as journal_file:
+            journal_file.write(persistence.JOURNAL_MAGIC + records[0] + records[2] + records[1])
+
+        with Snapshot(self.snapshot_path) as snapshot:
+            self.assertEqual(replay(self.journal_path, snapshot), 3)
+            self.assertSameState(self.customers, snapshot)
+
+    def test_journal_records_concurrent_changes(self):
+        """Test that changes of a customer recorded from several threads at once follow the customer details"""
+        Snapshot.write(self.snapshot_path, [])
+        customers = [Customer('bar{}'.format(i), 'foo', 'bar{}@foo.com'.format(i)) for i in range(10)]
+        for customer in customers:
+            customer.subscribe_plan(self.infinite_plan)
+        barrier = threading.Barrier(len(customers) * 2)
+
+        def change_subscription_date(customer):
+            barrier.wait()
+            customer.subscription_date = date(2019, 1, 1)
+
+        def add_websites(customer):
+            barrier.wait()
+            customer.websites.bulk_add(Website('https://{}.com'.format(i)) for i in range(20))
+
+        def slow_write(journal, *args):
+            # Lets other threads record meanwhile, between checking whether a customer was recorded and recording it
+            time.sleep(0.001)
+            write(journal, *args)
+
+        write = Journal._write
+        with mock.patch.object(Journal, '_write', slow_write), Journal(self.journal_path):
+            threads = [
+                threading.Thread(target=target, args=(customer,))
+                for customer in customers for target in (change_subscription_date, add_websites)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        with Snapshot(self.snapshot_path) as snapshot:
+            replay(self.journal_path, snapshot)
+            self.assertSameState(customers, snapshot)
+
+    def test_journal_replays_email_changes(self):
+        """Test that the changes of customers whose emails changed are replayed on the same customers"""
+        Snapshot.write(self.snapshot_path, self.customers)
+        registry = CustomerRegistry(self.customers)
+
+        with Journal(self.journal_path):
+            self.customers[0].email = 'bar0@foo.com'
+            self.customers[0].websites.add(Website('https://x.y'))
+            self.customers[0].email = 'foo0@bar.com'
+            self.customers[1].email = 'bar1@foo.com'
+            self.customers[1].change_plan(self.infinite_plan)
+
+            new_customer = Customer('new', 'bar', 'new@bar.com', self.plus_plan)
+            Website('https://new.com', new_customer)
+            new_customer.email = 'bar@foo.com'
+            new_customer.websites.add(Website('https://new.org'))
+            self.customers.append(new_customer)
+
+            # Changes rejected aren't recorded
+            with self.assertRaises(ValueError):
+                self.customers[2].email = 'foo3@bar.com'
+        self.assertIs(registry.get('bar1@foo.com'), self.customers[1])
+
+        with Snapshot(self.snapshot_path) as snapshot:
+            self.assertEqual(replay(self.journal_path, snapshot), 12)
+            self.assertNotIn('foo1@bar.com', snapshot)
+            self.assertIsNone(snapshot.get('new@bar.com'))
+            self.assertSameState(self.customers, snapshot)
+
+    def test_suspended_websites_are_persisted(self):
+        """Test that snapshots and journals restore the suspended websites, told apart even if they share urls"""
+        self.customers[0].websites.add(Website('https://x.y'), Website('https://foo0.bar'))
+        self.customers[0].change_plan(Plan('Single', 49.0, 'single'), over_quota='suspend')
+        Snapshot.write(self.snapshot_path, self.customers)
+
+        with Journal(self.journal_path):
+            self.customers[0].change_plan(self.plus_plan, over_quota='suspend')
+            self.customers[2].websites.add(Website('https://foo.com'))
+            self.customers[2].change_plan(Plan('Single', 49.0, 'single'), over_quota='suspend')
+
+        with Snapshot(self.snapshot_path) as snapshot:
+            self.assertEqual(replay(self.journal_path, snapshot), 7)
+            self.assertSameState(self.customers, snapshot)
+            loaded_customer = snapshot.get('foo0@bar.com')
+            self.assertEqual(list(loaded_customer.websites.suspended()), [loaded_customer.websites.all()[3]])
+
+    def test_snapshots_without_suspended_websites_are_loaded(self):
+        """Test that snapshots written before suspended websites were persisted are still loaded"""
+        with mock.patch.object(persistence, 'SNAPSHOT_MAGIC', b'SUBSNAP1'), \
+                mock.patch.object(persistence, '_pack_positions', lambda positions: b''):
+            Snapshot.write(self.snapshot_path, self.customers)
+
+        with Snapshot(self.snapshot_path) as snapshot:
+            self.assertSameState(self.customers, snapshot)
+
+    def test_journal_replay_ignores_partially_written_record(self):
+        """Test that a record partially written, e.g. by a crash, isn't replayed"""
+        Snapshot.write(self.snapshot_path, self.customers)
+        with Journal(self.journal_path):
+            self.customers[4].websites.remove(self.customers[4].websites.get_by_url('https://bar4.foo'))
+            self.customers[4].websites.add(Website('https://foo.com'))
+
+        with open(self.journal_path, 'rb+') as journal_file:
+            journal_file.truncate(os.path.getsize(self.journal_path) - 1)
+
+        with Snapshot(self.snapshot_path) as snapshot:
+            self.assertEqual(replay(self.journal_path, snapshot), 2)
+            urls = [website.url for website in snapshot.get('foo4@bar.com').websites.all()]
+            self.assertEqual(urls, ['https://foo4.bar'])
+
+
+class AsyncSubscriptionServiceTestCase(TestCase):
+    def setUp(self):
+        self.plus_plan = Plan('Plus', 99.0, 'plus', total_websites_allowed=3)
+        self.customers = [Customer('foo{}'.format(i), 'bar', 'foo{}@bar.com'.format(i)) for i in range(3)]
+
+    def test_service_operations(self):
+        """Test the subscriptions and websites operations through the async service"""
+        service = AsyncSubscriptionService()
+        website = Website('https://foo.bar')
+
+        async def operations():
+            await service.subscribe_plan(self.customers[0], self.plus_plan)
+            await service.add_websites(self.customers[0], website, Website('https://bar.foo'))
+            await service.remove_website(self.customers[0], website)
+            self.assertTrue(await service.change_plan(self.customers[0], Plan('Infinite', 249.0, 'infinite')))
+
+        asyncio.run(operations())
+        self.assertEqual(self.customers[0].subscription.plan_type, 'infinite')
+        self.assertEqual([website.url for website in self.customers[0].websites.all()], ['https://bar.foo'])
+        self.assertEqual(service._locks, {})
+
+    def test_service_serializes_operations_by_customer(self):
+        """Test that operations on one customer run one at a time, while different customers run concurrently"""
+        running = {customer.email: 0 for customer in self.customers}
+        max_running = dict(running)
+
+        def slow_subscribe_plan(customer, plan):
+            running[customer.email] += 1
+            max_running[customer.email] = max(max_running[customer.email], running[customer.email])
+            time.sleep(0.02)
+            customer.subscription = plan
+            running[customer.email] -= 1
+
+        service = AsyncSubscriptionService(executor=ThreadPoolExecutor(max_workers=8))
+        self.addCleanup(service.executor.shutdown)
+
+        async def operations():
+            await asyncio.gather(*(
+                service._run(customer, slow_subscribe_plan, customer, self.plus_plan)
+                for customer in self.customers for _ in range(4)
+            ))
+
+        start = time.perf_counter()
+        asyncio.run(operations())
+
+        self.assertEqual(max_running, {customer.email: 1 for customer in self.customers})
+        # 3 customers with 4 operations each take, at least, 4 sequential operations and less than 12
+        self.assertLess(time.perf_counter() - start, 0.2)
+
+    def test_service_bulk_add_websites(self):
+        """Test that websites are added to many customers at once, with errors returned by customer"""
+        for customer in self.customers:
+            customer.subscribe_plan(self.plus_plan)
+
+        service = AsyncSubscriptionService()
+        items = [
+            (customer, [Website('https://foo{}-{}.bar'.format(i, j)) for j in range(i + 2)])
+            for i, customer in enumerate(self.customers)
+        ]
+
+        results = asyncio.run(service.bulk_add_websites(items))
+
+        self.assertEqual(results[:2], [None, None])
+        self.assertIsInstance(results[2], CustomerAddWebsitePermissionDenied)
+        self.assertEqual([customer.websites.count() for customer in self.customers], [2, 3, 0])
+
+
+class ImporterTestCase(TestCase):
+    ROWS = [
+        ['foo@bar.com', 'foo', 'bar', 'Plus', '99.0', 'plus', '3', 'https://foo1.bar'],
+        ['foo@bar.com', 'foo', 'bar', 'Plus', '99.0', 'plus', '3', 'https://foo2.bar'],
+        ['bar@foo.com', 'bar', 'foo', 'Single', '49.0', 'single', '', 'https://bar1.foo'],
+        ['bar@foo.com', 'bar', 'foo', 'Single', '49.0', 'single', '', 'https://bar2.foo'],
+        ['foo@bar.com', 'foo', 'bar', 'Plus', '99.0', 'plus', '3', 'https://foo3.bar'],
+        ['foo@bar.com', 'foo', 'bar', 'Plus', '99.0', 'plus', '3', 'https://foo4.bar'],
+        ['new@foo.com', 'new', 'foo', 'Gold', '99.0', 'gold', '1', 'https://new.foo'],
+        ['new@foo.com', 'new', 'foo', 'Single', '49.0', 'single', '2', 'https://new.foo'],
+        ['new@foo.com', 'new', 'foo', 'Single', 'free', 'single', '1', 'https://new.foo'],
+        ['bar@foo.com', 'bar', 'foo', 'Plus', '99.0', 'plus', '3', 'https://bar3.foo'],
+        ['inf@bar.com', 'inf', 'bar', 'Infinite', '249.0', 'infinite', '', ''],
+        ['', 'nobody', 'bar', 'Single', '49.0', 'single', '1', 'https://nobody.bar'],
+    ]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.csv_path = os.path.join(directory.name, 'customers.csv')
+        self.jsonl_path = os.path.join(directory.name, 'customers.jsonl')
+        self.reject_path = os.path.join(directory.name, 'rejects.jsonl')
+
+        with open(self.csv_path, 'w', newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(importer.FIELDS)
+            writer.writerows(self.ROWS)
+
+        with open(self.jsonl_path, 'w') as jsonl_file:
+            for row in self.ROWS:
+                jsonl_file.write(json.dumps(dict(zip(importer.FIELDS, row))) + '\n')
+            jsonl_file.write('{not json\n')
+
+    def assertImported(self, registry, rejected_lines):
+        foo, bar, inf = registry.get('foo@bar.com'), registry.get('bar@foo.com'), registry.get('inf@bar.com')
+        self.assertEqual(len(registry), 3)
+        self.assertEqual(
+            [website.url for website in foo.websites.all()], ['https://foo1.bar', 'https://foo2.bar', 'https://foo3.bar']
+        )
+        self.assertEqual([website.url for website in bar.websites.all()], ['https://bar1.foo'])
+        self.assertEqual(inf.subscription.plan_type, 'infinite')
+
+        with open(self.reject_path) as reject_file:
+            rejects = [json.loads(line) for line in reject_file]
+        self.assertEqual([reject['line'] for reject in rejects], rejected_lines)
+        self.assertEqual(rejects[0]['row']['url'], 'https://bar2.foo')
+        self.assertIn('plan type', rejects[2]['error'])
+
+    def test_import_csv(self):
+        """Test that valid rows are imported, while the invalid ones are written to the reject file"""
+        rows_importer = Importer(reject_path=self.reject_path, processes=0, chunk_size=4)
+
+        self.assertEqual(rows_importer.import_file(self.csv_path), (5, 7))
+        self.assertImported(rows_importer.registry, [5, 7, 8, 9, 10, 11, 13])
+
+    def test_imported_passwords_are_hashed_at_once(self):
+        """Test that the passwords of the customers created by each chunk are hashed at once, through the hasher"""
+        hasher = PasswordHasher(iterations=1000)
+        rows_importer = Importer(processes=0, chunk_size=4, hasher=hasher)
+
+        with mock.patch.object(hasher, 'bulk_hash', wraps=hasher.bulk_hash) as bulk_hash:
+            rows_importer.import_file(self.csv_path)
+
+        self.assertEqual([list(call.args[0]) for call in bulk_hash.call_args_list], [['bar', 'foo'], [], ['bar']])
+        for email, password in (('foo@bar.com', 'bar'), ('bar@foo.com', 'foo'), ('inf@bar.com', 'bar')):
+            encoded = rows_importer.registry.get(email).password
+            self.assertTrue(encoded.startswith('pbkdf2_sha256$1000$') and hasher.verify(password, encoded))
+
+    def test_import_jsonl_on_process_pool(self):
+        """Test that rows parsed on a process pool are imported in the same way, in the file order"""
+        rows_importer = Importer(reject_path=self.reject_path, processes=2, chunk_size=3)
+
+        self.assertEqual(rows_importer.import_file(self.jsonl_path), (5, 8))
+        self.assertImported(rows_importer.registry, [4, 6, 7, 8, 9, 10, 12, 13])
+
+    def test_import_jsonl_values_which_arent_strings(self):
+        """Test that JSON lines values are imported whatever their type, e.g. free plans with a plan_price of 0"""
+        rows = [
+            ['free@bar.com', 'free', 'bar', 'Free', 0, 'single', 1, 'https://free.bar'],
+            ['half@bar.com', 'half', 1234, 'Half', 49.5, 'plus', None, 'https://half.bar'],
+            ['none@bar.com', 'none', 'bar', 'Free', None, 'single', 1, 'https://none.bar'],
+        ]
+        with open(self.jsonl_path, 'w') as jsonl_file:
+            for row in rows:
+                jsonl_file.write(json.dumps(dict(zip(importer.FIELDS, row))) + '\n')
+
+        rows_importer = Importer(reject_path=self.reject_path, processes=0)
+
+        self.assertEqual(rows_importer.import_file(self.jsonl_path), (2, 1))
+        free, half = rows_importer.registry.get('free@bar.com'), rows_importer.registry.get('half@bar.com')
+        self.assertEqual(free.subscription.price, Decimal(0))
+        self.assertEqual([website.url for website in free.websites.all()], ['https://free.bar'])
+        self.assertEqual((half.subscription.price, half.subscription.total_websites_allowed), (Decimal('49.5'), 1))
+        self.assertTrue(half.check_password('1234'))
+        with open(self.reject_path) as reject_file:
+            self.assertEqual(json.loads(reject_file.read())['error'], 'Missing fields: plan_price')
+
+    def test_websites_registered_by_other_customers_are_rejected(self):
+        """Test that rows with an url registered by another customer are rejected, without aborting the import"""
+        customer = Customer('other', 'bar', 'other@bar.com', Plan('Infinite', 249.0, 'infinite'))
+        customer.websites.add(Website('https://foo2.bar'))
+        index = URLIndex([customer])
+        self.addCleanup(index.close)
+
+        rows_importer = Importer(reject_path=self.reject_path, processes=0, chunk_size=4)
+
+        # The website rejected leaves room, on the customer plan quota, for the next one
+        self.assertEqual(rows_importer.import_file(self.csv_path), (5, 7))
+        foo = rows_importer.registry.get('foo@bar.com')
+        urls = [website.url for website in foo.websites.all()]
+        self.assertEqual(urls, ['https://foo1.bar', 'https://foo3.bar', 'https://foo4.bar'])
+        self.assertIs(index.owner('https://foo2.bar'), customer)
+
+        with open(self.reject_path) as reject_file:
+            rejects = [json.loads(line) for line in reject_file]
+        self.assertEqual(rejects[0]['line'], 3)
+        self.assertIn('already registered', rejects[0]['error'])
+
+    def test_invalid_urls_are_rejected(self):
+        """Test that rows with urls which can't be parsed are rejected, without aborting the import"""
+        index = URLIndex()
+        self.addCleanup(index.close)
+        rows = [
+            (line, dict(zip(importer.FIELDS, ['foo@bar.com', 'foo', 'bar', 'Plus', '99.0', 'plus', '3', url])))
+            for line, url in enumerate(('https://foo.bar', 'http://foo.com:99999', 'https://bar.foo'), 2)
+        ]
+
+        rows_importer = Importer(reject_path=self.reject_path, processes=0)
+
+        self.assertEqual(rows_importer.import_rows(rows), (2, 1))
+        with open(self.reject_path) as reject_file:
+            self.assertIn('Port out of range', json.loads(reject_file.read())['error'])
+
+        # Urls are checked by the websites additions as well
+        customer = rows_importer.registry.get('foo@bar.com')
+        self.assertEqual(rows_importer._add_websites(customer, [(5, {}, 'http://[::1')])[0][0], 5)
+        self.assertEqual(customer.websites.count(), 2)
+
+
+class BenchmarksTestCase(TestCase):
+    def test_suite_cases_run_and_report_their_metrics(self):
+        """Test that every suite case runs and reports its time and memory metrics"""
+        for case, setup in benchmarks.SUITE.items():
+            metrics = benchmarks.run_case(setup, 10, repeat=1, min_time=0)
+            self.assertEqual(
+                set(metrics), {'time', 'time_per_operation', 'runs', 'peak_memory', 'allocated_blocks'}, case
+            )
+
+    def test_compare_flags_regressions_over_the_tolerance(self):
+        """Test that only the metrics grown over both the tolerance and the noise floor are flagged as regressions"""
+        baseline = {
+            'websites_add': {'1000': {'time_per_operation': 1e-6, 'peak_memory': 100}},
+            'websites_get': {'1000': {'time_per_operation': 1e-6, 'peak_memory': 100}},
+        }
+        results = {
+            'websites_add': {
+                '1000': {'time_per_operation': 1.2e-6, 'peak_memory': 2000},
+                '10000': {'time_per_operation': 1e-5, 'peak_memory': 1000},
+            },
+            # Twice as slow, but by less than the noise floor
+            'websites_get': {'1000': {'time_per_operation': 1.4e-6, 'peak_memory': 100}},
+            'change_plan': {'1000': {'time_per_operation': 1e-6, 'peak_memory': 100}},
+        }
+
+        self.assertEqual(
+            benchmarks.compare(results, baseline, 0.25), [('websites_add', '1000', 'peak_memory', 2000, 100)]
+        )
+        self.assertEqual(
+            benchmarks.compare(results, baseline, 0.25, {'time_per_operation': 0.1e-6, 'peak_memory': 0}), [
+                ('websites_add', '1000', 'peak_memory', 2000, 100),
+                ('websites_get', '1000', 'time_per_operation', 1.4e-6, 1e-6),
+            ]
+        )
+
+
+class SubscriptionAggregatesTestCase(TestCase):
+    def setUp(self):
+        self.single_plan = Plan('Single', 49.0, 'single')
+        self.plus_plan = Plan('Plus', 99.0, 'plus', total_websites_allowed=3)
+        self.customers = [
+            Customer('foo', 'bar', 'foo@bar.com', self.single_plan),
+            Customer('bar', 'foo', 'bar@foo.com', self.plus_plan),
+            Customer('foobar', 'bar', 'foobar@bar.com'),
+        ]
+        self.customers[1].websites.add(Website('https://foo.bar'), Website('https://bar.foo'))
+        self.aggregates = SubscriptionAggregates(self.customers)
+
+    def test_aggregates_of_the_initial_customers(self):
+        """Test the aggregates of the customers given when created"""
+        self.assertEqual(self.aggregates.revenue, Decimal('148'))
+        self.assertEqual(self.aggregates.mrr, Decimal('148') / 12)
+        self.assertEqual(self.aggregates.customers_by_plan_type, {'single': 1, 'plus': 1})
+        self.assertEqual(self.aggregates.customers_by_plan, {self.single_plan: 1, self.plus_plan: 1})
+        self.assertEqual(self.aggregates.websites_by_plan, {self.plus_plan: 2})
+
+    def test_aggregates_follow_subscriptions_and_websites_changes(self):
+        """Test that aggregates follow the subscriptions and websites changes"""
+        self.customers[1].change_plan(self.single_plan, over_quota='suspend')
+        self.customers[2].subscribe_plan(self.plus_plan)
+        website = Website('https://foobar.bar', customer=self.customers[2])
+        self.customers[0].websites.add(website)
+        self.customers[2].websites.add(Website('https://barfoo.bar'))
+        Customer('other', 'bar', 'other@bar.com', self.plus_plan).websites.add(Website('https://other.bar'))
+
+        self.assertEqual(self.aggregates.revenue, Decimal('197'))
+        self.assertEqual(self.aggregates.customers_by_plan_type, {'single': 2, 'plus': 1})
+        self.assertEqual(self.aggregates.websites_by_plan, {self.single_plan: 3, self.plus_plan: 1})
+        self.assertEqual(self.aggregates.audit(self.customers), {})
+
+    def test_discarded_customers_are_no_longer_aggregated(self):
+        """Test that the changes of discarded customers are no longer aggregated"""
+        self.aggregates.discard(self.customers[1])
+        self.customers[1].websites.add(Website('https://foobar.bar'))
+
+        self.assertEqual(self.aggregates.revenue, Decimal('49'))
+        self.assertEqual(self.aggregates.websites_by_plan, {})
+        self.assertEqual(self.aggregates.audit([self.customers[0], self.customers[2]]), {})
+
+    def test_audit_reports_drift(self):
+        """Test that audit reports the aggregates drifted by changes the signals don't cover"""
+        self.plus_plan.price = Decimal('109')
+
+        self.assertEqual(self.aggregates.audit(self.customers), {'revenue': (Decimal('148'), Decimal('158'))})
+
+
+class ChangePlanOverQuotaTestCase(TestCase):
+    def setUp(self):
+        self.single_plan = Plan('Single', 49.0, 'single')
+        self.plus_plan = Plan('Plus', 99.0, 'plus', total_websites_allowed=3)
+
+    def test_downgrade_over_quota_is_rejected_by_default(self):
+        """Test that changing to a plan the websites don't fit in is rejected by default"""
+        customer = create_customer()
+
+        with self.assertRaises(CustomerChangePlanPermissionDenied):
+            customer.change_plan(self.plus_plan)
+
+        self.assertEqual(customer.subscription.plan_type, 'infinite')
+        self.assertEqual(customer.websites.count(), 5)
+
+    def test_downgrade_trims_the_websites_over_quota_at_once(self):
+        """Test that the oldest or newest websites over the quota are removed at once"""
+        receiver = mock.Mock()
+        websites_removed.connect(receiver, weak=False)
+        self.addCleanup(websites_removed.disconnect, receiver)
+
+        for storage_class in (MemoryStorage, ArrayStorage, SQLiteStorage):
+            for policy, kept in (('trim_oldest', [2, 3, 4]), ('trim_newest', [0, 1, 2])):
+                with self.subTest(storage=storage_class.__name__, policy=policy):
+                    customer = create_customer(storage_class())
+                    receiver.reset_mock()
+
+                    customer.change_plan(self.plus_plan, over_quota=policy)
+
+                    self.assertIs(customer.subscription, self.plus_plan)
+                    self.assertEqual(
+                        website_urls(customer.websites.all()), ['https://foo{}.bar'.format(i) for i in kept]
+                    )
+                    self.assertEqual(receiver.call_count, 1)
+                    self.assertEqual(len(receiver.call_args[1]['websites']), 2)
+
+    def test_downgrade_suspends_the_newest_websites_over_quota(self):
+        """Test that the newest websites over the quota are suspended, and later resumed"""
+        customer = create_customer()
+
+        customer.change_plan(self.single_plan, over_quota='suspend')
+
+        self.assertEqual(customer.websites.count(), 5)
+        self.assertEqual(
+            website_urls(customer.websites.suspended()), ['https://foo{}.bar'.format(i) for i in range(1, 5)]
+        )
+        self.assertFalse(customer.websites.is_suspended(customer.websites.get_by_url('https://foo0.bar')))
+        self.assertFalse(customer.can_add_website())
+
+        customer.websites.remove(customer.websites.get_by_url('https://foo4.bar'))
+        customer.websites.get_by_url('https://foo3.bar').url = 'https://bar3.foo'
+        self.assertEqual(
+            website_urls(customer.websites.suspended()), ['https://foo1.bar', 'https://foo2.bar', 'https://bar3.foo']
+        )
+
+        # Upgrading resumes the suspended websites within the new quota
+        customer.change_plan(self.plus_plan, over_quota='suspend')
+        self.assertEqual(website_urls(customer.websites.suspended()), ['https://bar3.foo'])
+        customer.change_plan(Plan('Infinite', 249.0, 'infinite'))
+        self.assertEqual(list(customer.websites.suspended()), [])
+
+    def test_websites_sharing_an_url_are_told_apart(self):
+        """Test that only the websites over the quota are suspended or trimmed, even if they share their url"""
+        customer = Customer('foo', 'bar', 'foo@bar.com', Plan('Infinite', 249.0, 'infinite'))
+        websites = [Website('https://foo.bar', customer), Website('https://foo.bar', customer)]
+
+        customer.change_plan(self.single_plan, over_quota='suspend')
+        self.assertFalse(customer.websites.is_suspended(websites[0]))
+        self.assertTrue(customer.websites.is_suspended(websites[1]))
+        self.assertEqual(list(customer.websites.suspended()), websites[1:])
+
+    def test_trimmed_websites_are_unlinked_from_the_customer(self):
+        """Test that websites trimmed from storages creating Website objects when read are unlinked too"""
+        for storage_class in (ArrayStorage, SQLiteStorage):
+            with self.subTest(storage=storage_class.__name__):
+                customer = Customer('foo', 'bar', 'foo@bar.com', Plan('Infinite', 249.0, 'infinite'), storage_class())
+                websites = [Website('https://foo{}.bar'.format(i), customer) for i in range(5)]
+
+                customer.change_plan(self.plus_plan, over_quota='trim_oldest')
+
+                self.assertEqual([website.customer for website in websites], [None, None] + [customer] * 3)
+                websites[4].customer = None
+                websites[0].customer = customer
+                self.assertEqual(
+                    website_urls(customer.websites.all()), ['https://foo{}.bar'.format(i) for i in (2, 3, 0)]
+                )
+
+    def test_quota_is_only_enforced_when_needed(self):
+        """Test that changing to a plan the websites fit in doesn't go through the websites"""
+        customer = create_customer()
+
+        with mock.patch.object(customer.websites, 'enforce_quota') as enforce_quota:
+            customer.change_plan(Plan('Gold', 299.0, 'infinite'))
+            customer.websites.remove(customer.websites.get_by_url('https://foo4.bar'))
+            customer.websites.remove(customer.websites.get_by_url('https://foo3.bar'))
+            customer.change_plan(self.plus_plan)
+            enforce_quota.assert_not_called()
+
+        self.assertIs(customer.subscription, self.plus_plan)
+
+    def test_unknown_policy(self):
+        """Test that unknown quota policies are rejected"""
+        with self.assertRaises(ValueError):
+            create_customer().change_plan(self.plus_plan, over_quota='foo')
+
+
+class PlanCatalogTestCase(TestCase):
+    def setUp(self):
+        self.catalog = PlanCatalog()
+
+    def test_identical_plans_are_shared(self):
+        """Test that identical plans are a single Plan object"""
+        plan = self.catalog.get('Plus', 99.0, 'plus', 3)
+
+        self.assertIs(self.catalog.get('Plus', '99', 'plus', 3), plan)
+        self.assertIsNot(self.catalog.get('Plus', 99.0, 'plus', 2), plan)
+        self.assertIsNot(self.catalog.get('Plus', 89.0, 'plus', 3), plan)
+        self.assertEqual(len(self.catalog), 3)
+        self.assertIn(plan, self.catalog)
+
+    def test_plans_are_validated_when_created(self):
+        """Test that catalog plans are validated as any other plan"""
+        with self.assertRaises(ValueError):
+            self.catalog.get('Plus', 99.0, 'plus', 4)
+
+        self.assertEqual(len(self.catalog), 0)
+
+    def test_intern_returns_the_catalog_plan(self):
+        """Test that interning a plan returns the identical one on the catalog, if any"""
+        plan = Plan('Single', 49.0, 'single')
+
+        self.assertIs(self.catalog.intern(plan), plan)
+        self.assertIs(self.catalog.intern(Plan('Single', 49.0, 'single')), plan)
+        self.assertIs(self.catalog.get('Single', 49.0), plan)
+        self.assertNotIn(Plan('Single', 49.0, 'single'), self.catalog)
+
+
 class PlanTestCase(TestCase):
     def setUp(self):
         self.customer = Customer('foo', 'bar', 'foo@bar.com')
@@ -125,6 +1873,18 @@ class PlanTestCase(TestCase):
         self.assertEqual(self.single_plan.total_websites_allowed, 1)
         self.assertEqual(self.plus_plan.total_websites_allowed, 3)
 
+    def test_websites_limit_follows_the_plan_type_rules(self):
+        """Test that websites_limit follows the plan type and the total websites allowed"""
+        self.assertEqual(self.single_plan.websites_limit, 1)
+        self.assertEqual(self.plus_plan.websites_limit, 3)
+        self.assertIsNone(self.infinite_plan.websites_limit)
+
+        self.plus_plan.total_websites_allowed = 2
+        self.assertEqual(self.plus_plan.websites_limit, 2)
+
+        self.plus_plan.plan_type = 'infinite'
+        self.assertIsNone(self.plus_plan.websites_limit)
+
     def test_plan_type_value(self):
         """Test that NO plan, with plan type different than 'single', 'plus' and 'infinite', can be initialized"""
         with self.assertRaises(ValueError):
@@ -167,6 +1927,114 @@ class PlanTestCase(TestCase):
         with self.assertRaises(CustomerAddWebsitePermissionDenied):
             self.customer.websites.add(self.website4)
 
+    def test_bulk_add_checks_plan_quota_once(self):
+        """Test that adding a batch of websites validates the plan quota only once"""
+        self.customer.subscribe_plan(self.plus_plan)
+
+        can_add_website = Customer.can_add_website
+        with mock.patch.object(Customer, 'can_add_website', autospec=True, side_effect=can_add_website) as can_add:
+            self.customer.websites.bulk_add(iter([self.website1, self.website2, self.website3]))
+
+        can_add.assert_called_once_with(self.customer, 3)
+        self.assertEqual(list(self.customer.websites.all()), [self.website1, self.website2, self.website3])
+        self.assertEqual(self.website3.customer, self.customer)
+
+    def test_bulk_add_is_all_or_nothing(self):
+        """Test that a batch of websites exceeding the plan quota doesn't add any of them"""
+        self.customer.subscribe_plan(self.plus_plan)
+        self.customer.websites.add(self.website1)
+
+        with self.assertRaises(CustomerAddWebsitePermissionDenied):
+            self.customer.websites.bulk_add([self.website2, self.website3, self.website4])
+
+        self.assertEqual(self.customer.websites.count(), 1)
+        self.assertIsNone(self.website2.customer)
+        self.assertIsNone(self.website4.customer)
+
+        # Websites already added aren't taken into account again
+        self.customer.websites.bulk_add([self.website1, self.website2, self.website3, self.website3])
+        self.assertEqual(self.customer.websites.count(), 3)
+
+    def test_concurrent_adds_respect_plan_quota(self):
+        """Test that many threads adding websites to the same customer can't go over the plan quota"""
+        self.customer.subscribe_plan(self.plus_plan)
+        # Switching threads as often as possible makes races between the quota check and the storage more likely
+        self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+        sys.setswitchinterval(1e-6)
+        total_threads = 32
+        barrier = threading.Barrier(total_threads)
+        counts = []
+
+        def add_websites(i):
+            websites = [Website('https://foo{}-{}.bar'.format(i, j)) for j in range(1 + i % 2)]
+            barrier.wait()
+            for _ in range(50):
+                try:
+                    self.customer.websites.add(*websites)
+                except CustomerAddWebsitePermissionDenied:
+                    continue
+
+                counts.append(self.customer.websites.count())
+                # Gives the websites back, so other threads get to race for the quota
+                for website in websites:
+                    self.customer.websites.remove(website)
+
+        self.run_threads(add_websites, range(total_threads))
+        self.assertEqual(self.customer.websites.count(), 0)
+        self.assertTrue(counts)
+        self.assertLessEqual(max(counts), 3)
+
+        # Now without giving the websites back
+        websites = [Website('https://foo{}.com'.format(i)) for i in range(total_threads)]
+
+        def set_customer(website):
+            barrier.wait()
+            try:
+                website.customer = self.customer
+            except CustomerAddWebsitePermissionDenied:
+                pass
+
+        self.run_threads(set_customer, websites)
+        self.assertEqual(self.customer.websites.count(), 3)
+        self.assertEqual(sum(1 for website in websites if website.customer), 3)
+
+    def test_concurrent_changes_are_signaled_in_order(self):
+        """Test that a website added into the quota freed by a removal is signaled after the removal"""
+        self.customer.subscribe_plan(self.single_plan)
+        website = Website('https://foo.bar', self.customer)
+        other_website = Website('https://bar.foo')
+        signaled = []
+        threads = []
+
+        def websites_added_receiver(sender, instance, websites, **kwargs):
+            signaled.append(('added', websites[0].url))
+
+        def websites_removed_receiver(sender, instance, websites, **kwargs):
+            # Another thread adds a website meanwhile, once the quota is freed
+            thread = threading.Thread(target=self.customer.websites.add, args=(other_website,))
+            thread.start()
+            threads.append(thread)
+            thread.join(0.05)
+            signaled.append(('removed', websites[0].url))
+
+        websites_added.connect(websites_added_receiver)
+        websites_removed.connect(websites_removed_receiver)
+        self.addCleanup(websites_added.disconnect, websites_added_receiver)
+        self.addCleanup(websites_removed.disconnect, websites_removed_receiver)
+
+        self.customer.websites.remove(website)
+        threads[0].join()
+
+        self.assertEqual(signaled, [('removed', 'https://foo.bar'), ('added', 'https://bar.foo')])
+        self.assertEqual(other_website.customer, self.customer)
+
+    def run_threads(self, target, args):
+        threads = [threading.Thread(target=target, args=(arg,)) for arg in args]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
     def test_plan_type_infinite_allow_unlimited_websites(self):
         """Test that the plan with type infinite can have multiple websites"""
 
@@ -0,0 +1,225 @@
+import ipaddress
+import threading
+from urllib.parse import urlsplit, urlunsplit
+
+from .exceptions import InvalidWebsiteURL, WebsiteAlreadyRegistered
+from .signals import (
+    website_pre_url_change, website_url_change_failed, website_url_changed, websites_add_failed, websites_added,
+    websites_pre_add, websites_removed,
+)
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# Public suffixes made of more than one label, whose domains are registered one level below them. A short list of
+# the most common ones, rather than the whole public suffix list, which can be extended as needed.
+MULTI_LABEL_SUFFIXES = {
+    'ac.uk', 'co.uk', 'gov.uk', 'org.uk', 'com.au', 'net.au', 'org.au', 'co.nz', 'co.jp', 'co.in', 'co.za',
+    'com.br', 'com.cn', 'com.mx', 'com.pt', 'com.tr',
+}
+
+
+def normalize_url(url):
+    """
+    Returns the normalized form of an url, which is the same for urls of the same website: scheme and host
+    lowercased, default port, trailing slashes, fragment and credentials dropped, e.g. 'HTTPS://Foo.bar:443/a/'
+    becomes 'https://foo.bar/a'. Raises InvalidWebsiteURL for urls which can't be parsed, e.g. with a port out of range.
+    """
+    parts = _split(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').rstrip('.')
+    try:
+        port = parts.port
+    except ValueError as error:
+        raise InvalidWebsiteURL('Invalid url {}: {}'.format(url, error))
+
+    netloc = host if port is None or DEFAULT_PORTS.get(scheme) == port else '{}:{}'.format(host, port)
+    return urlunsplit((scheme, netloc, parts.path.rstrip('/'), parts.query, ''))
+
+
+def url_host(url):
+    """Returns the lowercased host of an url (with or without a scheme)."""
+    return (_split(url).hostname or '').rstrip('.')
+
+
+def _split(url):
+    # Urls without a scheme (e.g. 'foo.bar/a') still have their host on the first part
+    try:
+        return urlsplit(url if '://' in url or url.startswith('//') else '//' + url)
+    except ValueError as error:
+        raise InvalidWebsiteURL('Invalid url {}: {}'.format(url, error))
+
+
+def registrable_domain(host):
+    """Returns the domain a host was registered under, e.g. 'example.co.uk' for 'www.blog.example.co.uk'."""
+    host = host.lower().rstrip('.')
+    try:
+        ipaddress.ip_address(host)
+        return host
+    except ValueError:
+        pass
+
+    labels = host.split('.')
+    size = 3 if '.'.join(labels[-2:]) in MULTI_LABEL_SUFFIXES else 2
+    return '.'.join(labels[-size:])
+
+
+class URLIndex:
+    """
+    Index of the websites of every customer by normalized url, where each url can only belong to one website,
+    and by registrable domain, so that the websites under a domain are found among the ones sharing its registrable
+    domain only.
+
+    The index follows the websites additions, removals and url changes of all the customers, through the
+    websites_added, websites_removed and website_url_changed signals, and prevents (raising WebsiteAlreadyRegistered)
+    adding or renaming a website to an url of another one, through websites_pre_add and website_pre_url_change.
+    Websites added before the index was created are only known to it once their customers are added.
+
+    Customers are changed under their own locks only, so the urls checked before a change are reserved (under the
+    index lock) until it's done, or until it fails (through websites_add_failed and website_url_change_failed),
+    which keeps two customers from registering the same url at the same time.
+    """
+
+    def __init__(self, customers=()):
+        """
+        :param customers=(): Customers whose websites are indexed straight away
+        """
+        # normalized url -> (customer, website)
+        self._urls = {}
+        # registrable domain -> {normalized url: website}
+        self._domains = {}
+        # normalized url -> website, of the urls checked for websites being added or renamed
+        self._reserved = {}
+        self._lock = threading.Lock()
+
+        for customer in customers:
+            self.add(customer)
+
+        websites_pre_add.connect(self._websites_pre_add)
+        website_pre_url_change.connect(self._website_pre_url_change)
+        websites_added.connect(self._websites_added)
+        websites_removed.connect(self._websites_removed)
+        website_url_changed.connect(self._website_url_changed)
+        websites_add_failed.connect(self._websites_add_failed)
+        website_url_change_failed.connect(self._website_url_change_failed)
+
+    def __len__(self):
+        return len(self._urls)
+
+    def __contains__(self, url):
+        return normalize_url(url) in self._urls
+
+    def add(self, customer):
+        """Indexes the websites a customer already has, raising WebsiteAlreadyRegistered if any url is taken."""
+        websites = list(customer.websites.all())
+        with self._lock:
+            self._check(websites)
+            for website in websites:
+                self._index(customer, website, website.url)
+
+    def get(self, url):
+        """Returns the website registered with the url (or an equivalent one), or None."""
+        return self._urls.get(normalize_url(url), (None, None))[1]
+
+    def owner(self, url):
+        """Returns the customer of the website registered with the url (or an equivalent one), or None."""
+        return self._urls.get(normalize_url(url), (None, None))[0]
+
+    def under_domain(self, domain):
+        """Returns the websites under a domain (e.g. 'example.com' or 'blog.example.com'), subdomains included."""
+        host = url_host(domain)
+        websites = self._domains.get(registrable_domain(host), {})
+
+        return [
+            website for normalized_url, website in websites.items()
+            if url_host(normalized_url) == host or url_host(normalized_url).endswith('.' + host)
+        ]
+
+    def close(self):
+        """Stops following the websites changes."""
+        websites_pre_add.disconnect(self._websites_pre_add)
+        website_pre_url_change.disconnect(self._website_pre_url_change)
+        websites_added.disconnect(self._websites_added)
+        websites_removed.disconnect(self._websites_removed)
+        website_url_changed.disconnect(self._website_url_changed)
+        websites_add_failed.disconnect(self._websites_add_failed)
+        website_url_change_failed.disconnect(self._website_url_change_failed)
+
+    def _check(self, websites, urls=None):
+        """
+        Raises WebsiteAlreadyRegistered if any of the websites urls belongs (or is reserved) to another website,
+        returning the normalized urls otherwise. Called under the index lock.
+        """
+        batch = {}
+        for website, url in zip(websites, urls or (website.url for website in websites)):
+            normalized_url = normalize_url(url)
+            registered_customer, registered_website = self._urls.get(normalized_url, (None, None))
+            reserved_website = self._reserved.get(normalized_url, website)
+
+            # Websites moving between customers keep their urls, while storages such as ArrayStorage may return
+            # another object for the same stored website
+            taken = registered_website is not None and registered_website is not website and not (
+                website._customer is registered_customer and website.url == registered_website.url
+            )
+            if taken or reserved_website is not website or batch.setdefault(normalized_url, website) is not website:
+                raise WebsiteAlreadyRegistered('Website with url {} is already registered'.format(url))
+
+        return batch
+
+    def _reserve(self, websites, urls=None):
+        with self._lock:
+            self._reserved.update(self._check(websites, urls))
+
+    def _release(self, websites, urls=None):
+        """Drops the reservations of the websites urls, if they're still theirs. Called under the index lock."""
+        for website, url in zip(websites, urls or (website.url for website in websites)):
+            normalized_url = normalize_url(url)
+            if self._reserved.get(normalized_url) is website:
+                del self._reserved[normalized_url]
+
+    def _index(self, customer, website, url):
+        normalized_url = normalize_url(url)
+        self._urls[normalized_url] = (customer, website)
+        self._domains.setdefault(registrable_domain(url_host(normalized_url)), {})[normalized_url] = website
+
+    def _unindex(self, customer, url):
+        normalized_url = normalize_url(url)
+        if self._urls.get(normalized_url, (None,))[0] is not customer:
+            return
+
+        del self._urls[normalized_url]
+        domain = registrable_domain(url_host(normalized_url))
+        websites = self._domains[domain]
+        del websites[normalized_url]
+        if not websites:
+            del self._domains[domain]
+
+    def _websites_pre_add(self, sender, instance, websites, **kwargs):
+        self._reserve(websites)
+
+    def _website_pre_url_change(self, sender, instance, website, url, **kwargs):
+        self._reserve([website], [url])
+
+    def _websites_add_failed(self, sender, instance, websites, **kwargs):
+        with self._lock:
+            self._release(websites)
+
+    def _website_url_change_failed(self, sender, instance, website, url, **kwargs):
+        with self._lock:
+            self._release([website], [url])
+
+    def _websites_added(self, sender, instance, websites, **kwargs):
+        with self._lock:
+            self._release(websites)
+            for website in websites:
+                self._index(instance, website, website.url)
+
+    def _websites_removed(self, sender, instance, websites, **kwargs):
+        with self._lock:
+            for website in websites:
+                self._unindex(instance, website.url)
+
+    def _website_url_changed(self, sender, instance, website, old_url, **kwargs):
+        with self._lock:
+            self._release([website])
+            self._unindex(instance, old_url)
+            self._index(instance, website, website.url)
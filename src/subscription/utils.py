@@ -1,5 +1,12 @@
 import datetime
 
+try:
+    import numpy
+except ImportError:  # NumPy is optional, and only used to speed up batch calculations
+    numpy = None
+
+from . import settings
+
 
 def get_year_total_days(year=None):
     """Util function that calculates the total days a year have."""
@@ -13,3 +20,58 @@ def get_year_total_days(year=None):
     # needs to add one more day so we get 365/366 results
     return (last_day_year - first_day_year).days + 1
 
+
+def get_renewal_dates(subscriptions, use_numpy=None):
+    """
+    Util function that calculates, at once, the renewal dates of a sequence of customers or subscription dates.
+    Gives the same results as Customer.sub_renewal_date, including None for customers without a subscription.
+
+    :param subscriptions: Sequence of Customer objects or subscription dates (None allowed)
+    :param use_numpy=None: Whether to use NumPy datetime64 arithmetic. Defaults to using it when it's installed.
+    """
+    subscription_dates = [_get_subscription_date(item) for item in subscriptions]
+    ttl_days = getattr(settings, 'SUBSCRIPTION_TTL_DAYS', None)
+
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    if use_numpy:
+        return _get_renewal_dates_numpy(subscription_dates, ttl_days)
+
+    # The subscription TTL only depends on the year, so it's calculated once per year
+    years_ttl_days = {}
+    renewal_dates = []
+    for subscription_date in subscription_dates:
+        if subscription_date is None:
+            renewal_dates.append(None)
+            continue
+
+        days = ttl_days
+        if days is None:
+            days = years_ttl_days.get(subscription_date.year)
+            if days is None:
+                days = years_ttl_days[subscription_date.year] = get_year_total_days(subscription_date.year + 1)
+
+        renewal_dates.append(subscription_date + datetime.timedelta(days=days))
+
+    return renewal_dates
+
+
+def _get_subscription_date(item):
+    if item is None or isinstance(item, datetime.date):
+        return item
+
+    return item.subscription_date if item.subscription else None
+
+
+def _get_renewal_dates_numpy(subscription_dates, ttl_days=None):
+    # Missing subscription dates become NaT, which are turned back into None
+    dates = numpy.array(subscription_dates, dtype='datetime64[D]')
+
+    if ttl_days is None:
+        # datetime64[Y] counts years since 1970, and the TTL is the total days of the year after the subscription
+        next_years = dates.astype('datetime64[Y]').astype(numpy.int64) + 1971
+        leap_years = (next_years % 4 == 0) & ((next_years % 100 != 0) | (next_years % 400 == 0))
+        ttl_days = 365 + leap_years.astype(numpy.int64)
+
+    renewal_dates = dates + numpy.asarray(ttl_days).astype('timedelta64[D]')
+    return renewal_dates.astype(object).tolist()